@@ -1,14 +1,17 @@
 import json
-import re
 import os
 import argparse
 import shutil
-from utils import extract_planning, content_to_json, format_json_data
+import sys
+from utils import format_json_data
+from planning_context import find_config_yaml, build_bundle, save_bundle, load_planning_context
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--paper_name',type=str)
 parser.add_argument('--output_dir',type=str, default="")
+parser.add_argument('--pdf_json_path', type=str, default="",
+                    help="Paper to render into the planning context bundle (optional)")
 
 args    = parser.parse_args()
 
@@ -17,28 +20,25 @@ output_dir = args.output_dir
 with open(f'{output_dir}/planning_trajectories.json', encoding='utf8') as f:
     traj = json.load(f)
 
-yaml_raw_content = ""
-for turn_idx, turn in enumerate(traj):
-        if turn_idx == 8:
-            yaml_raw_content = turn['content']   
-
-if "</think>" in yaml_raw_content:
-    yaml_raw_content = yaml_raw_content.split("</think>")[-1]
-
-match = re.search(r"```yaml\n(.*?)\n```", yaml_raw_content, re.DOTALL)
-if match:
-    yaml_content = match.group(1)
+# the config turn is the last one with a yaml block, wherever it sits in the conversation
+yaml_content = find_config_yaml(traj)
+if yaml_content is not None:
     with open(f'{output_dir}/planning_config.yaml', 'w', encoding='utf8') as f:
         f.write(yaml_content)
 else:
-    # print("No YAML content found.")
-    match2 = re.search(r"```yaml\\n(.*?)\\n```", yaml_raw_content, re.DOTALL)
-    if match2:
-        yaml_content = match2.group(1)
-        with open(f'{output_dir}/planning_config.yaml', 'w', encoding='utf8') as f:
-            f.write(yaml_content)
-    else:
-        print("No YAML content found.")
+    print("No YAML content found.")
+
+# ---------------------------------------
+
+# the validated planning context bundle the downstream stages load (planning_context.py)
+try:
+    bundle = build_bundle(output_dir)
+except (ValueError, OSError) as e:
+    print(f"[ERROR] {e}. Please re-generate the planning.")
+    sys.exit(0)
+for warning in bundle["warnings"]:
+    print(f"[WARNING] planning: {warning}")
+save_bundle(output_dir, bundle)
 
 # ---------------------------------------
 
@@ -46,16 +46,14 @@ artifact_output_dir=f"{output_dir}/planning_artifacts"
 
 os.makedirs(artifact_output_dir, exist_ok=True)
 
-context_lst = extract_planning(f'{output_dir}/planning_trajectories.json')
-
-arch_design = content_to_json(context_lst[1])
-logic_design = content_to_json(context_lst[2])
+arch_design = bundle["design"]
+logic_design = bundle["task_list"]
 
 formatted_arch_design = format_json_data(arch_design)
 formatted_logic_design = format_json_data(logic_design)
 
 with open(f"{artifact_output_dir}/1.1_overall_plan.txt", "w", encoding="utf-8") as f:
-    f.write(context_lst[0])
+    f.write(bundle["context_lst"][0])
 
 with open(f"{artifact_output_dir}/1.2_arch_design.txt", "w", encoding="utf-8") as f:
     f.write(formatted_arch_design)
@@ -64,3 +62,11 @@ with open(f"{artifact_output_dir}/1.3_logic_design.txt", "w", encoding="utf-8")
     f.write(formatted_logic_design)
 
 shutil.copy(f"{output_dir}/planning_config.yaml", f"{artifact_output_dir}/1.4_config.yaml")
+
+# ---------------------------------------
+
+if args.pdf_json_path:
+    # stores the rendered paper in the bundle for the stages that prompt with it
+    with open(args.pdf_json_path) as f:
+        load_planning_context(output_dir, json.load(f))
+print(f"[SAVED] {output_dir}/planning_context.json ({bundle['hash'][:12]}, {len(bundle['todo_file_lst'])} files)")
@@ -1,10 +1,13 @@
-from openai import OpenAI
 import json
 from tqdm import tqdm
 import argparse
 import os
 import sys
-from utils import print_response, print_log_cost, load_accumulated_cost, save_accumulated_cost
+from utils import print_response, print_log_cost, load_accumulated_cost, save_accumulated_cost, \
+        add_api_args, load_response_cache, get_executor
+from context_budget import ContextBudgeter, fit_paper_in_messages, add_budget_args
+from backends import add_backend_args, get_backend, context_window
+from prompts import render_paper
 
 parser = argparse.ArgumentParser()
 
@@ -14,10 +17,14 @@ parser.add_argument('--paper_format',type=str, default="JSON", choices=["JSON",
 parser.add_argument('--pdf_json_path', type=str) # json format
 parser.add_argument('--pdf_latex_path', type=str) # latex format
 parser.add_argument('--output_dir',type=str, default="")
+add_api_args(parser)
+add_budget_args(parser)
+add_backend_args(parser)
 
 args    = parser.parse_args()
 
-client = OpenAI(api_key = os.environ["OPENAI_API_KEY"])
+cache = load_response_cache(args)
+backend = get_backend(args, args.gpt_version, cache)
 
 paper_name = args.paper_name
 gpt_version = args.gpt_version
@@ -50,7 +57,7 @@ Instructions:
 3. Prioritize Efficiency: Optimize the plan for clarity and practical implementation while ensuring fidelity to the original experiments."""},
         {"role": "user",
          "content" : f"""## Paper
-{paper_content}
+{render_paper(paper_content)}
 
 ## Task
 1. We want to reproduce the method described in the attached paper. 
@@ -215,20 +222,20 @@ training:
 
 def api_call(msg, gpt_version):
     if "o3-mini" in gpt_version:
-        completion = client.chat.completions.create(
-            model=gpt_version, 
-            reasoning_effort="high",
-            messages=msg
-        )
+        request_json = {"model": gpt_version, "reasoning_effort": "high", "messages": msg}
     else:
-        completion = client.chat.completions.create(
-            model=gpt_version, 
-            messages=msg
-        )
+        request_json = {"model": gpt_version, "messages": msg}
 
-    return completion 
+    return backend.complete(request_json)
 
 responses = []
+# keep the paper within the model's context; the headroom leaves room for the four replies
+PLANNING_HEADROOM = 32_000
+PLANNING_QUERY = "methodology method model architecture experiments dataset settings hyperparameters training evaluation metrics"
+budgeter = ContextBudgeter(gpt_version, output_dir, context_window(args), headroom=PLANNING_HEADROOM)
+fit_paper_in_messages(budgeter, paper_content, plan_msg + file_list_msg + task_list_msg + config_msg,
+                      PLANNING_QUERY, "[Planning]")
+
 trajectories = []
 total_accumulated_cost = 0
 
@@ -265,6 +272,9 @@ for idx, instruction_msg in enumerate([plan_msg, file_list_msg, task_list_msg, c
 
 # save
 save_accumulated_cost(f"{output_dir}/accumulated_cost.json", total_accumulated_cost)
+if cache is not None:
+    cache.write_stats(output_dir, "[Planning]")
+get_executor().write_stats(output_dir, "[Planning]")
 
 os.makedirs(output_dir, exist_ok=True)
 
@@ -2,18 +2,18 @@ import json
 import argparse
 import os
 import sys
-from utils import print_response
-from transformers import AutoTokenizer
-from vllm import LLM, SamplingParams
+from utils import print_response, add_api_args, load_response_cache
+from context_budget import ContextBudgeter, fit_paper_in_messages, LOCAL_RESERVE_OUTPUT
+from backends import add_backend_args, get_backend, complete_text
+from prompts import render_paper
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--paper_name',type=str)
 
 parser.add_argument('--model_name',type=str, default="deepseek-ai/DeepSeek-Coder-V2-Lite-Instruct") 
-parser.add_argument('--tp_size',type=int, default=2)
-parser.add_argument('--temperature',type=float, default=1.0)
-parser.add_argument('--max_model_len',type=int, default=128000)
+add_backend_args(parser, default="vllm")
+add_api_args(parser)
 
 parser.add_argument('--paper_format',type=str, default="JSON", choices=["JSON", "LaTeX"])
 parser.add_argument('--pdf_json_path', type=str) # json format
@@ -57,7 +57,7 @@ Instructions:
 3. Prioritize Efficiency: Optimize the plan for clarity and practical implementation while ensuring fidelity to the original experiments."""},
         {"role": "user",
          "content" : f"""## Paper
-{paper_content}
+{render_paper(paper_content)}
 
 ## Task
 1. We want to reproduce the method described in the attached paper. 
@@ -221,39 +221,22 @@ training:
     }]
 
 
-model_name = args.model_name
-tokenizer = AutoTokenizer.from_pretrained(model_name)
-
-
-if "Qwen" in model_name:
-    llm = LLM(model=model_name, 
-            tensor_parallel_size=tp_size, 
-            max_model_len=max_model_len,
-            gpu_memory_utilization=0.95,
-            trust_remote_code=True, enforce_eager=True, 
-            rope_scaling={"factor": 4.0, "original_max_position_embeddings": 32768, "type": "yarn"})
-    sampling_params = SamplingParams(temperature=temperature, max_tokens=131072)
-
-elif "deepseek" in model_name:
-    llm = LLM(model=model_name, 
-              tensor_parallel_size=tp_size, 
-              max_model_len=max_model_len,
-              gpu_memory_utilization=0.95,
-              trust_remote_code=True, enforce_eager=True)
-    sampling_params = SamplingParams(temperature=temperature, max_tokens=128000, stop_token_ids=[tokenizer.eos_token_id])
+cache = load_response_cache(args)
+backend = get_backend(args, model_name, cache)
 
 
 def run_llm(msg):
-    # vllm
-    prompt_token_ids = [tokenizer.apply_chat_template(messages, add_generation_prompt=True) for messages in [msg]]
-
-    outputs = llm.generate(prompt_token_ids=prompt_token_ids, sampling_params=sampling_params)
-
-    completion = [output.outputs[0].text for output in outputs]
-    
-    return completion[0] 
+    # the vllm backend only tokenizes the turns appended since the previous call (chat_encoding.py)
+    return complete_text(backend, msg)
 
 responses = []
+# keep the paper within the model's context; the headroom leaves room for the four replies
+PLANNING_HEADROOM = 32_000
+PLANNING_QUERY = "methodology method model architecture experiments dataset settings hyperparameters training evaluation metrics"
+budgeter = ContextBudgeter(model_name, output_dir, max_model_len, LOCAL_RESERVE_OUTPUT, headroom=PLANNING_HEADROOM)
+fit_paper_in_messages(budgeter, paper_content, plan_msg + file_list_msg + task_list_msg + config_msg,
+                      PLANNING_QUERY, "[Planning]")
+
 trajectories = []
 total_accumulated_cost = 0
 
@@ -1,14 +1,18 @@
 import json
 import os
 import sys
-import copy
 from tqdm import tqdm
-from utils import extract_planning, content_to_json, print_response
+from utils import print_response, add_api_args, load_response_cache, \
+    get_executor, IncrementalWriter
+from context_budget import ContextBudgeter, add_budget_args
+from backends import add_backend_args, get_backend, context_window
+from prompts import PromptLayout, prompt_cache_stats, cached_tokens_of, record_prompt_cache_stats
+from planning_context import load_planning_context
 from pathlib import Path
-import openai
 import argparse
 
 MAX_FEEDBACK_ITERATIONS = 3
+FEEDBACK_TURN_TOKENS = 8_000  # one revision + its critiques, reserved per extra iteration
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--paper_name', type=str)
@@ -17,6 +21,11 @@ parser.add_argument('--paper_format', type=str, default="JSON", choices=["JSON",
 parser.add_argument('--pdf_json_path', type=str)
 parser.add_argument('--pdf_latex_path', type=str)
 parser.add_argument('--output_dir', type=str, default="")
+parser.add_argument('--stream', action="store_true",
+                    help="Stream each revision into its debug_revisions file as it arrives")
+add_api_args(parser)
+add_budget_args(parser)
+add_backend_args(parser)
 args = parser.parse_args()
 
 paper_name = args.paper_name
@@ -26,21 +35,24 @@ pdf_json_path = args.pdf_json_path
 pdf_latex_path = args.pdf_latex_path
 output_dir = args.output_dir
 
-gpt_version = "o3-mini"  # or o3-mini
-client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+if args.backend == "openai":
+    gpt_version = "o3-mini"  # or o3-mini
+cache = load_response_cache(args)
+backend = get_backend(args, gpt_version, cache)
+prompt_cache_usage = {"prompt_tokens": 0, "cached_tokens": 0}
 
-def api_call(msg):
+def api_call(msg, stream_path=None):
     if "o3-mini" in gpt_version:
-        completion = client.chat.completions.create(
-            model=gpt_version,
-            messages=msg,
-            reasoning_effort="high"
-        )
+        request_json = {"model": gpt_version, "messages": msg, "reasoning_effort": "high"}
     else:
-        completion = client.chat.completions.create(
-            model=gpt_version,
-            messages=msg
-        )
+        request_json = {"model": gpt_version, "messages": msg}
+    if args.stream and stream_path is not None:
+        completion = backend.stream(request_json, IncrementalWriter(stream_path).update)
+    else:
+        completion = backend.complete(request_json)
+    if completion.usage:
+        prompt_cache_usage["prompt_tokens"] += completion.usage.prompt_tokens
+        prompt_cache_usage["cached_tokens"] += cached_tokens_of(completion)
     return completion.choices[0].message.content
 
 
@@ -54,42 +66,26 @@ else:
     print(f"[ERROR] Invalid paper format. Please select either 'JSON' or 'LaTeX.")
     sys.exit(0)
 
-with open(f'{output_dir}/planning_config.yaml') as f:
-    config_yaml = f.read()
-
-context_lst = extract_planning(f'{output_dir}/planning_trajectories.json')
-
-if os.path.exists(f'{output_dir}/task_list.json'):
-    with open(f'{output_dir}/task_list.json') as f:
-        task_list = json.load(f)
-else:
-    task_list = content_to_json(context_lst[2])
-
-if 'Task list' in task_list:
-    todo_file_lst = task_list['Task list']
-elif 'task_list' in task_list:
-    todo_file_lst = task_list['task_list']
-elif 'task list' in task_list:
-    todo_file_lst = task_list['task list']
-else:
-    print(f"[ERROR] 'Task list' does not exist. Please re-generate the planning.")
+try:
+    planning = load_planning_context(output_dir, paper_content)
+except ValueError as e:
+    print(f"[ERROR] {e}. Please re-generate the planning.")
     sys.exit(0)
 
-if 'Logic Analysis' in task_list:
-    logic_analysis = task_list['Logic Analysis']
-elif 'logic_analysis' in task_list:
-    logic_analysis = task_list['logic_analysis']
-elif 'logic analysis' in task_list:
-    logic_analysis = task_list['logic analysis']
-else:
-    print(f"[ERROR] 'Logic Analysis' does not exist. Please re-generate the planning.")
-    sys.exit(0)
+config_yaml = planning.config_yaml
+context_lst = planning.context_lst
+todo_file_lst = planning.todo_file_lst
+logic_analysis_dict = planning.logic_analysis_dict
 
 done_file_lst = ['config.yaml']
-logic_analysis_dict = {desc[0]: desc[1] for desc in logic_analysis}
 
-analysis_msg = [
-    {"role": "system", "content": f"""You are an expert researcher, strategic analyzer and software engineer with a deep understanding of experimental design and reproducibility in scientific research.
+# the stage prompt follows the shared planning context (see prompts.py)
+# headroom: the revisions and critiques appended by later feedback iterations
+budgeter = ContextBudgeter(gpt_version, output_dir, context_window(args),
+                           headroom=(MAX_FEEDBACK_ITERATIONS - 1) * FEEDBACK_TURN_TOKENS)
+layout = PromptLayout(paper_content, context_lst, config_yaml, budgeter)
+
+analysis_prompt = f"""You are an expert researcher, strategic analyzer and software engineer with a deep understanding of experimental design and reproducibility in scientific research.
 You will receive a research paper in {paper_format} format, an overview of the plan, a design in JSON format consisting of \"Implementation approach\", \"File list\", \"Data structures and interfaces\", and \"Program call flow\", followed by a task in JSON format that includes \"Required packages\", \"Required other language third-party packages\", \"Logic Analysis\", and \"Task list\", along with a configuration file named \"config.yaml\".
 
 Your task is to conduct a comprehensive logic analysis to accurately reproduce the experiments and methodologies described in the research paper.
@@ -100,40 +96,13 @@ This analysis must align precisely with the paper’s methodology, experimental
 3. Prioritize Efficiency: Optimize the analysis for clarity and practical implementation while ensuring fidelity to the original experiments.
 4. Follow design: YOU MUST FOLLOW \"Data structures and interfaces\". DONT CHANGE ANY DESIGN. Do not use public member functions that do not exist in your design.
 5. REFER TO CONFIGURATION: Always reference settings from the config.yaml file. Do not invent or assume any values—only use configurations explicitly provided.
-"""}]
+"""
 
 def get_write_msg(todo_file_name, todo_file_desc):
     draft_desc = f"Write the logic analysis in '{todo_file_name}', which is intended for '{todo_file_desc}'."
     if len(todo_file_desc.strip()) == 0:
         draft_desc = f"Write the logic analysis in '{todo_file_name}'."
-    return [{
-        'role': 'user', 'content': f"""## Paper
-{paper_content}
-
------
-
-## Overview of the plan
-{context_lst[0]}
-
------
-
-## Design
-{context_lst[1]}
-
------
-
-## Task
-{context_lst[2]}
-
------
-
-## Configuration file
-```yaml
-{config_yaml}
-```
------
-
-## Instruction
+    return layout.messages(analysis_prompt, f"""## Instruction
 Conduct a Logic Analysis to assist in writing the code, based on the paper, the plan, the design, the task and the previously specified configuration file (config.yaml).
 You DON'T need to provide the actual code yet; focus on a thorough, clear analysis.
 
@@ -141,7 +110,8 @@ You DON'T need to provide the actual code yet; focus on a thorough, clear analys
 
 -----
 
-## Logic Analysis: {todo_file_name}"""}]
+## Logic Analysis: {todo_file_name}""", query=f"{todo_file_name} {todo_file_desc}",
+                           label=f"[ANALYZING] {todo_file_name}")
     
 
 def run_evaluation_on_analysis(todo_file_name, analysis_text):
@@ -199,11 +169,7 @@ for todo_file_name in tqdm(todo_file_lst):
     print(f"[ANALYZING] {todo_file_name}")
 
     # ── 1. build a fresh message stack for this file ─────────────
-    file_msg = copy.deepcopy(analysis_msg)          # use the global template
-    file_msg.extend(get_write_msg(
-        todo_file_name,
-        logic_analysis_dict.get(todo_file_name, "")
-    ))
+    file_msg = get_write_msg(todo_file_name, logic_analysis_dict.get(todo_file_name, ""))
 
     # ── 2. make sure debug folder exists (first call only) ───────
     debug_output_dir = Path(output_dir) / "analyzing_artifacts" / "debug_revisions"
@@ -213,7 +179,7 @@ for todo_file_name in tqdm(todo_file_lst):
     max_iterations = MAX_FEEDBACK_ITERATIONS
     for iteration in range(1, max_iterations + 1):
         print(f"\n🔄 Iteration {iteration}: generating analysis...")
-        analysis_text = api_call(file_msg)
+        analysis_text = api_call(file_msg, debug_output_dir / f"{safe_name}_rev{iteration}.txt")
 
         # save intermediate revision for inspection
         (debug_output_dir / f"{safe_name}_rev{iteration}.txt").write_text(
@@ -285,3 +251,9 @@ for todo_file_name in tqdm(todo_file_lst):
     )
 
     print(f"✅ Final analysis for {todo_file_name} saved.")
+
+record_prompt_cache_stats(output_dir, "analyzing",
+                          prompt_cache_stats(prompt_cache_usage["prompt_tokens"], prompt_cache_usage["cached_tokens"]))
+if cache is not None:
+    cache.write_stats(output_dir, "[ANALYZING]")
+get_executor().write_stats(output_dir, "[ANALYZING]")
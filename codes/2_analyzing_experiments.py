@@ -19,23 +19,51 @@ Usage examples:
 
   # Experiment 4: Multi-signal (all channels combined)
   python 2_analyzing_experiments.py --mode multi_signal --feedback_format json ...
+
+  # Any mode, analyzing up to 4 files in parallel
+  python 2_analyzing_experiments.py --mode llm_only --concurrency 4 ...
+
+  # Continue a crashed run from its per-file / per-iteration checkpoints
+  python 2_analyzing_experiments.py --mode llm_only --resume ...
+
+  # Revise with patch hunks instead of re-sending every earlier revision
+  python 2_analyzing_experiments.py --mode multi_signal --revision_mode patch ...
+
+  # Stop a file's loop once revisions stop paying off (see stopping.py)
+  python 2_analyzing_experiments.py --mode llm_only --stop_policy no_improvement,token_budget:60000 ...
+
+  # Re-run the critique/merge/stop logic offline on a recorded run's replies
+  python 2_analyzing_experiments.py --mode multi_signal --replay_from ../outputs/fit/experiments/llm_only_json \
+      --replay_tag llm_only_json --output_dir /tmp/fit_replay ...
+
+  # Also run one tiny forward/backward step per model class (needs torch)
+  python 2_analyzing_experiments.py --mode static_only --exec_smoke ...
 """
 
+import asyncio
 import json
 import os
 import sys
-import copy
 from tqdm import tqdm
-from utils import extract_planning, content_to_json, print_response
+from utils import print_response, add_api_args, load_response_cache, \
+    IncrementalWriter, estimate_request_tokens, get_executor, DEFAULT_CACHE_DIR
+from revision import patch_request, parse_hunks, apply_hunks
+from context_budget import ContextBudgeter, add_budget_args
+from backends import add_backend_args, get_backend, context_window
+from prompts import PromptLayout, prompt_cache_stats, cached_tokens_of, record_prompt_cache_stats
+from planning_context import load_planning_context
 from pathlib import Path
-import openai
 import argparse
 import time
 
 # ---- import the static analysis module ----
-from static_analysis import ast_check, pylint_check, import_probe, merge_critiques, filter_high
+from static_analysis import StaticAnalysisEngine, merge_critiques, filter_high
+from probe_server import DEFAULT_PRELOAD, DEFAULT_MEMORY_MB
+from stopping import StopController, POLICIES
+from replay import ReplaySource, add_usage
 
 MAX_FEEDBACK_ITERATIONS = 3
+FEEDBACK_TURN_TOKENS = 8_000  # one revision + its critiques, reserved per extra iteration
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--paper_name', type=str)
@@ -54,6 +82,36 @@ parser.add_argument('--feedback_format', type=str, default="json",
                     help="LLM critique format: json (structured) or freetext")
 parser.add_argument('--output_repo_dir', type=str, default="",
                     help="Path to the generated repo (for static analysis on .py files)")
+parser.add_argument('--concurrency', type=int, default=1,
+                    help="Number of files whose feedback loops run in parallel (1 = serial)")
+parser.add_argument('--resume', action="store_true",
+                    help="Skip finished files and continue unfinished ones from their last iteration checkpoint")
+parser.add_argument('--revision_mode', type=str, default="transcript", choices=["transcript", "patch"],
+                    help="transcript: re-send all revisions and critiques; "
+                         "patch: send only the current analysis + open critiques and apply returned hunks")
+parser.add_argument('--static_workers', type=int, default=0,
+                    help="Processes for the static-analysis channels (0 = one per CPU)")
+parser.add_argument('--static_cache_dir', type=str, default=os.path.join(DEFAULT_CACHE_DIR, "static_analysis"),
+                    help="Cache of static-analysis results by file content ('' = this run only)")
+parser.add_argument('--probe_preload', type=str, default=DEFAULT_PRELOAD,
+                    help="Packages the warm import-probe server imports once ('none' = one interpreter per probe)")
+parser.add_argument('--probe_memory_mb', type=int, default=DEFAULT_MEMORY_MB,
+                    help="Address space each import probe may add on top of the preload (0 = no limit)")
+parser.add_argument('--exec_smoke', action="store_true",
+                    help="Add the exec-smoke channel: one forward/backward step per nn.Module on a shrunk config")
+parser.add_argument('--stop_policy', type=str, default="",
+                    help=f"Extra stopping policies, comma-separated name[:value] ({', '.join(POLICIES)}); "
+                         "the loop always stops once no high/medium critiques remain or at the iteration cap")
+parser.add_argument('--stream', action="store_true",
+                    help="Stream each revision into its debug_revisions file as it arrives")
+parser.add_argument('--replay_from', type=str, default="",
+                    help="Experiment dir of a finished run: serve its recorded revisions and judge replies "
+                         "instead of calling the API (see replay.py)")
+parser.add_argument('--replay_tag', type=str, default="",
+                    help="<mode>_<feedback_format> of the recorded run (default: read from its summary)")
+add_api_args(parser)
+add_budget_args(parser)
+add_backend_args(parser)
 
 args = parser.parse_args()
 
@@ -66,34 +124,46 @@ output_dir = args.output_dir
 mode = args.mode
 feedback_format = args.feedback_format
 output_repo_dir = args.output_repo_dir
+concurrency = max(1, args.concurrency)
+resume = args.resume
+revision_mode = args.revision_mode
+stop_controller = StopController(args.stop_policy, MAX_FEEDBACK_ITERATIONS)
 
-client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-# ---- Token tracking ----
-total_prompt_tokens = 0
-total_completion_tokens = 0
+cache = load_response_cache(args)
+backend = get_backend(args, gpt_version, cache) if not args.replay_from else None
+replay = ReplaySource(args.replay_from, args.replay_tag or None) if args.replay_from else None
 
 
-def api_call(msg):
-    """Call the API and track tokens."""
-    global total_prompt_tokens, total_completion_tokens
+async def api_call(msg, usage, replay_key=None, stream_path=None):
+    """
+    Call the API and add the token usage to this file's `usage` counters.
+    With --replay_from, serve the recorded reply for
+    replay_key = (kind "revision" | "judge", file, iteration) instead. With
+    --stream and a `stream_path`, the reply is written there as it arrives.
+    """
+    if replay is not None:
+        kind, todo_file_name, iteration = replay_key
+        if kind == "revision":
+            reply = replay.revision(todo_file_name, iteration, patch=(revision_mode == "patch" and iteration > 1))
+        else:
+            reply = replay.judge_response(todo_file_name, iteration, feedback_format)
+        add_usage(usage, msg, reply)
+        return reply
 
     if "o3-mini" in gpt_version:
-        completion = client.chat.completions.create(
-            model=gpt_version,
-            messages=msg,
-            reasoning_effort="high"
-        )
+        request_json = {"model": gpt_version, "messages": msg, "reasoning_effort": "high"}
     else:
-        completion = client.chat.completions.create(
-            model=gpt_version,
-            messages=msg
-        )
+        request_json = {"model": gpt_version, "messages": msg}
+    if args.stream and stream_path is not None:
+        completion = await backend.astream(request_json, IncrementalWriter(stream_path).update)
+    else:
+        completion = await backend.acomplete(request_json)
 
     # Track tokens
     if hasattr(completion, 'usage') and completion.usage:
-        total_prompt_tokens += completion.usage.prompt_tokens
-        total_completion_tokens += completion.usage.completion_tokens
+        usage["prompt_tokens"] += completion.usage.prompt_tokens
+        usage["completion_tokens"] += completion.usage.completion_tokens
+        usage["cached_tokens"] = usage.get("cached_tokens", 0) + cached_tokens_of(completion)
 
     return completion.choices[0].message.content
 
@@ -109,39 +179,24 @@ else:
     print("[ERROR] Invalid paper format.")
     sys.exit(0)
 
-with open(f'{output_dir}/planning_config.yaml') as f:
-    config_yaml = f.read()
-
-context_lst = extract_planning(f'{output_dir}/planning_trajectories.json')
-
-if os.path.exists(f'{output_dir}/task_list.json'):
-    with open(f'{output_dir}/task_list.json') as f:
-        task_list = json.load(f)
-else:
-    task_list = content_to_json(context_lst[2])
-
-# Robust key lookup
-for key in ['Task list', 'task_list', 'task list']:
-    if key in task_list:
-        todo_file_lst = task_list[key]
-        break
-else:
-    print("[ERROR] 'Task list' not found.")
+try:
+    planning = load_planning_context(output_dir, paper_content)
+except ValueError as e:
+    print(f"[ERROR] {e}. Please re-generate the planning.")
     sys.exit(0)
 
-for key in ['Logic Analysis', 'logic_analysis', 'logic analysis']:
-    if key in task_list:
-        logic_analysis = task_list[key]
-        break
-else:
-    print("[ERROR] 'Logic Analysis' not found.")
-    sys.exit(0)
+config_yaml = planning.config_yaml
+context_lst = planning.context_lst
+todo_file_lst = planning.todo_file_lst
+logic_analysis_dict = planning.logic_analysis_dict
 
-logic_analysis_dict = {desc[0]: desc[1] for desc in logic_analysis}
+# ---- Stage prompt (follows the shared planning context, see prompts.py) ----
+# headroom: the revisions and critiques appended by later feedback iterations
+budgeter = ContextBudgeter(gpt_version, output_dir, context_window(args),
+                           headroom=(MAX_FEEDBACK_ITERATIONS - 1) * FEEDBACK_TURN_TOKENS)
+layout = PromptLayout(paper_content, context_lst, config_yaml, budgeter)
 
-# ---- System message ----
-analysis_msg = [
-    {"role": "system", "content": f"""You are an expert researcher, strategic analyzer and software engineer with a deep understanding of experimental design and reproducibility in scientific research.
+analysis_prompt = f"""You are an expert researcher, strategic analyzer and software engineer with a deep understanding of experimental design and reproducibility in scientific research.
 You will receive a research paper in {paper_format} format, an overview of the plan, a design in JSON format consisting of "Implementation approach", "File list", "Data structures and interfaces", and "Program call flow", followed by a task in JSON format that includes "Required packages", "Required other language third-party packages", "Logic Analysis", and "Task list", along with a configuration file named "config.yaml".
 
 Your task is to conduct a comprehensive logic analysis to accurately reproduce the experiments and methodologies described in the research paper.
@@ -152,40 +207,14 @@ This analysis must align precisely with the paper's methodology, experimental se
 3. Prioritize Efficiency: Optimize the analysis for clarity and practical implementation while ensuring fidelity to the original experiments.
 4. Follow design: YOU MUST FOLLOW "Data structures and interfaces". DONT CHANGE ANY DESIGN. Do not use public member functions that do not exist in your design.
 5. REFER TO CONFIGURATION: Always reference settings from the config.yaml file. Do not invent or assume any values.
-"""}]
+"""
 
 
 def get_write_msg(todo_file_name, todo_file_desc):
     draft_desc = f"Write the logic analysis in '{todo_file_name}', which is intended for '{todo_file_desc}'."
     if len(todo_file_desc.strip()) == 0:
         draft_desc = f"Write the logic analysis in '{todo_file_name}'."
-    return [{'role': 'user', 'content': f"""## Paper
-{paper_content}
-
------
-
-## Overview of the plan
-{context_lst[0]}
-
------
-
-## Design
-{context_lst[1]}
-
------
-
-## Task
-{context_lst[2]}
-
------
-
-## Configuration file
-```yaml
-{config_yaml}
-```
------
-
-## Instruction
+    return layout.messages(analysis_prompt, f"""## Instruction
 Conduct a Logic Analysis to assist in writing the code, based on the paper, the plan, the design, the task and the previously specified configuration file (config.yaml).
 You DON'T need to provide the actual code yet; focus on a thorough, clear analysis.
 
@@ -193,10 +222,11 @@ You DON'T need to provide the actual code yet; focus on a thorough, clear analys
 
 -----
 
-## Logic Analysis: {todo_file_name}"""}]
+## Logic Analysis: {todo_file_name}""", query=f"{todo_file_name} {todo_file_desc}",
+                           label=f"[ANALYZING] {todo_file_name}")
 
 
-def run_llm_evaluation_json(todo_file_name, analysis_text):
+async def run_llm_evaluation_json(todo_file_name, analysis_text, usage, iteration):
     """Original structured JSON evaluation (your existing code)."""
     eval_prompt = [
         {"role": "system", "content": "You are a reviewer checking the correctness and completeness of a logic analysis for a scientific implementation."},
@@ -229,20 +259,21 @@ Assign "severity_level" as follows:
 Respond only with the JSON."""}
     ]
     try:
-        eval_response = api_call(eval_prompt)
+        eval_response = await api_call(eval_prompt, usage, ("judge", todo_file_name, iteration))
         start = eval_response.find('{')
         end = eval_response.rfind('}') + 1
         result = json.loads(eval_response[start:end])
         # Tag source
         for c in result.get("critique_list", []):
             c["source"] = "llm-judge"
+        result["judge_response"] = eval_response
         return result
     except Exception as e:
         print(f"[EVAL ERROR] JSON parse failed for {todo_file_name}: {e}")
         return None
 
 
-def run_llm_evaluation_freetext(todo_file_name, analysis_text):
+async def run_llm_evaluation_freetext(todo_file_name, analysis_text, usage, iteration):
     """Free-text evaluation (for ablation comparison)."""
     eval_prompt = [
         {"role": "system", "content": "You are a reviewer checking the correctness and completeness of a logic analysis for a scientific implementation."},
@@ -261,7 +292,7 @@ Severity guide:
 Write your critique as plain text. Do NOT use JSON."""}
     ]
     try:
-        eval_response = api_call(eval_prompt)
+        eval_response = await api_call(eval_prompt, usage, ("judge", todo_file_name, iteration))
         # Parse free-text into critique-like dicts heuristically
         critiques = []
         text_lower = eval_response.lower()
@@ -282,7 +313,7 @@ Write your critique as plain text. Do NOT use JSON."""}
                 "source": "llm-judge-freetext",
             })
         # If we cannot parse severity, treat as no high-severity issues
-        return {"critique_list": critiques, "raw_freetext": eval_response}
+        return {"critique_list": critiques, "raw_freetext": eval_response, "judge_response": eval_response}
     except Exception as e:
         print(f"[EVAL ERROR] Free-text eval failed for {todo_file_name}: {e}")
         return None
@@ -290,7 +321,9 @@ Write your critique as plain text. Do NOT use JSON."""}
 
 def run_static_analysis(todo_file_name, repo_dir):
     """
-    Run ast_check + pylint_check + import_probe on the actual .py file.
+    Run ast_check + pylint + import_probe (+ exec_smoke_check with
+    --exec_smoke) on the actual .py file (cached by content through the
+    StaticAnalysisEngine).
     If the file does not exist yet (analysis phase generates specs, not code),
     we skip and return empty. For files that DO exist in repo_dir, we check them.
     """
@@ -301,32 +334,31 @@ def run_static_analysis(todo_file_name, repo_dir):
     if not os.path.exists(filepath):
         return []
 
-    c_ast = ast_check(filepath)
-    c_lint = pylint_check(filepath)
-    c_exec = import_probe(filepath, project_root=repo_dir)
-
-    return merge_critiques(c_ast, c_lint, c_exec)
+    return static_engine.check(filepath, project_root=repo_dir)
 
 
-def get_critiques(todo_file_name, analysis_text, mode, feedback_format, repo_dir):
+async def get_critiques(todo_file_name, analysis_text, mode, feedback_format, repo_dir, usage, iteration):
     """
     Run the appropriate feedback channels based on mode.
-    Returns (all_critiques_list, high_or_medium_list).
+    Returns (all_critiques_list, high_or_medium_list, raw judge reply or None).
     """
     llm_critiques = []
     static_critiques = []
+    judge_response = None
 
     if mode in ("llm_only", "multi_signal"):
         if feedback_format == "json":
-            result = run_llm_evaluation_json(todo_file_name, analysis_text)
+            result = await run_llm_evaluation_json(todo_file_name, analysis_text, usage, iteration)
         else:
-            result = run_llm_evaluation_freetext(todo_file_name, analysis_text)
+            result = await run_llm_evaluation_freetext(todo_file_name, analysis_text, usage, iteration)
 
         if result and isinstance(result, dict):
             llm_critiques = result.get("critique_list", [])
+            judge_response = result.get("judge_response")
 
     if mode in ("static_only", "multi_signal"):
-        static_critiques = run_static_analysis(todo_file_name, repo_dir)
+        # subprocess-based checks; keep them off the event loop
+        static_critiques = await asyncio.to_thread(run_static_analysis, todo_file_name, repo_dir)
 
     if mode == "multi_signal":
         all_critiques = merge_critiques(static_critiques, llm_critiques)
@@ -339,7 +371,7 @@ def get_critiques(todo_file_name, analysis_text, mode, feedback_format, repo_dir
               if isinstance(c, dict)
               and c.get("severity_level", "").lower() in ("high", "medium")]
 
-    return all_critiques, hi_med
+    return all_critiques, hi_med, judge_response
 
 
 # ---- Output directories ----
@@ -348,93 +380,286 @@ os.makedirs(artifact_output_dir, exist_ok=True)
 
 debug_output_dir = Path(output_dir) / "analyzing_artifacts" / "debug_revisions"
 debug_output_dir.mkdir(parents=True, exist_ok=True)
+if replay is not None and os.path.samefile(replay.debug_dir, debug_output_dir) \
+        and replay.tag == f"{mode}_{feedback_format}":
+    print("[ERROR] --replay_from would overwrite the recorded run; use another --output_dir.")
+    sys.exit(1)
 
-# ---- Per-iteration score log ----
-iteration_log = {}  # {file_name: [score_iter0, score_iter1, ...]}
+checkpoint_dir = Path(output_dir) / "analyzing_artifacts" / "checkpoints"
+checkpoint_dir.mkdir(parents=True, exist_ok=True)
 
-# ---- Main loop ----
-for todo_file_name in tqdm(todo_file_lst):
-    if todo_file_name == "config.yaml":
-        continue
 
-    print(f"\n[ANALYZING] {todo_file_name}  (mode={mode}, format={feedback_format})")
+def load_checkpoint(safe_name):
+    """Return the saved loop state for this file, or None when not resuming."""
+    path = checkpoint_dir / f"{safe_name}_{mode}_{feedback_format}.json"
+    if not resume or not path.exists():
+        return None
+    return json.loads(path.read_text(encoding="utf-8"))
 
-    file_msg = copy.deepcopy(analysis_msg)
-    file_msg.extend(get_write_msg(
-        todo_file_name,
-        logic_analysis_dict.get(todo_file_name, "")
-    ))
 
-    safe_name = todo_file_name.replace("/", "_")
-    per_iter_scores = []
+def load_history(safe_name, per_iter_scores):
+    """Stopping-policy history of the finished iterations, from their logs and saved critiques."""
+    history = []
+    for iter_log in per_iter_scores:
+        path = debug_output_dir / f"{safe_name}_rev{iter_log['iteration']}_{mode}_{feedback_format}_critiques.json"
+        critiques = json.loads(path.read_text(encoding="utf-8")).get("high_medium", []) if path.exists() else []
+        history.append({"critiques": critiques, "tokens": iter_log.get("tokens", 0)})
+    return history
 
-    for iteration in range(1, MAX_FEEDBACK_ITERATIONS + 1):
-        print(f"\n  Iteration {iteration}: generating analysis...")
-        analysis_text = api_call(file_msg)
 
-        # Save revision
-        (debug_output_dir / f"{safe_name}_rev{iteration}_{mode}_{feedback_format}.txt").write_text(
-            analysis_text, encoding="utf-8"
-        )
+def save_checkpoint(safe_name, state):
+    """Atomically persist the loop state so a crash never leaves a torn checkpoint."""
+    path = checkpoint_dir / f"{safe_name}_{mode}_{feedback_format}.json"
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(json.dumps(state, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp_path, path)
 
-        # Get critiques based on mode
-        all_crits, hi_med = get_critiques(
-            todo_file_name, analysis_text, mode, feedback_format, output_repo_dir
-        )
 
-        # Save critiques
-        (debug_output_dir / f"{safe_name}_rev{iteration}_{mode}_{feedback_format}_critiques.json").write_text(
-            json.dumps({"all": all_crits, "high_medium": hi_med}, indent=2, ensure_ascii=False),
+async def analyze_file(todo_file_name, semaphore, prefix_warmed, pbar, is_first=False):
+    """
+    Run the generate -> critique -> revise loop for one file.
+    Returns (per_iteration_scores, usage) so the caller can aggregate
+    token counts without sharing mutable state between files.
+
+    Other files send their first request only after the first file's has
+    returned (`prefix_warmed` is set), so they find the shared prompt prefix
+    already in the provider cache.
+    """
+    try:
+        return await _analyze_file(todo_file_name, semaphore, prefix_warmed, pbar, is_first)
+    finally:
+        if is_first:
+            prefix_warmed.set()
+
+
+async def _analyze_file(todo_file_name, semaphore, prefix_warmed, pbar, is_first):
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+
+    async with semaphore:
+        print(f"\n[ANALYZING] {todo_file_name}  (mode={mode}, format={feedback_format})")
+
+        safe_name = todo_file_name.replace("/", "_")
+        checkpoint = load_checkpoint(safe_name)
+
+        if checkpoint and checkpoint["done"]:
+            print(f"  [{todo_file_name}] Already analyzed (checkpoint). Skipping.")
+            pbar.update(1)
+            return checkpoint["per_iter_scores"], checkpoint["usage"]
+
+        base_msg = get_write_msg(todo_file_name, logic_analysis_dict.get(todo_file_name, ""))
+        if checkpoint:
+            # resume right after the last finished iteration (feedback already appended)
+            file_msg = checkpoint["file_msg"]
+            transcript_msg = checkpoint.get("transcript_msg", file_msg)
+            analysis_text = checkpoint.get("analysis_text", "")
+            per_iter_scores = checkpoint["per_iter_scores"]
+            usage = checkpoint["usage"]
+            first_iteration = checkpoint["iteration"] + 1
+            history = load_history(safe_name, per_iter_scores)
+            print(f"  [{todo_file_name}] Resuming at iteration {first_iteration}.")
+        else:
+            file_msg = base_msg
+            # what the transcript mode would send, kept to measure the patch mode's savings
+            transcript_msg = list(base_msg)
+            analysis_text = ""
+            per_iter_scores = []
+            history = []
+            first_iteration = 1
+
+        # a checkpoint of the last iteration resumes past the loop
+        iteration = first_iteration - 1
+        for iteration in range(first_iteration, MAX_FEEDBACK_ITERATIONS + 1):
+            if replay is not None and iteration > 1 and not replay.has(todo_file_name, iteration):
+                # the recorded run stopped here; nothing to serve for a further revision
+                per_iter_scores[-1]["stopped_by"] = "replay_end"
+                print(f"  [{todo_file_name}] Recorded run ends after iteration {iteration - 1}.")
+                break
+            print(f"\n  [{todo_file_name}] Iteration {iteration}: generating analysis...")
+            if not is_first:
+                await prefix_warmed.wait()
+            iter_prompt_tokens = usage["prompt_tokens"]
+            iter_completion_tokens = usage["completion_tokens"]
+            patch_reply = revision_mode == "patch" and iteration > 1
+            stream_path = debug_output_dir / (f"{safe_name}_rev{iteration}_{mode}_{feedback_format}"
+                                              f"{'_patch' if patch_reply else ''}.txt")
+            reply = await api_call(file_msg, usage, ("revision", todo_file_name, iteration), stream_path)
+            if is_first:
+                prefix_warmed.set()
+            generation_prompt_tokens = usage["prompt_tokens"] - iter_prompt_tokens
+
+            hunk_stats = None
+            if patch_reply:
+                (debug_output_dir / f"{safe_name}_rev{iteration}_{mode}_{feedback_format}_patch.txt").write_text(
+                    reply, encoding="utf-8"
+                )
+                hunks = parse_hunks(reply)
+                if hunks is None:
+                    # not a hunk document: take it as a full rewrite
+                    print(f"    [{todo_file_name}] Reply has no hunks; using it as the full revision.")
+                    analysis_text = reply
+                else:
+                    analysis_text, n_applied, failed = apply_hunks(analysis_text, hunks)
+                    hunk_stats = {"applied": n_applied, "failed": len(failed)}
+                    print(f"    [{todo_file_name}] Applied {n_applied}/{len(hunks)} hunks.")
+            else:
+                analysis_text = reply
+
+            # Save revision
+            (debug_output_dir / f"{safe_name}_rev{iteration}_{mode}_{feedback_format}.txt").write_text(
+                analysis_text, encoding="utf-8"
+            )
+
+            # Get critiques based on mode
+            all_crits, hi_med, judge_response = await get_critiques(
+                todo_file_name, analysis_text, mode, feedback_format, output_repo_dir, usage, iteration
+            )
+
+            # Save critiques (and the judge's raw reply, which --replay_from serves back)
+            recorded = {"all": all_crits, "high_medium": hi_med}
+            if judge_response is not None:
+                recorded["judge_response"] = judge_response
+            (debug_output_dir / f"{safe_name}_rev{iteration}_{mode}_{feedback_format}_critiques.json").write_text(
+                json.dumps(recorded, indent=2, ensure_ascii=False),
+                encoding="utf-8"
+            )
+
+            # Log per-iteration score (we use critique count as a proxy;
+            # for actual rubric scores, run eval.py after each iteration)
+            n_high = len([c for c in all_crits if c.get("severity_level", "").lower() == "high"])
+            n_med = len([c for c in all_crits if c.get("severity_level", "").lower() == "medium"])
+            n_low = len([c for c in all_crits if c.get("severity_level", "").lower() == "low"])
+            iter_log = {
+                "iteration": iteration,
+                "high": n_high,
+                "medium": n_med,
+                "low": n_low,
+                "total_critiques": len(all_crits),
+                "prompt_tokens": usage["prompt_tokens"] - iter_prompt_tokens,
+                "completion_tokens": usage["completion_tokens"] - iter_completion_tokens,
+                "generation_prompt_tokens": generation_prompt_tokens,
+            }
+            iter_log["tokens"] = iter_log["prompt_tokens"] + iter_log["completion_tokens"]
+            if revision_mode == "patch":
+                sent_est = estimate_request_tokens({"messages": file_msg})
+                transcript_est = estimate_request_tokens({"messages": transcript_msg})
+                iter_log["transcript_prompt_tokens_est"] = transcript_est
+                iter_log["prompt_tokens_saved_est"] = transcript_est - sent_est
+                if hunk_stats is not None:
+                    iter_log["hunks"] = hunk_stats
+            per_iter_scores.append(iter_log)
+            history.append({"critiques": hi_med, "tokens": iter_log["tokens"]})
+
+            print(f"    [{todo_file_name}] {len(all_crits)} total critiques, {len(hi_med)} high/medium")
+
+            stopped_by = stop_controller.check(history)
+            if stopped_by is not None:
+                iter_log["stopped_by"] = stopped_by
+                print(f"  [{todo_file_name}] Stopping after iteration {iteration} ({stopped_by}).")
+                break
+
+            # Append feedback for next iteration
+            transcript_msg = transcript_msg + [
+                {"role": "assistant", "content": analysis_text},
+                {
+                    "role": "user",
+                    "content": (
+                        f"The following critiques were raised for `{todo_file_name}`:\n\n"
+                        f"{json.dumps(hi_med, indent=2)}\n\n"
+                        "Please revise the analysis to address these critiques."
+                    )
+                },
+            ]
+            if revision_mode == "patch":
+                # only the current analysis and its open critiques
+                file_msg = base_msg + [
+                    {"role": "assistant", "content": analysis_text},
+                    {"role": "user", "content": patch_request(todo_file_name, hi_med)},
+                ]
+            else:
+                file_msg = transcript_msg
+            state = {
+                "done": False,
+                "iteration": iteration,
+                "file_msg": file_msg,
+                "analysis_text": analysis_text,
+                "per_iter_scores": per_iter_scores,
+                "usage": usage,
+            }
+            if revision_mode == "patch":
+                state["transcript_msg"] = transcript_msg
+            save_checkpoint(safe_name, state)
+
+        # Save final analysis (compatible with 3_coding.py)
+        artifact_path = Path(output_dir) / "analyzing_artifacts"
+        (artifact_path / f"{safe_name}_simple_analysis.txt").write_text(
+            analysis_text, encoding="utf-8"
+        )
+        (Path(output_dir) / f"{safe_name}_simple_analysis_response.json").write_text(
+            json.dumps([{"text": analysis_text}], ensure_ascii=False),
             encoding="utf-8"
         )
 
-        # Log per-iteration score (we use critique count as a proxy;
-        # for actual rubric scores, run eval.py after each iteration)
-        n_high = len([c for c in all_crits if c.get("severity_level", "").lower() == "high"])
-        n_med = len([c for c in all_crits if c.get("severity_level", "").lower() == "medium"])
-        n_low = len([c for c in all_crits if c.get("severity_level", "").lower() == "low"])
-        per_iter_scores.append({
+        save_checkpoint(safe_name, {
+            "done": True,
             "iteration": iteration,
-            "high": n_high,
-            "medium": n_med,
-            "low": n_low,
-            "total_critiques": len(all_crits),
+            "per_iter_scores": per_iter_scores,
+            "usage": usage,
         })
 
-        print(f"    {len(all_crits)} total critiques, {len(hi_med)} high/medium")
+        print(f"  Final analysis for {todo_file_name} saved.")
 
-        if not hi_med:
-            print("  No high/medium critiques. Stopping early.")
-            break
+    pbar.update(1)
+    return per_iter_scores, usage
 
-        if iteration == MAX_FEEDBACK_ITERATIONS:
-            print("  Max iterations reached.")
-            break
 
-        # Append feedback for next iteration
-        file_msg.append({"role": "assistant", "content": analysis_text})
-        file_msg.append({
-            "role": "user",
-            "content": (
-                f"The following critiques were raised for `{todo_file_name}`:\n\n"
-                f"{json.dumps(hi_med, indent=2)}\n\n"
-                "Please revise the analysis to address these critiques."
-            )
-        })
-
-    iteration_log[todo_file_name] = per_iter_scores
+async def analyze_all(file_lst):
+    """
+    Analyze every file with at most `concurrency` feedback loops in flight.
+    Tasks acquire the semaphore in list order, so concurrency=1 is the serial run.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    prefix_warmed = asyncio.Event()
+    with tqdm(total=len(file_lst)) as pbar:
+        return await asyncio.gather(*(analyze_file(f, semaphore, prefix_warmed, pbar, is_first=(idx == 0))
+                                      for idx, f in enumerate(file_lst)))
 
-    # Save final analysis (compatible with 3_coding.py)
-    artifact_path = Path(output_dir) / "analyzing_artifacts"
-    (artifact_path / f"{safe_name}_simple_analysis.txt").write_text(
-        analysis_text, encoding="utf-8"
-    )
-    (Path(output_dir) / f"{safe_name}_simple_analysis_response.json").write_text(
-        json.dumps([{"text": analysis_text}], ensure_ascii=False),
-        encoding="utf-8"
-    )
 
-    print(f"  Final analysis for {todo_file_name} saved.")
+# ---- Main loop ----
+analysis_file_lst = [f for f in todo_file_lst if f != "config.yaml"]
+
+static_engine = None
+if mode in ("static_only", "multi_signal"):
+    # check every repo file up front, in parallel; the feedback loops then read the cache
+    smoke_config = None
+    if args.exec_smoke:
+        smoke_config = os.path.join(output_repo_dir, "config.yaml")
+        if not os.path.exists(smoke_config):
+            smoke_config = f'{output_dir}/planning_config.yaml'
+        if not os.path.exists(smoke_config):
+            print(f"[STATIC] exec-smoke skipped: no config.yaml in {output_repo_dir} and no {smoke_config}")
+            smoke_config = None
+    static_engine = StaticAnalysisEngine(args.static_workers or None, args.static_cache_dir or None,
+                                         None if args.probe_preload == "none" else args.probe_preload,
+                                         args.probe_memory_mb, smoke_config)
+    if output_repo_dir:
+        static_engine.check_many([os.path.join(output_repo_dir, f) for f in analysis_file_lst
+                                  if os.path.exists(os.path.join(output_repo_dir, f))], project_root=output_repo_dir)
+
+results = asyncio.run(analyze_all(analysis_file_lst))
+if static_engine is not None:
+    static_engine.close()
+    print(f"[STATIC] {static_engine.misses} files checked, {static_engine.hits} results served from cache")
+
+# ---- Aggregate per-file logs and token counts (in task-list order) ----
+iteration_log = {}  # {file_name: [score_iter0, score_iter1, ...]}
+total_prompt_tokens = 0
+total_completion_tokens = 0
+total_cached_tokens = 0
+for todo_file_name, (per_iter_scores, usage) in zip(analysis_file_lst, results):
+    iteration_log[todo_file_name] = per_iter_scores
+    total_prompt_tokens += usage["prompt_tokens"]
+    total_completion_tokens += usage["completion_tokens"]
+    total_cached_tokens += usage.get("cached_tokens", 0)
 
 
 # ---- Save experiment summary ----
@@ -443,14 +668,24 @@ summary = {
     "mode": mode,
     "feedback_format": feedback_format,
     "max_iterations": MAX_FEEDBACK_ITERATIONS,
+    "stop_policy": stop_controller.spec,
+    "revision_mode": revision_mode,
+    "replay_from": args.replay_from or None,
     "total_prompt_tokens": total_prompt_tokens,
     "total_completion_tokens": total_completion_tokens,
     "total_tokens": total_prompt_tokens + total_completion_tokens,
     "per_file_iterations": iteration_log,
+    "stopped_by": {fn: scores[-1].get("stopped_by") for fn, scores in iteration_log.items() if scores},
 }
 
 summary_path = Path(output_dir) / f"experiment_summary_{mode}_{feedback_format}.json"
 summary_path.write_text(json.dumps(summary, indent=2, ensure_ascii=False), encoding="utf-8")
+record_prompt_cache_stats(output_dir, "analyzing", prompt_cache_stats(total_prompt_tokens, total_cached_tokens),
+                          summary_path)
+
+if cache is not None:
+    cache.write_stats(output_dir, f"[ANALYZING] mode={mode}, format={feedback_format}")
+get_executor().write_stats(output_dir, f"[ANALYZING] mode={mode}, format={feedback_format}")
 
 print("\n" + "=" * 60)
 print(f"EXPERIMENT COMPLETE: mode={mode}, format={feedback_format}")
@@ -1,11 +1,13 @@
 import json
 import os
 from tqdm import tqdm
-from utils import extract_planning, content_to_json, print_response
+from utils import print_response, add_api_args, load_response_cache
+from context_budget import ContextBudgeter, fit_paper_in_messages, LOCAL_RESERVE_OUTPUT
 import copy
 import sys
-from transformers import AutoTokenizer
-from vllm import LLM, SamplingParams
+from backends import add_backend_args, get_backend, ThroughputMeter
+from prompts import PromptLayout, render_shared_context, record_prompt_cache_stats
+from planning_context import load_planning_context
 
 import argparse
 
@@ -14,15 +16,16 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--paper_name',type=str)
 
 parser.add_argument('--model_name',type=str, default="deepseek-ai/DeepSeek-Coder-V2-Lite-Instruct") 
-parser.add_argument('--tp_size',type=int, default=2)
-parser.add_argument('--temperature',type=float, default=1.0)
-parser.add_argument('--max_model_len',type=int, default=128000)
+add_backend_args(parser, default="vllm")
+add_api_args(parser)
 
 parser.add_argument('--paper_format',type=str, default="JSON", choices=["JSON", "LaTeX"])
 parser.add_argument('--pdf_json_path', type=str) # json format
 parser.add_argument('--pdf_latex_path', type=str) # latex format
 
 parser.add_argument('--output_dir',type=str, default="")
+parser.add_argument('--serial', action="store_true",
+                    help="One generate call per file instead of one for all files")
 
 args    = parser.parse_args()
 
@@ -49,42 +52,18 @@ else:
     print(f"[ERROR] Invalid paper format. Please select either 'JSON' or 'LaTeX.")
     sys.exit(0)
 
-with open(f'{output_dir}/planning_config.yaml') as f: 
-    config_yaml = f.read()
-
-context_lst = extract_planning(f'{output_dir}/planning_trajectories.json')
-
-# 0: overview, 1: detailed, 2: PRD
-if os.path.exists(f'{output_dir}/task_list.json'):
-    with open(f'{output_dir}/task_list.json') as f:
-        task_list = json.load(f)
-else:
-    task_list = content_to_json(context_lst[2])
-
-if 'Task list' in task_list:
-    todo_file_lst = task_list['Task list']
-elif 'task_list' in task_list:
-    todo_file_lst = task_list['task_list']
-elif 'task list' in task_list:
-    todo_file_lst = task_list['task list']
-else:
-    print(f"[ERROR] 'Task list' does not exist. Please re-generate the planning.")
+try:
+    planning = load_planning_context(output_dir, paper_content)
+except ValueError as e:
+    print(f"[ERROR] {e}. Please re-generate the planning.")
     sys.exit(0)
 
-if 'Logic Analysis' in task_list:
-    logic_analysis = task_list['Logic Analysis']
-elif 'logic_analysis' in task_list:
-    logic_analysis = task_list['logic_analysis']
-elif 'logic analysis' in task_list:
-    logic_analysis = task_list['logic analysis']
-else:
-    print(f"[ERROR] 'Logic Analysis' does not exist. Please re-generate the planning.")
-    sys.exit(0)
+config_yaml = planning.config_yaml
+context_lst = planning.context_lst
+todo_file_lst = planning.todo_file_lst
+logic_analysis_dict = planning.logic_analysis_dict
 
 done_file_lst = ['config.yaml']
-logic_analysis_dict = {}
-for desc in logic_analysis:
-    logic_analysis_dict[desc[0]] = desc[1]
 
 analysis_msg = [
     {"role": "system", "content": f"""You are an expert researcher, strategic analyzer and software engineer with a deep understanding of experimental design and reproducibility in scientific research.
@@ -107,33 +86,7 @@ def get_write_msg(todo_file_name, todo_file_desc):
     if len(todo_file_desc.strip()) == 0:
         draft_desc = f"Write the logic analysis in '{todo_file_name}'."
 
-    write_msg=[{'role': 'user', "content": f"""## Paper
-{paper_content}
-
------
-
-## Overview of the plan
-{context_lst[0]}
-
------
-
-## Design
-{context_lst[1]}
-
------
-
-## Task
-{context_lst[2]}
-
------
-
-## Configuration file
-```yaml
-{config_yaml}
-```
------
-
-## Instruction
+    instruction = f"""## Instruction
 Conduct a Logic Analysis to assist in writing the code, based on the paper, the plan, the design, the task and the previously specified configuration file (config.yaml). 
 You DON'T need to provide the actual code yet; focus on a thorough, clear analysis.
 
@@ -141,63 +94,66 @@ You DON'T need to provide the actual code yet; focus on a thorough, clear analys
 
 -----
 
-## Logic Analysis: {todo_file_name}"""}]
-    return write_msg
-
-
-
-model_name = args.model_name
-tokenizer = AutoTokenizer.from_pretrained(model_name)
+## Logic Analysis: {todo_file_name}"""
+    if layout is not None:
+        # the whole conversation, shared context first (see prompts.py)
+        return layout.messages(analysis_msg[0]['content'], instruction, query=f"{todo_file_name} {todo_file_desc}",
+                               label=f"[ANALYSIS] {todo_file_name}")
 
+    # the shared context without its "# Context" header, followed by the instruction
+    write_msg=[{'role': 'user', "content": render_shared_context(paper_content, context_lst, config_yaml).split("\n", 1)[1]
+                + "\n" + instruction}]
+    return write_msg
 
-if "Qwen" in model_name:
-    llm = LLM(model=model_name, 
-            tensor_parallel_size=tp_size, 
-            max_model_len=max_model_len,
-            gpu_memory_utilization=0.95,
-            trust_remote_code=True, enforce_eager=True, 
-            rope_scaling={"factor": 4.0, "original_max_position_embeddings": 32768, "type": "yarn"})
-    sampling_params = SamplingParams(temperature=temperature, max_tokens=131072)
 
-elif "deepseek" in model_name:
-    llm = LLM(model=model_name, 
-              tensor_parallel_size=tp_size, 
-              max_model_len=max_model_len,
-              gpu_memory_utilization=0.95,
-              trust_remote_code=True, enforce_eager=True)
-    sampling_params = SamplingParams(temperature=temperature, max_tokens=128000, stop_token_ids=[tokenizer.eos_token_id])
 
-def run_llm(msg):
-    # vllm
-    prompt_token_ids = [tokenizer.apply_chat_template(messages, add_generation_prompt=True) for messages in [msg]]
+cache = load_response_cache(args)
+backend = get_backend(args, model_name, cache)
+meter = ThroughputMeter()
+# every prompt contains the planning context: the vllm backend tokenizes it once (chat_encoding.py)
+backend.share_prefix(render_shared_context(paper_content, context_lst, config_yaml).split("\n", 1)[1])
 
-    outputs = llm.generate(prompt_token_ids=prompt_token_ids, sampling_params=sampling_params)
 
-    completion = [output.outputs[0].text for output in outputs]
-    
-    return completion[0]
+def run_llm_batch(msgs):
+    return meter.complete_texts(backend, msgs)
 
 artifact_output_dir=f'{output_dir}/analyzing_artifacts'
 os.makedirs(artifact_output_dir, exist_ok=True)
 
-for todo_file_name in tqdm(todo_file_lst):
-    responses = []
-    trajectories = copy.deepcopy(analysis_msg)
+budgeter = ContextBudgeter(model_name, output_dir, max_model_len, LOCAL_RESERVE_OUTPUT)
+# --prefix_caching: every prompt of this stage and of coding starts with the same shared context
+layout = PromptLayout(paper_content, context_lst, config_yaml, budgeter) if args.prefix_caching else None
 
+# the per-file analyses are independent: build every prompt first and generate them together
+trajectories_dict = {}
+for todo_file_name in todo_file_lst:
     current_stage=f"[ANALYSIS] {todo_file_name}"
     print(current_stage)
     if todo_file_name == "config.yaml":
         continue
-    
+
     if todo_file_name not in logic_analysis_dict:
         # print(f"[DEBUG ANALYSIS] {paper_name} {todo_file_name} is not exist in the logic analysis")
         logic_analysis_dict[todo_file_name] = ""
-        
-    instruction_msg = get_write_msg(todo_file_name, logic_analysis_dict[todo_file_name])
-    trajectories.extend(instruction_msg)
-        
-    completion = run_llm(trajectories)
-    
+
+    if layout is not None:
+        trajectories = get_write_msg(todo_file_name, logic_analysis_dict[todo_file_name])
+    else:
+        trajectories = copy.deepcopy(analysis_msg)
+        instruction_msg = get_write_msg(todo_file_name, logic_analysis_dict[todo_file_name])
+        trajectories.extend(instruction_msg)
+        fit_paper_in_messages(budgeter, paper_content, trajectories,
+                              f"{todo_file_name} {logic_analysis_dict[todo_file_name]}", current_stage)
+    trajectories_dict[todo_file_name] = trajectories
+
+if args.serial:
+    completions = [run_llm_batch([trajectories])[0] for trajectories in tqdm(trajectories_dict.values())]
+else:
+    completions = run_llm_batch(list(trajectories_dict.values()))
+
+for (todo_file_name, trajectories), completion in zip(trajectories_dict.items(), completions):
+    responses = []
+
     # response
     completion_json = {
         'text': completion
@@ -225,3 +181,7 @@ for todo_file_name in tqdm(todo_file_lst):
 
     with open(f'{output_dir}/{todo_file_name}_simple_analysis_trajectories.json', 'w', encoding='utf-8') as f:
         json.dump(trajectories, f)
+
+meter.write_stats(output_dir, "[ANALYSIS]")
+if args.prefix_caching:
+    record_prompt_cache_stats(output_dir, "analyzing", meter.prefix_cache_stats())
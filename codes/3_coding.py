@@ -1,11 +1,20 @@
-from openai import OpenAI
+import asyncio
 import json
 import os
 from tqdm import tqdm
 import re
 import sys
-import copy
-from utils import extract_planning, content_to_json, extract_code_from_content, print_response, print_log_cost, load_accumulated_cost, save_accumulated_cost
+import time
+from utils import extract_code_from_content, print_response, print_log_cost, load_accumulated_cost, save_accumulated_cost, \
+        add_api_args, add_batch_args, load_response_cache, BatchQueue, BatchDeferred, DEFAULT_CACHE_DIR, \
+        get_executor, fenced_code_so_far, IncrementalWriter
+from context_budget import ContextBudgeter, add_budget_args, count_tokens
+from backends import add_backend_args, get_backend, context_window
+from retrieval import SectionIndex
+from code_context import build_code_context
+from coding_dag import build_coding_dag, topological_waves
+from prompts import PromptLayout, prompt_cache_stats, cached_tokens_of, record_prompt_cache_stats
+from planning_context import load_planning_context
 import argparse
 
 parser = argparse.ArgumentParser()
@@ -17,9 +26,27 @@ parser.add_argument('--pdf_json_path', type=str) # json format
 parser.add_argument('--pdf_latex_path', type=str) # latex format
 parser.add_argument('--output_dir',type=str, default="")
 parser.add_argument('--output_repo_dir',type=str, default="")
+parser.add_argument('--resume', action="store_true") # skip files already written by a previous (crashed) run
+add_api_args(parser)
+add_batch_args(parser)
+add_budget_args(parser)
+add_backend_args(parser)
+parser.add_argument('--retrieval_top_k', type=int, default=0,
+                    help="Send only the k paper sections most relevant to each file (0 = whole paper)")
+parser.add_argument('--retrieval_index_dir', type=str, default=os.path.join(DEFAULT_CACHE_DIR, "retrieval"))
+parser.add_argument('--retrieval_embed_model', type=str, default="",
+                    help="Optional sentence-transformers model mixed into the BM25 ranking")
+parser.add_argument('--code_context', type=str, default="full", choices=["full", "deps"],
+                    help="full: every written file verbatim; deps: direct dependencies verbatim, signature stubs for the rest")
+parser.add_argument('--max_parallel', type=int, default=1,
+                    help="Files generated concurrently per dependency wave (1 = serial, in Task list order)")
+parser.add_argument('--stream', action="store_true",
+                    help="Stream replies into the artifact and repo file as they arrive; stop at the closing fence")
 
 args    = parser.parse_args()
-client = OpenAI(api_key = os.environ["OPENAI_API_KEY"])
+cache = load_response_cache(args)
+backend = get_backend(args, args.gpt_version, cache)
+batch = BatchQueue(args.batch_dir, args.output_dir, "[CODING]", resume_flag="--resume") if args.batch else None
 
 paper_name = args.paper_name
 gpt_version = args.gpt_version
@@ -28,6 +55,7 @@ pdf_json_path = args.pdf_json_path
 pdf_latex_path = args.pdf_latex_path
 output_dir = args.output_dir
 output_repo_dir = args.output_repo_dir
+max_parallel = max(1, args.max_parallel)
 
 if paper_format == "JSON":
     with open(f'{pdf_json_path}') as f:
@@ -39,28 +67,33 @@ else:
     print(f"[ERROR] Invalid paper format. Please select either 'JSON' or 'LaTeX.")
     sys.exit(0)
 
-with open(f'{output_dir}/planning_config.yaml') as f: 
-    config_yaml = f.read()
+try:
+    planning = load_planning_context(output_dir, paper_content)
+except ValueError as e:
+    print(f"[ERROR] {e}. Please re-generate the planning.")
+    sys.exit(0)
 
-context_lst = extract_planning(f'{output_dir}/planning_trajectories.json')
-# 0: overview, 1: detailed, 2: PRD
-# file_list = content_to_json(context_lst[1])
-task_list = content_to_json(context_lst[2])
+config_yaml = planning.config_yaml
+context_lst = planning.context_lst
+todo_file_lst = planning.todo_file_lst
 
-todo_file_lst = task_list['Task list']
 done_file_lst = ['config.yaml']
 done_file_dict = {}
 
-code_msg = [
-    {"role": "system", "content": f"""You are an expert researcher and software engineer with a deep understanding of experimental design and reproducibility in scientific research.
+# the stage prompt follows the shared planning context (see prompts.py)
+layout = PromptLayout(paper_content, context_lst, config_yaml,
+                      ContextBudgeter(gpt_version, output_dir, context_window(args)))
+prompt_cache_usage = {"prompt_tokens": 0, "cached_tokens": 0}
+
+coding_prompt = f"""You are an expert researcher and software engineer with a deep understanding of experimental design and reproducibility in scientific research.
 You will receive a research paper in {paper_format} format, an overview of the plan, a Design in JSON format consisting of "Implementation approach", "File list", "Data structures and interfaces", and "Program call flow", followed by a Task in JSON format that includes "Required packages", "Required other language third-party packages", "Logic Analysis", and "Task list", along with a configuration file named "config.yaml". 
 Your task is to write code to reproduce the experiments and methodologies described in the paper. 
 
 The code you write must be elegant, modular, and maintainable, adhering to Google-style guidelines. 
 The code must strictly align with the paper's methodology, experimental setup, and evaluation metrics. 
-Write code with triple quoto."""}]
+Write code with triple quoto."""
 
-def get_write_msg(todo_file_name, detailed_logic_analysis, done_file_lst): 
+def all_code_files(done_file_lst):
     code_files = ""
     for done_file in done_file_lst:
         if done_file.endswith(".yaml"): continue
@@ -70,36 +103,23 @@ def get_write_msg(todo_file_name, detailed_logic_analysis, done_file_lst):
 ```
 
 """
+    return code_files
 
-    write_msg=[
-{'role': 'user', "content": f"""# Context
-## Paper
-{paper_content}
-
------
-
-## Overview of the plan
-{context_lst[0]}
-
------
-
-## Design
-{context_lst[1]}
-
------
-
-## Task
-{context_lst[2]}
-
------
-
-## Configuration file
-```yaml
-{config_yaml}
-```
------
 
-## Code Files
+def get_write_msg(todo_file_name, detailed_logic_analysis, done_file_lst): 
+    code_files = all_code_files(done_file_lst)
+    if args.code_context == "deps":
+        full_tokens = count_tokens(code_files)
+        code_files, info = build_code_context(todo_file_name, detailed_logic_analysis, done_file_lst, done_file_dict)
+        sent_tokens = count_tokens(code_files)
+        info.update({"file": todo_file_name, "full_tokens": full_tokens, "sent_tokens": sent_tokens,
+                     "saved_tokens": full_tokens - sent_tokens})
+        with open(f'{artifact_output_dir}/code_context.log', 'a', encoding='utf-8') as f:
+            f.write(json.dumps(info) + "\n")
+        print(f"[CODE CONTEXT] {todo_file_name}: {len(info['full'])} files in full, {len(info['stubbed'])} as stubs "
+              f"({full_tokens:,} -> {sent_tokens:,} tokens)")
+
+    return layout.messages(coding_prompt, f"""## Code Files
 {code_files}
 
 -----
@@ -129,23 +149,27 @@ Next, you must write only the "{todo_file_name}".
 
 {detailed_logic_analysis}
 
-## Code: {todo_file_name}"""}]
-    return write_msg
+## Code: {todo_file_name}""", query=f"{todo_file_name} {detailed_logic_analysis}",
+                           label=f"[CODING] {todo_file_name}",
+                           paper_content=retrieved_section_dict.get(todo_file_name))
 
 
-def api_call(msg):
+def api_call(msg, todo_file_name=None):
     if "o3-mini" in gpt_version:
-        completion = client.chat.completions.create(
-            model=gpt_version, 
-            reasoning_effort="high",
-            messages=msg
-        )
+        request_json = {"model": gpt_version, "reasoning_effort": "high", "messages": msg}
     else:
-        completion = client.chat.completions.create(
-            model=gpt_version, 
-            messages=msg
-        )
-    return completion
+        request_json = {"model": gpt_version, "messages": msg}
+    if args.stream and batch is None and todo_file_name is not None:
+        # the artifact and the repo file grow as tokens arrive; stop at the code block's closing fence
+        artifact = IncrementalWriter(f'{artifact_output_dir}/{todo_file_name.replace("/", "_")}_coding.txt')
+        repo_file = IncrementalWriter(f"{output_repo_dir}/{todo_file_name}")
+
+        def on_text(content):
+            artifact.update(content)
+            repo_file.update(fenced_code_so_far(content)[0])
+
+        return backend.stream(request_json, on_text, stop_when=lambda content: fenced_code_so_far(content)[1])
+    return backend.complete(request_json, batch)
     
 
 # testing for checking
@@ -172,31 +196,42 @@ for todo_file_name in todo_file_lst:
 artifact_output_dir=f'{output_dir}/coding_artifacts'
 os.makedirs(artifact_output_dir, exist_ok=True)
 
+# per-file paper subsets from the section index
+if args.retrieval_top_k > 0:
+    paper_path = pdf_json_path if paper_format == "JSON" else pdf_latex_path
+    section_index = SectionIndex.load_or_build(paper_path, paper_content, args.retrieval_index_dir,
+                                               args.retrieval_embed_model)
+    retrieval_log = {}
+    for todo_file_name, detailed_logic_analysis in detailed_logic_analysis_dict.items():
+        retrieved_section_dict[todo_file_name], retrieval_log[todo_file_name] = section_index.retrieve(
+            paper_content, f"{todo_file_name}\n{detailed_logic_analysis}", args.retrieval_top_k)
+    with open(f'{artifact_output_dir}/retrieved_sections.json', 'w', encoding='utf-8') as f:
+        json.dump(retrieval_log, f, indent=2, ensure_ascii=False)
+
+# progress checkpoint: files finished so far + the running cost
+progress_path = f'{artifact_output_dir}/coding_progress.json'
+resumed_file_set = set()
 total_accumulated_cost = load_accumulated_cost(f"{output_dir}/accumulated_cost.json")
-for todo_idx, todo_file_name in enumerate(tqdm(todo_file_lst)):
-    responses = []
-    trajectories = copy.deepcopy(code_msg)
-
+if args.resume and os.path.exists(progress_path):
+    with open(progress_path) as f:
+        progress = json.load(f)
+    resumed_file_set = {fn for fn in progress['done_file_lst'] if os.path.exists(f"{output_repo_dir}/{fn}")}
+    if not args.batch:
+        # batch_api.py adds the batch cost to accumulated_cost.json after the checkpoint was written
+        total_accumulated_cost = progress['total_accumulated_cost']
+
+def save_file(todo_file_name, completion):
+    """Logs one finished file and writes it to the repo (in the main thread, in Task list order)."""
+    global total_accumulated_cost
     current_stage = f"[CODING] {todo_file_name}"
-    print(current_stage)
-
-    if todo_file_name == "config.yaml":
-        continue
 
-    instruction_msg = get_write_msg(todo_file_name, detailed_logic_analysis_dict[todo_file_name], done_file_lst)
-    trajectories.extend(instruction_msg)
-
-    completion = api_call(trajectories)
-    # print(completion.choices[0].message)
-    
     # response
     completion_json = json.loads(completion.model_dump_json())
-    responses.append(completion_json)
+    if completion.usage:
+        prompt_cache_usage["prompt_tokens"] += completion.usage.prompt_tokens
+        prompt_cache_usage["cached_tokens"] += cached_tokens_of(completion)
 
-    # trajectories
     message = completion.choices[0].message
-    trajectories.append({'role': message.role, 'content': message.content})
-
     done_file_lst.append(todo_file_name)
 
     # save
@@ -206,6 +241,7 @@ for todo_idx, todo_file_name in enumerate(tqdm(todo_file_lst)):
 
 
     # print and logging
+    print(current_stage)
     print_response(completion_json)
     temp_total_accumulated_cost = print_log_cost(completion_json, gpt_version, current_stage, output_dir, total_accumulated_cost)
     total_accumulated_cost = temp_total_accumulated_cost
@@ -228,4 +264,74 @@ for todo_idx, todo_file_name in enumerate(tqdm(todo_file_lst)):
     with open(f"{output_repo_dir}/{todo_file_name}", 'w', encoding='utf-8') as f:
         f.write(code)
 
+    with open(progress_path, 'w', encoding='utf-8') as f:
+        json.dump({'done_file_lst': done_file_lst[1:], 'total_accumulated_cost': total_accumulated_cost}, f)
+
+
+async def code_wave(wave):
+    """
+    Generates the files of one wave concurrently (at most --max_parallel requests
+    in flight). Every prompt sees the files done before the wave.
+    Returns {file: completion, or None if it was queued for the Batch API}.
+    """
+    semaphore = asyncio.Semaphore(max_parallel)
+    wave_done_file_lst = list(done_file_lst)
+    instruction_msgs = {fn: get_write_msg(fn, detailed_logic_analysis_dict[fn], wave_done_file_lst) for fn in wave}
+
+    async def generate(todo_file_name):
+        async with semaphore:
+            try:
+                return await asyncio.to_thread(api_call, instruction_msgs[todo_file_name], todo_file_name)
+            except BatchDeferred:
+                return None
+
+    completions = await asyncio.gather(*(generate(fn) for fn in wave))
+    return dict(zip(wave, completions))
+
+
+# files written in the same wave only depend on earlier waves (see coding_dag.py)
+coding_file_lst = [fn for fn in todo_file_lst if fn != "config.yaml"]
+if max_parallel > 1:
+    coding_dag = build_coding_dag(coding_file_lst, planning.logic_analysis_dict,
+                                  planning.design.get('Data structures and interfaces', ''))
+    waves = topological_waves(coding_file_lst, coding_dag)
+    with open(f'{artifact_output_dir}/coding_waves.json', 'w', encoding='utf-8') as f:
+        json.dump({"waves": waves, "deps": {fn: sorted(deps) for fn, deps in coding_dag.items()}}, f, indent=2)
+    print(f"[SCHEDULE] {len(coding_file_lst)} files in {len(waves)} waves (max_parallel={max_parallel})")
+else:
+    waves = [[fn] for fn in coding_file_lst]
+
+pbar = tqdm(total=len(coding_file_lst))
+for wave in waves:
+    for todo_file_name in [fn for fn in wave if fn in resumed_file_set]:
+        print(f"[RESUME] {todo_file_name} already written. Skipping.")
+        with open(f"{output_repo_dir}/{todo_file_name}", encoding='utf-8') as f:
+            done_file_dict[todo_file_name] = f.read()
+        done_file_lst.append(todo_file_name)
+        pbar.update(1)
+
+    todo_wave = [fn for fn in wave if fn not in resumed_file_set]
+    if not todo_wave:
+        continue
+    wave_start = time.time()
+    completions = asyncio.run(code_wave(todo_wave))
+    for todo_file_name in todo_wave:
+        if completions[todo_file_name] is not None:
+            save_file(todo_file_name, completions[todo_file_name])
+            pbar.update(1)
+    if len(todo_wave) > 1:
+        print(f"[SCHEDULE] wave {todo_wave} done in {time.time() - wave_start:.1f}s")
+
+    deferred = [fn for fn in todo_wave if completions[fn] is None]
+    if deferred:
+        # later waves need these files in their prompts; continue after the batch completes
+        print(f"[BATCH] {', '.join(deferred)} queued in {args.batch_dir}. Run batch_api.py to continue.")
+        break
+pbar.close()
+
 save_accumulated_cost(f"{output_dir}/accumulated_cost.json", total_accumulated_cost)
+record_prompt_cache_stats(output_dir, "coding",
+                          prompt_cache_stats(prompt_cache_usage["prompt_tokens"], prompt_cache_usage["cached_tokens"]))
+if cache is not None:
+    cache.write_stats(output_dir, "[CODING]")
+get_executor().write_stats(output_dir, "[CODING]")
@@ -3,9 +3,13 @@ import os
 from tqdm import tqdm
 import sys
 import copy
-from utils import extract_planning, content_to_json, extract_code_from_content,extract_code_from_content2, print_response, print_log_cost, load_accumulated_cost, save_accumulated_cost
-from transformers import AutoTokenizer
-from vllm import LLM, SamplingParams
+from utils import extract_code_from_content,extract_code_from_content2, print_response, print_log_cost, load_accumulated_cost, save_accumulated_cost, \
+    add_api_args, load_response_cache
+from context_budget import ContextBudgeter, fit_paper_in_messages, LOCAL_RESERVE_OUTPUT
+from backends import add_backend_args, get_backend, ThroughputMeter
+from prompts import PromptLayout, render_shared_context, record_prompt_cache_stats
+from planning_context import load_planning_context
+from coding_dag import build_coding_dag, topological_waves
 
 import argparse
 
@@ -14,9 +18,8 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--paper_name',type=str)
 
 parser.add_argument('--model_name',type=str, default="deepseek-ai/DeepSeek-Coder-V2-Lite-Instruct") 
-parser.add_argument('--tp_size',type=int, default=2)
-parser.add_argument('--temperature',type=float, default=1.0)
-parser.add_argument('--max_model_len',type=int, default=128000)
+add_backend_args(parser, default="vllm")
+add_api_args(parser)
 
 parser.add_argument('--paper_format',type=str, default="JSON", choices=["JSON", "LaTeX"])
 parser.add_argument('--pdf_json_path', type=str) # json format
@@ -24,6 +27,8 @@ parser.add_argument('--pdf_latex_path', type=str) # latex format
 
 parser.add_argument('--output_dir',type=str, default="")
 parser.add_argument('--output_repo_dir',type=str, default="")
+parser.add_argument('--serial', action="store_true",
+                    help="One generate call per file, each seeing every earlier file, instead of one per dependency wave")
 
 args    = parser.parse_args()
 
@@ -52,24 +57,16 @@ else:
     print(f"[ERROR] Invalid paper format. Please select either 'JSON' or 'LaTeX.")
     sys.exit(0)
 
-with open(f'{output_dir}/planning_config.yaml') as f: 
-    config_yaml = f.read()
-
-context_lst = extract_planning(f'{output_dir}/planning_trajectories.json')
-# 0: overview, 1: detailed, 2: PRD
-# file_list = content_to_json(context_lst[1])
-task_list = content_to_json(context_lst[2])
-
-if 'Task list' in task_list:
-    todo_file_lst = task_list['Task list']
-elif 'task_list' in task_list:
-    todo_file_lst = task_list['task_list']
-elif 'task list' in task_list:
-    todo_file_lst = task_list['task list']
-else:
-    print(f"[ERROR] 'Task list' does not exist. Please re-generate the planning.")
+try:
+    planning = load_planning_context(output_dir, paper_content)
+except ValueError as e:
+    print(f"[ERROR] {e}. Please re-generate the planning.")
     sys.exit(0)
 
+config_yaml = planning.config_yaml
+context_lst = planning.context_lst
+todo_file_lst = planning.todo_file_lst
+
 done_file_lst = ['config.yaml']
 done_file_dict = {}
 
@@ -93,35 +90,7 @@ def get_write_msg(todo_file_name, detailed_logic_analysis, done_file_lst):
 
 """
 
-    write_msg=[
-{'role': 'user', "content": f"""# Context
-## Paper
-{paper_content}
-
------
-
-## Overview of the plan
-{context_lst[0]}
-
------
-
-## Design
-{context_lst[1]}
-
------
-
-## Task
-{context_lst[2]}
-
------
-
-## Configuration file
-```yaml
-{config_yaml}
-```
------
-
-## Code Files
+    instruction = f"""## Code Files
 {code_files}
 
 -----
@@ -151,40 +120,25 @@ Next, you must write only the "{todo_file_name}".
 
 {detailed_logic_analysis}
 
-## Code: {todo_file_name}"""}]
-    return write_msg
-
-model_name = args.model_name
-tokenizer = AutoTokenizer.from_pretrained(model_name)
-
-
-if "Qwen" in model_name:
-    llm = LLM(model=model_name, 
-            tensor_parallel_size=tp_size, 
-            max_model_len=max_model_len,
-            gpu_memory_utilization=0.95,
-            trust_remote_code=True, enforce_eager=True, 
-            rope_scaling={"factor": 4.0, "original_max_position_embeddings": 32768, "type": "yarn"})
-    sampling_params = SamplingParams(temperature=temperature, max_tokens=131072)
-
-elif "deepseek" in model_name:
-    llm = LLM(model=model_name, 
-              tensor_parallel_size=tp_size, 
-              max_model_len=max_model_len,
-              gpu_memory_utilization=0.95,
-              trust_remote_code=True, enforce_eager=True)
-    sampling_params = SamplingParams(temperature=temperature, max_tokens=128000, stop_token_ids=[tokenizer.eos_token_id])
+## Code: {todo_file_name}"""
+    if layout is not None:
+        # the whole conversation, shared context first (see prompts.py)
+        return layout.messages(code_msg[0]['content'], instruction, query=f"{todo_file_name} {detailed_logic_analysis}",
+                               label=f"[CODING] {todo_file_name}")
 
+    write_msg=[
+{'role': 'user', "content": render_shared_context(paper_content, context_lst, config_yaml) + "\n" + instruction}]
+    return write_msg
 
-def run_llm(msg):
-    # vllm
-    prompt_token_ids = [tokenizer.apply_chat_template(messages, add_generation_prompt=True) for messages in [msg]]
+cache = load_response_cache(args)
+backend = get_backend(args, model_name, cache)
+meter = ThroughputMeter()
+# every prompt contains the planning context: the vllm backend tokenizes it once (chat_encoding.py)
+backend.share_prefix(render_shared_context(paper_content, context_lst, config_yaml).split("\n", 1)[1])
 
-    outputs = llm.generate(prompt_token_ids=prompt_token_ids, sampling_params=sampling_params)
 
-    completion = [output.outputs[0].text for output in outputs]
-    
-    return completion[0] 
+def run_llm_batch(msgs):
+    return meter.complete_texts(backend, msgs)
     
 
 # testing for checking
@@ -197,29 +151,22 @@ for todo_file_name in todo_file_lst:
     if todo_file_name == "config.yaml":
         continue
 
-    with open(f"{output_dir}/{save_todo_file_name}_simple_analysis_trajectories.json", encoding='utf8') as f:
-        detailed_logic_analysis_trajectories = json.load(f)
+    # the analysis itself (the trajectories start with the analyzing prompt, the whole shared context under --prefix_caching)
+    with open(f"{output_dir}/{save_todo_file_name}_simple_analysis_response.json", encoding='utf8') as f:
+        detailed_logic_analysis_response = json.load(f)
 
-    detailed_logic_analysis_dict[todo_file_name] = detailed_logic_analysis_trajectories[0]['content']
+    detailed_logic_analysis_dict[todo_file_name] = detailed_logic_analysis_response[0]['text']
 
 artifact_output_dir=f'{output_dir}/coding_artifacts'
 os.makedirs(artifact_output_dir, exist_ok=True)
 
-for todo_idx, todo_file_name in enumerate(tqdm(todo_file_lst)):
-    responses = []
-    trajectories = copy.deepcopy(code_msg)
+budgeter = ContextBudgeter(model_name, output_dir, max_model_len, LOCAL_RESERVE_OUTPUT)
+# --prefix_caching: every prompt of this stage and of analyzing starts with the same shared context
+layout = PromptLayout(paper_content, context_lst, config_yaml, budgeter) if args.prefix_caching else None
 
-    current_stage = f"[CODING] {todo_file_name}"
-    print(current_stage)
-
-    if todo_file_name == "config.yaml":
-        continue
-
-    instruction_msg = get_write_msg(todo_file_name, detailed_logic_analysis_dict[todo_file_name], done_file_lst)
-    trajectories.extend(instruction_msg)
+def save_file(todo_file_name, trajectories, completion):
+    responses = []
 
-    completion = run_llm(trajectories)
-    
     # response
     completion_json = {
         'text': completion
@@ -246,7 +193,7 @@ for todo_idx, todo_file_name in enumerate(tqdm(todo_file_lst)):
     # extract code save 
     try:
         code = extract_code_from_content(completion)
-    except Exception as e:
+    except Exception:
         code = extract_code_from_content2(completion) 
 
     if len(code) == 0:
@@ -259,3 +206,44 @@ for todo_idx, todo_file_name in enumerate(tqdm(todo_file_lst)):
 
     with open(f"{output_repo_dir}/{todo_file_name}", 'w', encoding='utf-8') as f:
         f.write(code)
+
+
+# files of one wave only depend on earlier waves (see coding_dag.py): each wave is generated together
+coding_file_lst = [fn for fn in todo_file_lst if fn != "config.yaml"]
+if args.serial:
+    waves = [[fn] for fn in coding_file_lst]
+else:
+    coding_dag = build_coding_dag(coding_file_lst, planning.logic_analysis_dict,
+                                  planning.design.get('Data structures and interfaces', ''))
+    waves = topological_waves(coding_file_lst, coding_dag)
+    with open(f'{artifact_output_dir}/coding_waves.json', 'w', encoding='utf-8') as f:
+        json.dump({"waves": waves, "deps": {fn: sorted(deps) for fn, deps in coding_dag.items()}}, f, indent=2)
+    print(f"[SCHEDULE] {len(coding_file_lst)} files in {len(waves)} waves")
+
+for wave in tqdm(waves):
+    # every prompt of the wave sees the files done before it
+    wave_done_file_lst = list(done_file_lst)
+    trajectories_dict = {}
+    for todo_file_name in wave:
+        current_stage = f"[CODING] {todo_file_name}"
+        print(current_stage)
+
+        if layout is not None:
+            trajectories = get_write_msg(todo_file_name, detailed_logic_analysis_dict[todo_file_name],
+                                         wave_done_file_lst)
+        else:
+            trajectories = copy.deepcopy(code_msg)
+            instruction_msg = get_write_msg(todo_file_name, detailed_logic_analysis_dict[todo_file_name],
+                                            wave_done_file_lst)
+            trajectories.extend(instruction_msg)
+            fit_paper_in_messages(budgeter, paper_content, trajectories,
+                                  f"{todo_file_name} {detailed_logic_analysis_dict[todo_file_name]}", current_stage)
+        trajectories_dict[todo_file_name] = trajectories
+
+    completions = run_llm_batch(list(trajectories_dict.values()))
+    for (todo_file_name, trajectories), completion in zip(trajectories_dict.items(), completions):
+        save_file(todo_file_name, trajectories, completion)
+
+meter.write_stats(output_dir, "[CODING]")
+if args.prefix_caching:
+    record_prompt_cache_stats(output_dir, "coding", meter.prefix_cache_stats())
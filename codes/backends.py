@@ -0,0 +1,547 @@
+"""
+backends.py
+
+The model behind a stage (--backend):
+
+  openai   the OpenAI API, or any endpoint given with --base_url, through
+           utils.chat_completion: response cache, rate limiter, retries and
+           hedging, streaming
+  server   an OpenAI-compatible server running a local model (`vllm serve
+           <model>`, mock_server.py) at --base_url; same request path as
+           openai, but nothing is billed
+  vllm     vLLM in the stage's own process
+
+Every backend answers complete(request_json) with an openai ChatCompletion,
+so logging, cost accounting and the response cache treat its replies the same
+way. complete_many(request_jsons) answers independent requests together: the
+vllm backend submits them in one llm.generate call, where continuous batching
+decodes them side by side; the API backends send them concurrently.
+Completions of the local backends carry "x_local", which cal_cost bills at
+zero.
+
+The vLLM engine is loaded once per process and model (load_vllm_engine) and
+shared by every stage run in that process: run_local.py runs planning,
+analyzing and coding of a paper in one process, so the model is loaded and its
+CUDA graphs are captured once instead of three times. The engine is no longer
+run with enforce_eager; pass --enforce_eager when the graphs do not fit in
+GPU memory.
+
+With --prefix_caching the engine is started with automatic prefix caching:
+KV blocks of a prompt prefix the engine has already computed are reused
+instead of prefilled again. complete_many then sorts its requests so that
+prompts sharing a prefix are scheduled next to each other, and first prefills
+the prefix the whole batch shares in a one-token warm-up request, since
+requests scheduled in the same step cannot reuse each other's blocks. The
+prompt tokens served from the cache are reported as
+usage.prompt_tokens_details.cached_tokens (vLLM's num_cached_tokens, or
+PrefixCacheSimulator's estimate for engines that do not report it).
+
+The vllm backend tokenizes prompts with chat_encoding.IncrementalChatEncoder:
+token ids of conversation prefixes and of text registered with share_prefix
+(a no-op on the API backends) are kept, so a growing conversation or another
+prompt over the same planning context only tokenizes what is new.
+
+StubEngine is a CPU stand-in for vllm.LLM (register_engine) with a simple
+cost model of continuous batching and, optionally, a PrefixCacheSimulator;
+bench_batching.py and bench_prefix_caching.py use it to compare stage paths
+without a GPU.
+"""
+
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from chat_encoding import IncrementalChatEncoder, CHECK_MODES
+from prompts import prompt_cache_stats, cached_tokens_of
+from utils import make_client, chat_completion, achat_completion, stream_chat_completion, \
+    astream_chat_completion, _cache_lookup, _cache_store
+
+BACKENDS = ["openai", "server", "vllm"]
+
+_ENGINES = {}  # model name -> (vllm.LLM, tokenizer, engine settings, SamplingParams class)
+API_BATCH_WORKERS = 8  # concurrent requests of complete_many on the API backends
+PREFIX_BLOCK_SIZE = 16  # tokens per KV block (vLLM's default block size)
+_PREFIX_CACHES = {}  # model name -> PrefixCacheSimulator mirroring the engine's prefix cache
+_ENCODERS = {}  # model name -> IncrementalChatEncoder over the engine's tokenizer
+
+
+def add_backend_args(parser, default="openai"):
+    """Register --backend and the settings of the local (vLLM) model."""
+    parser.add_argument('--backend', type=str, default=default, choices=BACKENDS,
+                        help="openai: OpenAI API; server: OpenAI-compatible local server at --base_url; "
+                             "vllm: vLLM in this process")
+    parser.add_argument('--tp_size', type=int, default=2)
+    parser.add_argument('--temperature', type=float, default=1.0,
+                        help="Sampling temperature of the local backends")
+    parser.add_argument('--max_model_len', type=int, default=128000)
+    parser.add_argument('--enforce_eager', action="store_true",
+                        help="Run vLLM without CUDA graphs (less GPU memory, slower decoding)")
+    parser.add_argument('--prefix_caching', action="store_true",
+                        help="Reuse the KV cache of shared prompt prefixes across files and stages "
+                             "(vLLM automatic prefix caching, prompts laid out as in prompts.py)")
+    parser.add_argument('--encoding_check', type=str, default="first", choices=CHECK_MODES,
+                        help="Compare the vllm backend's incremental prompt encoding with a full re-encoding: "
+                             "on the first prompt that reuses a prefix, on every prompt, or never")
+    return parser
+
+
+def local_completion(model, content, prompt_tokens, completion_tokens, finish_reason="stop", cached_tokens=0):
+    """A ChatCompletion for a reply generated by a local model."""
+    from openai.types.chat import ChatCompletion
+
+    return ChatCompletion.model_validate({
+        "id": f"local-{time.time_ns()}", "object": "chat.completion", "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "finish_reason": finish_reason or "stop",
+                     "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens,
+                  "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+        "x_local": True,
+    })
+
+
+def load_vllm_engine(model_name, tp_size=2, max_model_len=128000, enforce_eager=False, prefix_caching=False):
+    """(vllm.LLM, tokenizer) for `model_name`, loaded on first use and kept for the process."""
+    settings = {"tp_size": tp_size, "max_model_len": max_model_len, "enforce_eager": enforce_eager,
+                "prefix_caching": prefix_caching}
+    if model_name in _ENGINES:
+        llm, tokenizer, loaded, sampling_params_cls = _ENGINES[model_name]
+        if loaded != settings:
+            # a second engine would not fit next to the first on the same GPUs
+            print(f"[vLLM] reusing {model_name} loaded with {loaded} (asked for {settings})")
+        return llm, tokenizer, sampling_params_cls
+
+    from transformers import AutoTokenizer
+    from vllm import LLM, SamplingParams
+
+    engine_args = {"model": model_name, "tensor_parallel_size": tp_size, "max_model_len": max_model_len,
+                   "gpu_memory_utilization": 0.95, "trust_remote_code": True, "enforce_eager": enforce_eager}
+    if "Qwen" in model_name:
+        engine_args["rope_scaling"] = {"factor": 4.0, "original_max_position_embeddings": 32768, "type": "yarn"}
+    if prefix_caching:
+        engine_args["enable_prefix_caching"] = True
+    print(f"[vLLM] loading {model_name} ({settings})")
+    start = time.time()
+    llm = LLM(**engine_args)
+    print(f"[vLLM] loaded in {time.time() - start:.1f}s")
+    register_engine(model_name, llm, AutoTokenizer.from_pretrained(model_name), SamplingParams, settings)
+    return _ENGINES[model_name][0], _ENGINES[model_name][1], SamplingParams
+
+
+def register_engine(model_name, llm, tokenizer, sampling_params_cls, settings=None):
+    """Makes `llm` the engine the vllm backend uses for `model_name` in this process."""
+    _ENGINES[model_name] = (llm, tokenizer, settings or {}, sampling_params_cls)
+    _PREFIX_CACHES[model_name] = PrefixCacheSimulator()
+    _ENCODERS[model_name] = IncrementalChatEncoder(tokenizer)
+
+
+class PrefixCacheSimulator:
+    """
+    Block-level prefix cache as vLLM keeps it: a prompt is cut into full blocks
+    of `block_size` tokens, each identified by a hash chained over all blocks
+    before it, so a block is only reused after an identical prefix. With
+    `num_blocks` the least recently used blocks are evicted.
+    """
+
+    def __init__(self, block_size=PREFIX_BLOCK_SIZE, num_blocks=None):
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.blocks = OrderedDict()
+
+    def block_hashes(self, token_ids):
+        hashes = []
+        parent = b""
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            block = token_ids[start:start + self.block_size]
+            parent = hashlib.blake2b(parent + repr(block).encode(), digest_size=16).digest()
+            hashes.append(parent)
+        return hashes
+
+    def lookup(self, token_ids):
+        """Prompt tokens whose KV is cached; the last token is always computed, as in vLLM."""
+        cached_blocks = 0
+        for block_hash in self.block_hashes(token_ids[:-1]):
+            if block_hash not in self.blocks:
+                break
+            self.blocks.move_to_end(block_hash)
+            cached_blocks += 1
+        return cached_blocks * self.block_size
+
+    def insert(self, token_ids):
+        for block_hash in self.block_hashes(token_ids):
+            self.blocks[block_hash] = True
+            self.blocks.move_to_end(block_hash)
+        while self.num_blocks is not None and len(self.blocks) > self.num_blocks:
+            self.blocks.popitem(last=False)
+
+
+def common_prefix_length(token_id_lists):
+    first, last = min(token_id_lists), max(token_id_lists)
+    n = 0
+    while n < min(len(first), len(last)) and first[n] == last[n]:
+        n += 1
+    return n
+
+
+class OpenAIBackend:
+    """The OpenAI API (or --base_url) behind the stage's usual request path."""
+
+    kind = "openai"
+
+    def __init__(self, args, model, cache=None):
+        self.args = args
+        self.model = model
+        self.cache = cache
+        self._client = None
+        self._aclient = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = make_client(self.args)
+        return self._client
+
+    @property
+    def aclient(self):
+        if self._aclient is None:
+            self._aclient = make_client(self.args, use_async=True)
+        return self._aclient
+
+    def _request(self, request_json):
+        return request_json
+
+    def _mark(self, completion):
+        return completion
+
+    def complete(self, request_json, batch=None):
+        return self._mark(chat_completion(self.client, self._request(request_json), self.cache, batch))
+
+    async def acomplete(self, request_json):
+        return self._mark(await achat_completion(self.aclient, self._request(request_json), self.cache))
+
+    def stream(self, request_json, on_text=None, stop_when=None):
+        return self._mark(stream_chat_completion(self.client, self._request(request_json), self.cache, on_text,
+                                                 stop_when))
+
+    async def astream(self, request_json, on_text=None, stop_when=None):
+        return self._mark(await astream_chat_completion(self.aclient, self._request(request_json), self.cache,
+                                                        on_text, stop_when))
+
+    def share_prefix(self, text):
+        pass
+
+    def complete_many(self, request_jsons):
+        with ThreadPoolExecutor(max_workers=max(1, min(API_BATCH_WORKERS, len(request_jsons)))) as pool:
+            return list(pool.map(self.complete, request_jsons))
+
+
+class ServerBackend(OpenAIBackend):
+    """An OpenAI-compatible server running a local model."""
+
+    kind = "server"
+
+    def __init__(self, args, model, cache=None):
+        if not args.base_url:
+            raise ValueError("--backend server needs --base_url (e.g. http://127.0.0.1:8000/v1)")
+        super().__init__(args, model, cache)
+
+    def _request(self, request_json):
+        request_json = {k: v for k, v in request_json.items() if k != "reasoning_effort"}
+        return {"temperature": self.args.temperature, **request_json}
+
+    def _mark(self, completion):
+        completion.x_local = True
+        return completion
+
+
+class VLLMBackend:
+    """vLLM in this process, on the engine shared by the process's stages."""
+
+    kind = "vllm"
+
+    def __init__(self, args, model, cache=None):
+        self.model = model
+        self.cache = cache
+        self.temperature = args.temperature
+        self.prefix_caching = getattr(args, "prefix_caching", False)
+        self.llm, self.tokenizer, self.sampling_params_cls = load_vllm_engine(
+            model, args.tp_size, args.max_model_len, args.enforce_eager, self.prefix_caching)
+        self.prefix_cache = _PREFIX_CACHES[model]
+        self.encoder = _ENCODERS[model]
+        self.encoder.check = getattr(args, "encoding_check", "first")
+        self.max_model_len = args.max_model_len
+        self.warmup_tokens = 0  # prompt tokens prefilled by warm-up requests
+        self._lock = threading.Lock()
+
+    def sampling_params(self, request_json):
+        SamplingParams = self.sampling_params_cls
+        temperature = request_json.get("temperature", self.temperature)
+        if "Qwen" in self.model:
+            return SamplingParams(temperature=temperature, max_tokens=131072)
+        if "deepseek" in self.model:
+            return SamplingParams(temperature=temperature, max_tokens=128000,
+                                  stop_token_ids=[self.tokenizer.eos_token_id])
+        return SamplingParams(temperature=temperature, max_tokens=self.max_model_len,
+                              stop_token_ids=[self.tokenizer.eos_token_id])
+
+    def complete(self, request_json, batch=None):
+        return self.complete_many([request_json])[0]
+
+    def share_prefix(self, text):
+        """`text` starts or recurs in many prompts of the stage: its token ids are reused (chat_encoding.py)."""
+        self.encoder.add_anchor(text)
+
+    def complete_many(self, request_jsons):
+        """Uncached requests go to the engine in one generate call; replies come back in order."""
+        completions = []
+        pending = []  # (index, cache key, prompt token ids)
+        for i, request_json in enumerate(request_jsons):
+            key, completion = _cache_lookup(self.cache, request_json)
+            completions.append(completion)
+            if completion is None:
+                pending.append((i, key, None))
+        if not pending:
+            return completions
+        with self._lock:
+            pending = [(i, key, self.encoder.encode(request_jsons[i]["messages"], add_generation_prompt=True))
+                       for i, key, _ in pending]
+            if self.prefix_caching:
+                # neighbours share the longest prefixes; the prefix shared by all is prefilled once up front
+                pending.sort(key=lambda p: p[2])
+                shared = common_prefix_length([ids for _, _, ids in pending])
+                if len(pending) > 1 and shared >= self.prefix_cache.block_size:
+                    self.warm_up(pending[0][2][:shared])
+            # blocks of this batch are not cached yet for its own requests
+            estimates = [self.prefix_cache.lookup(ids) for _, _, ids in pending]
+            outputs = self.llm.generate(prompt_token_ids=[ids for _, _, ids in pending],
+                                        sampling_params=[self.sampling_params(request_jsons[i]) for i, _, _ in pending])
+            for _, _, ids in pending:
+                self.prefix_cache.insert(ids)
+        for (i, key, prompt_token_ids), request_output, estimate in zip(pending, outputs, estimates):
+            cached_tokens = getattr(request_output, "num_cached_tokens", None)
+            if cached_tokens is None:
+                cached_tokens = estimate if self.prefix_caching else 0
+            output = request_output.outputs[0]
+            completions[i] = local_completion(self.model, output.text, len(prompt_token_ids), len(output.token_ids),
+                                              output.finish_reason, cached_tokens)
+            _cache_store(self.cache, key, completions[i])
+        return completions
+
+    def warm_up(self, prefix_token_ids):
+        """Prefills `prefix_token_ids` (a one-token generation) so the next batch finds it cached."""
+        cached = self.prefix_cache.lookup(prefix_token_ids + [0])
+        if cached >= len(prefix_token_ids) - self.prefix_cache.block_size:
+            return
+        self.llm.generate(prompt_token_ids=[prefix_token_ids],
+                          sampling_params=[self.sampling_params_cls(temperature=0.0, max_tokens=1)])
+        self.prefix_cache.insert(prefix_token_ids)
+        self.warmup_tokens += len(prefix_token_ids) - cached
+
+    async def acomplete(self, request_json):
+        return await asyncio.to_thread(self.complete, request_json)
+
+    def stream(self, request_json, on_text=None, stop_when=None):
+        # offline generation returns the whole reply at once
+        completion = self.complete(request_json)
+        if on_text is not None:
+            on_text(completion.choices[0].message.content)
+        return completion
+
+    async def astream(self, request_json, on_text=None, stop_when=None):
+        return await asyncio.to_thread(self.stream, request_json, on_text, stop_when)
+
+
+class StubSamplingParams:
+    def __init__(self, temperature=1.0, max_tokens=16, stop_token_ids=None, **kwargs):
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.stop_token_ids = stop_token_ids or []
+
+
+class StubTokenizer:
+    """
+    Four characters per token, a line break always ending a token. Remembers
+    the conversation behind each rendered prompt for StubEngine.
+    """
+
+    eos_token_id = 0
+
+    def __init__(self):
+        self.vocab = {}
+        self.pieces = [""]
+        self.conversations = {}
+
+    def encode(self, text, add_special_tokens=False):
+        return [self.vocab.setdefault(line[i:i + 4], len(self.vocab) + 1)
+                for line in text.splitlines(keepends=True) for i in range(0, len(line), 4)]
+
+    def decode(self, token_ids):
+        if len(self.pieces) <= len(self.vocab):
+            self.pieces = [""] + sorted(self.vocab, key=self.vocab.get)
+        return "".join(self.pieces[i] for i in token_ids)
+
+    def apply_chat_template(self, messages, tokenize=True, add_generation_prompt=True):
+        text = "".join(f"<|{m['role']}|>\n{m['content']}\n" for m in messages)
+        text += "<|assistant|>\n" if add_generation_prompt else ""
+        self.conversations[text] = messages
+        return self.encode(text) if tokenize else text
+
+
+class StubEngine:
+    """
+    CPU stand-in for vllm.LLM. reply(messages) gives the text of each reply;
+    generate() sleeps as long as a continuous-batching engine would take: the
+    prompts are prefilled at prefill_tps, then every decode step advances all
+    running sequences (at most max_num_seqs) for step_s + per_seq_s per
+    running sequence, so a batch of N replies costs far less than N serial
+    ones. `busy_seconds` adds up the simulated time; the sleep is scaled by
+    time_scale.
+
+    With enable_prefix_caching a PrefixCacheSimulator of num_gpu_blocks
+    blocks decides which prompt tokens need no prefill; like vLLM, requests of
+    one generate call only reuse blocks cached before the call, and each
+    output reports num_cached_tokens. `prefilled_tokens` and `cached_tokens`
+    add up over all calls.
+    """
+
+    def __init__(self, tokenizer, reply, prefill_tps=20_000, step_s=0.004, per_seq_s=0.0002, max_num_seqs=256,
+                 time_scale=1.0, enable_prefix_caching=False, num_gpu_blocks=None):
+        self.tokenizer = tokenizer
+        self.reply = reply
+        self.prefill_tps = prefill_tps
+        self.step_s = step_s
+        self.per_seq_s = per_seq_s
+        self.max_num_seqs = max_num_seqs
+        self.time_scale = time_scale
+        self.prefix_cache = PrefixCacheSimulator(num_blocks=num_gpu_blocks) if enable_prefix_caching else None
+        self.busy_seconds = 0.0
+        self.prefill_seconds = 0.0
+        self.prefilled_tokens = 0
+        self.cached_tokens = 0
+
+    def decode_seconds(self, lengths):
+        seconds = 0.0
+        for start in range(0, len(lengths), self.max_num_seqs):
+            running = sorted(lengths[start:start + self.max_num_seqs])
+            done_steps = 0
+            for i, length in enumerate(running):
+                seconds += (length - done_steps) * (self.step_s + self.per_seq_s * (len(running) - i))
+                done_steps = length
+        return seconds
+
+    def generate(self, prompt_token_ids, sampling_params):
+        from types import SimpleNamespace
+
+        if not isinstance(sampling_params, list):
+            sampling_params = [sampling_params] * len(prompt_token_ids)
+        cached = [self.prefix_cache.lookup(ids) if self.prefix_cache else 0 for ids in prompt_token_ids]
+        outputs = []
+        for ids, params in zip(prompt_token_ids, sampling_params):
+            if self.prefix_cache:
+                self.prefix_cache.insert(ids)
+            messages = self.tokenizer.conversations.get(self.tokenizer.decode(ids))
+            if messages is None:  # a bare prefix (warm-up request)
+                token_ids = [self.tokenizer.eos_token_id][:params.max_tokens]
+            else:
+                token_ids = self.tokenizer.encode(self.reply(messages))[:params.max_tokens]
+            outputs.append(SimpleNamespace(text=self.tokenizer.decode(token_ids), token_ids=token_ids,
+                                           finish_reason="stop"))
+        prefilled = sum(len(ids) for ids in prompt_token_ids) - sum(cached)
+        prefill_seconds = prefilled / self.prefill_tps
+        seconds = prefill_seconds + self.decode_seconds([len(o.token_ids) for o in outputs])
+        time.sleep(seconds * self.time_scale)
+        self.busy_seconds += seconds
+        self.prefill_seconds += prefill_seconds
+        self.prefilled_tokens += prefilled
+        self.cached_tokens += sum(cached)
+        return [SimpleNamespace(outputs=[o], num_cached_tokens=c if self.prefix_cache else None)
+                for o, c in zip(outputs, cached)]
+
+
+def get_backend(args, model, cache=None):
+    """The backend selected by --backend, serving `model`."""
+    backend = getattr(args, "backend", "openai")
+    if backend == "vllm":
+        return VLLMBackend(args, model, cache)
+    if backend == "server":
+        return ServerBackend(args, model, cache)
+    return OpenAIBackend(args, model, cache)
+
+
+def complete_text(backend, messages):
+    """The reply text to `messages` (the local stages' run_llm)."""
+    return backend.complete({"model": backend.model, "messages": messages}).choices[0].message.content
+
+
+class ThroughputMeter:
+    """Generated tokens per second of a stage's generate calls, and the prompt tokens they took from the prefix cache."""
+
+    def __init__(self):
+        self.calls = 0
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.warmup_tokens = 0
+        self.completion_tokens = 0
+        self.seconds = 0.0
+
+    def complete_texts(self, backend, messages_list):
+        """Reply texts to independent conversations, generated together (complete_many)."""
+        start = time.time()
+        warmup_tokens = getattr(backend, "warmup_tokens", 0)
+        completions = backend.complete_many([{"model": backend.model, "messages": m} for m in messages_list])
+        self.seconds += time.time() - start
+        self.warmup_tokens += getattr(backend, "warmup_tokens", 0) - warmup_tokens
+        self.calls += 1
+        self.requests += len(completions)
+        for completion in completions:
+            if completion.usage:
+                self.prompt_tokens += completion.usage.prompt_tokens
+                self.cached_tokens += cached_tokens_of(completion)
+                self.completion_tokens += completion.usage.completion_tokens
+        return [completion.choices[0].message.content for completion in completions]
+
+    def tokens_per_second(self):
+        return self.completion_tokens / self.seconds if self.seconds else 0.0
+
+    def prefix_cache_stats(self):
+        """prompts.prompt_cache_stats plus the warm-up prefill, for record_prompt_cache_stats."""
+        stats = prompt_cache_stats(self.prompt_tokens, self.cached_tokens)
+        stats["warmup_tokens"] = self.warmup_tokens
+        stats["prefill_tokens_saved"] = self.cached_tokens - self.warmup_tokens
+        return stats
+
+    def write_stats(self, output_dir, current_stage):
+        """Append the stage's generation throughput to generation_throughput.log."""
+        if not self.requests:
+            return
+        output_lines = []
+        output_lines.append("⚡ Generation Throughput ⚡")
+        output_lines.append(f"{current_stage}")
+        output_lines.append(f"📦 Requests: {self.requests} in {self.calls} generate call(s)")
+        output_lines.append(f"📥 Prompt tokens: {self.prompt_tokens}  📤 Completion tokens: {self.completion_tokens}")
+        if self.cached_tokens or self.warmup_tokens:
+            output_lines.append(f"♻️ Prefix cache: {self.cached_tokens} prompt tokens not prefilled, "
+                                f"{self.warmup_tokens} prefilled by warm-up "
+                                f"({self.cached_tokens - self.warmup_tokens} saved)")
+        output_lines.append(f"⏱️ {self.seconds:.1f}s  ({self.tokens_per_second():.1f} completion tokens/s)")
+        output_lines.append("============================================\n")
+
+        output_text = "\n".join(output_lines)
+        print(output_text)
+
+        os.makedirs(output_dir, exist_ok=True)
+        with open(f"{output_dir}/generation_throughput.log", "a", encoding="utf-8") as f:
+            f.write(output_text + "\n")
+
+
+def context_window(args):
+    """--context_window, or for the local backends the model length they were started with."""
+    if getattr(args, "context_window", None):
+        return args.context_window
+    return args.max_model_len if getattr(args, "backend", "openai") != "openai" else None
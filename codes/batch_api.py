@@ -0,0 +1,259 @@
+"""
+batch_api.py
+
+Runs the requests queued by `eval.py --batch` and `3_coding.py --batch` through
+the OpenAI Batch API (half price, up to 24h turnaround) and fans the results
+back into the stages' usual outputs.
+
+Loop, until nothing is queued:
+  1. submit <batch_dir>/requests.jsonl as one batch job (split at
+     --max_requests_per_batch) and poll until it finishes
+  2. store every response in the shared response cache and log its discounted
+     cost to the cost_info.log of the stage that queued it
+  3. re-run every stage command that queued a request; it now hits the cache and
+     writes eval_results/*.json or coding_artifacts/ as usual. 3_coding.py is
+     re-run with --resume, so files of earlier rounds are skipped instead of
+     being logged again, and queues its next file for the next batch.
+
+A failed request is queued again by its stage's re-run. Failures are counted
+per request in <batch_dir>/failed_requests.json; once a request has failed
+--max_request_failures times, batch_api.py re-runs the other stages of that
+round (whatever they queue next stays queued), reports the failing request
+and stops with an error instead of resubmitting it every round.
+
+Usage:
+    python eval.py --batch ... (once per paper / experiment)
+    python 3_coding.py --batch ...
+    python batch_api.py --batch_dir ~/.cache/paper2code/batch
+
+    # offline: run the batch against a local OpenAI-compatible endpoint; the
+    # stages must have queued with the same --base_url (cache keys include it)
+    python batch_api.py --local --base_url http://127.0.0.1:8000/v1
+"""
+
+import argparse
+import io
+import json
+import os
+import shutil
+import subprocess
+import time
+
+from openai import OpenAI
+
+from utils import (
+    DEFAULT_CACHE_DIR, ResponseCache, cache_namespace, get_executor,
+    load_accumulated_cost, save_accumulated_cost, print_log_cost,
+)
+
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class LocalBatchRunner:
+    """
+    Stand-in for the Batch endpoint: executes each line through the ordinary
+    chat-completions endpoint and returns output lines in the Batch API format.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def run(self, request_lines):
+        output_lines = []
+        for idx, line in enumerate(request_lines):
+            try:
+                completion = get_executor().call(lambda: self.client.chat.completions.create(**line["body"]),
+                                                 label=line["custom_id"])
+                response = {"status_code": 200, "request_id": f"local-{idx}",
+                            "body": json.loads(completion.model_dump_json())}
+                error = None
+            except Exception as e:
+                response = None
+                error = {"code": type(e).__name__, "message": str(e)}
+            output_lines.append({"id": f"batch_req_local_{idx}", "custom_id": line["custom_id"],
+                                 "response": response, "error": error})
+        return output_lines
+
+
+def read_jsonl(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def take_queue(batch_dir):
+    """Moves the current queue aside so stages can queue the next round meanwhile."""
+    import fcntl
+
+    round_dir = os.path.join(batch_dir, "rounds", time.strftime("%Y%m%d-%H%M%S"))
+    with open(os.path.join(batch_dir, "queue.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(os.path.join(batch_dir, "requests.jsonl")):
+            return None
+        os.makedirs(round_dir, exist_ok=True)
+        for name in ("requests.jsonl", "meta.jsonl"):
+            shutil.move(os.path.join(batch_dir, name), os.path.join(round_dir, name))
+    return round_dir
+
+
+def meta_endpoint(meta, custom_id):
+    entries = meta.get(custom_id) or [{}]
+    return entries[0].get("endpoint", "")
+
+
+def load_failures(batch_dir):
+    path = os.path.join(batch_dir, "failed_requests.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_failures(batch_dir, failures):
+    with open(os.path.join(batch_dir, "failed_requests.json"), "w", encoding="utf-8") as f:
+        json.dump(failures, f, indent=2)
+
+
+def submit_and_wait(client, request_lines, poll_interval):
+    payload = "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in request_lines)
+    input_file = client.files.create(file=("batch_input.jsonl", io.BytesIO(payload.encode("utf-8"))),
+                                     purpose="batch")
+    job = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                completion_window="24h")
+    print(f"[BATCH] submitted {job.id} ({len(request_lines)} requests)")
+
+    while job.status not in FINAL_STATUSES:
+        time.sleep(poll_interval)
+        job = client.batches.retrieve(job.id)
+        counts = job.request_counts
+        done = f"{counts.completed}/{counts.total}" if counts else "?"
+        print(f"[BATCH] {job.id}: {job.status} ({done})")
+
+    output_lines = []
+    for file_id in (job.output_file_id, job.error_file_id):
+        if file_id:
+            output_lines += [json.loads(line) for line in client.files.content(file_id).text.splitlines()
+                             if line.strip()]
+    if job.status != "completed":
+        print(f"[WARNING] batch {job.id} ended as {job.status}")
+    return output_lines
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_dir', type=str, default=os.path.join(DEFAULT_CACHE_DIR, "batch"))
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR,
+                        help="Response cache the stages read (must match their --cache_dir)")
+    parser.add_argument('--cache_max_mb', type=int, default=2048)
+    parser.add_argument('--max_requests_per_batch', type=int, default=50000)
+    parser.add_argument('--poll_interval', type=float, default=30.0)
+    parser.add_argument('--max_rounds', type=int, default=1000,
+                        help="Upper bound on submit/re-run rounds (3_coding.py needs one per file)")
+    parser.add_argument('--max_request_failures', type=int, default=3,
+                        help="Stop once a request has failed this many times (it is retried until then)")
+    parser.add_argument('--local', action="store_true",
+                        help="Execute requests one by one via chat completions instead of the Batch endpoint")
+    parser.add_argument('--base_url', type=str, default=None)
+    args = parser.parse_args()
+
+    client = OpenAI(api_key=os.environ["OPENAI_API_KEY"], base_url=args.base_url)
+    cache = ResponseCache(args.cache_dir, "readwrite", args.cache_max_mb * 1024 * 1024)
+    runner = LocalBatchRunner(client) if args.local else None
+    # replies are cached under the stage's key, which includes the endpoint the stage meant
+    endpoint = cache_namespace(args)
+
+    for round_idx in range(args.max_rounds):
+        round_dir = take_queue(args.batch_dir)
+        if round_dir is None:
+            print("[BATCH] queue is empty - done.")
+            break
+
+        meta = {}
+        for m in read_jsonl(os.path.join(round_dir, "meta.jsonl")):
+            meta.setdefault(m["custom_id"], []).append(m)
+        # identical requests queued by different stages share one batch line
+        request_lines = list({line["custom_id"]: line
+                              for line in read_jsonl(os.path.join(round_dir, "requests.jsonl"))}.values())
+        print(f"[BATCH] round {round_idx}: {len(request_lines)} unique requests")
+
+        output_lines = []
+        for line in [l for l in request_lines if meta_endpoint(meta, l["custom_id"]) != endpoint]:
+            output_lines.append({"custom_id": line["custom_id"], "response": None,
+                                 "error": {"code": "endpoint_mismatch",
+                                           "message": f"queued for endpoint '{meta_endpoint(meta, line['custom_id'])}'"
+                                                      f", batch_api.py sends to '{endpoint}'"}})
+        request_lines = [l for l in request_lines if meta_endpoint(meta, l["custom_id"]) == endpoint]
+        for start in range(0, len(request_lines), args.max_requests_per_batch):
+            chunk = request_lines[start:start + args.max_requests_per_batch]
+            if runner is not None:
+                output_lines += runner.run(chunk)
+            else:
+                output_lines += submit_and_wait(client, chunk, args.poll_interval)
+        with open(os.path.join(round_dir, "output.jsonl"), "w", encoding="utf-8") as f:
+            for line in output_lines:
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+        failures = load_failures(args.batch_dir)
+        n_failed = 0
+        for line in output_lines:
+            response = line.get("response") or {}
+            if line.get("error") or response.get("status_code") != 200:
+                n_failed += 1
+                error = line.get('error') or response
+                failure = failures.setdefault(line["custom_id"], {"failures": 0})
+                failure["failures"] += 1
+                if isinstance(error, dict) and error.get("code") == "endpoint_mismatch":
+                    # answering it elsewhere cannot help
+                    failure["failures"] = max(failure["failures"], args.max_request_failures)
+                failure["error"] = str(error)
+                failure["stages"] = sorted({m["stage"] for m in meta.get(line["custom_id"], [])})
+                print(f"[WARNING] request {line['custom_id'][:12]} failed "
+                      f"({failure['failures']}/{args.max_request_failures}): {error}")
+                continue
+            failures.pop(line["custom_id"], None)
+            body = response["body"]
+            cache.put(line["custom_id"], body)
+            # cost is billed once, here; the stage re-run sees a cache hit
+            for m in meta.get(line["custom_id"], [])[:1]:
+                accumulated_cost_file = os.path.join(m["output_dir"], "accumulated_cost.json")
+                total_accumulated_cost = load_accumulated_cost(accumulated_cost_file)
+                total_accumulated_cost = print_log_cost(dict(body, x_batch=True), m["model"], m["stage"],
+                                                        m["output_dir"], total_accumulated_cost)
+                save_accumulated_cost(accumulated_cost_file, total_accumulated_cost)
+
+        save_failures(args.batch_dir, failures)
+        exhausted = {custom_id: failure for custom_id, failure in failures.items()
+                     if failure["failures"] >= args.max_request_failures}
+
+        commands = {}
+        for custom_id, entries in meta.items():
+            for m in entries:
+                cmd = m["cmd"]
+                if m.get("resume_flag") and m["resume_flag"] not in cmd:
+                    cmd = cmd + [m["resume_flag"]]
+                commands.setdefault((m["cwd"], tuple(cmd)), set()).add(custom_id)
+        for (cwd, cmd), custom_ids in commands.items():
+            if custom_ids & exhausted.keys():
+                # it would only queue the failing request again
+                continue
+            print(f"[BATCH] re-running: {' '.join(cmd)}")
+            subprocess.run(list(cmd), cwd=cwd)
+
+        if exhausted:
+            # a later batch_api.py run starts their count afresh
+            save_failures(args.batch_dir, {k: v for k, v in failures.items() if k not in exhausted})
+            for custom_id, failure in exhausted.items():
+                print(f"[ERROR] request {custom_id[:12]} of {', '.join(failure['stages'])} failed "
+                      f"{failure['failures']} times: {failure['error']}")
+            raise SystemExit(f"[ERROR] stopped: {len(exhausted)} requests keep failing; the other stages were "
+                             f"re-run and anything they queued is left in {args.batch_dir}. Fix the failing "
+                             f"requests, re-run their stages with --batch, then run batch_api.py again.")
+        if n_failed:
+            print(f"[WARNING] {n_failed} requests failed; their stages queued them again for a retry.")
+    else:
+        print(f"[WARNING] stopped after {args.max_rounds} rounds with requests still queued.")
+
+
+if __name__ == "__main__":
+    main()
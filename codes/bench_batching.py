@@ -0,0 +1,120 @@
+"""
+bench_batching.py
+
+Generation throughput of the local analyzing and coding stages
+(2_analyzing_llm.py, 3_coding_llm.py), serial (--serial: one generate call
+per file) against batched (one call for all analyses, one per dependency wave
+for coding).
+
+The stages run unchanged in this process on the vllm backend, with a
+backends.StubEngine registered for the model, so no GPU is needed: replies are
+the ones recorded in outputs/<paper>/experiments/<exp> (mock_server
+ScriptedResponses, synthetic where the recording has none) and every generate
+call takes the time the stub's continuous-batching cost model gives it.
+Throughput is completion tokens per wall-clock second of the generate calls,
+from the stage's ThroughputMeter, rescaled by --time_scale (the stub sleeps
+that fraction of the simulated time). The absolute numbers depend on the cost
+model (--step_ms, --per_seq_ms, --prefill_tps); the ratio is what to read.
+
+Usage:
+    python bench_batching.py --output_root ../outputs
+    python bench_batching.py --papers fit:../examples/fit.json --step_ms 2
+"""
+
+import argparse
+import contextlib
+import os
+import shutil
+import tempfile
+
+from backends import StubEngine, StubTokenizer, StubSamplingParams, register_engine
+from bench_prompt_cache import DEFAULT_PAPERS
+from mock_server import ScriptedResponses, classify, synthetic_reply
+from run_local import run_stage
+
+STUB_MODEL = "stub-coder"
+PLANNING_FILES = ("planning_config.yaml", "planning_trajectories.json", "task_list.json")
+
+
+def make_engine(exp_dir, args, **engine_kwargs):
+    scripted = ScriptedResponses(exp_dir)
+
+    def reply(messages):
+        kind, todo_file_name = classify(messages)
+        replies = scripted.reply(kind, todo_file_name, messages, 1)
+        return replies[0] if replies else synthetic_reply(kind, todo_file_name, messages)
+
+    tokenizer = StubTokenizer()
+    return StubEngine(tokenizer, reply, prefill_tps=args.prefill_tps, step_s=args.step_ms / 1000,
+                      per_seq_s=args.per_seq_ms / 1000, time_scale=args.time_scale, **engine_kwargs), tokenizer
+
+
+def run_paper(paper_name, pdf_json_path, planning_dir, exp_dir, serial, args, scratch_root):
+    """{stage: ThroughputMeter} of one run of analyzing + coding."""
+    engine, tokenizer = make_engine(exp_dir, args)
+    register_engine(STUB_MODEL, engine, tokenizer, StubSamplingParams)
+    out_dir = tempfile.mkdtemp(prefix=f"{paper_name}_{'serial' if serial else 'batched'}_", dir=scratch_root)
+    for name in PLANNING_FILES:
+        src = os.path.join(planning_dir, name)
+        if os.path.exists(src):
+            shutil.copy(src, out_dir)
+    stage_args = ["--paper_name", paper_name, "--pdf_json_path", pdf_json_path, "--output_dir", out_dir,
+                  "--model_name", STUB_MODEL, "--backend", "vllm"] + (["--serial"] if serial else [])
+    meters = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        meters["analyzing"] = run_stage("2_analyzing_llm.py", stage_args)["meter"]
+        meters["coding"] = run_stage("3_coding_llm.py", stage_args + ["--output_repo_dir",
+                                                                     os.path.join(out_dir, "repo")])["meter"]
+    return meters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_root', type=str, default="../outputs")
+    parser.add_argument('--papers', type=str, default=DEFAULT_PAPERS,
+                        help="Comma-separated paper_name:pdf_json_path pairs")
+    parser.add_argument('--experiment', type=str, default="llm_only_json",
+                        help="Recorded experiment whose replies the stub engine serves")
+    parser.add_argument('--prefill_tps', type=float, default=20_000)
+    parser.add_argument('--step_ms', type=float, default=4.0, help="Decode step of a single sequence")
+    parser.add_argument('--per_seq_ms', type=float, default=0.2, help="Extra decode step time per running sequence")
+    parser.add_argument('--time_scale', type=float, default=0.1, help="Fraction of the simulated time actually slept")
+    args = parser.parse_args()
+
+    scratch_root = tempfile.mkdtemp(prefix="batching_")
+    rows = []
+    for item in args.papers.split(","):
+        paper_name, pdf_json_path = item.strip().split(":", 1)
+        planning_dir = os.path.join(args.output_root, paper_name)
+        exp_dir = os.path.join(planning_dir, "experiments", args.experiment)
+        if not os.path.exists(os.path.join(planning_dir, "planning_trajectories.json")) \
+                or not os.path.exists(pdf_json_path):
+            print(f"[SKIP] {paper_name}: no planning output or paper json")
+            continue
+        serial = run_paper(paper_name, os.path.abspath(pdf_json_path), planning_dir, exp_dir, True, args,
+                           scratch_root)
+        batched = run_paper(paper_name, os.path.abspath(pdf_json_path), planning_dir, exp_dir, False, args,
+                            scratch_root)
+        for stage in ("analyzing", "coding"):
+            rows.append((paper_name, stage, serial[stage], batched[stage]))
+    shutil.rmtree(scratch_root, ignore_errors=True)
+
+    print("\n" + "=" * 92)
+    print(f"Batched generation on the stub engine (step {args.step_ms}ms + {args.per_seq_ms}ms/seq, "
+          f"prefill {args.prefill_tps:,.0f} tok/s)")
+    print("=" * 92)
+    print(f"{'Paper':<12} {'Stage':<10} {'Files':>5} {'Tokens':>8} {'Calls s/b':>10} {'Serial':>9} "
+          f"{'Batched':>9} {'tok/s s':>9} {'tok/s b':>9} {'Speedup':>8}")
+    print("-" * 92)
+    for paper_name, stage, s, b in rows:
+        serial_seconds, batched_seconds = s.seconds / args.time_scale, b.seconds / args.time_scale
+        speedup = serial_seconds / batched_seconds if batched_seconds else 0.0
+        print(f"{paper_name:<12} {stage:<10} {s.requests:>5} {s.completion_tokens:>8,} "
+              f"{f'{s.calls}/{b.calls}':>10} {serial_seconds:>8.1f}s {batched_seconds:>8.1f}s "
+              f"{s.completion_tokens / serial_seconds:>9.0f} {b.completion_tokens / batched_seconds:>9.0f} "
+              f"{speedup:>7.2f}x")
+    print("=" * 92)
+
+
+if __name__ == "__main__":
+    main()
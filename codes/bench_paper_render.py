@@ -0,0 +1,58 @@
+"""
+bench_paper_render.py
+
+Prompt tokens of the paper as the stages send it: the Python dict repr the
+prompts used to interpolate against paper_render.render_markdown, for every
+S2ORC JSON in examples/. Tokens are context_budget.count_tokens (o200k_base,
+or characters / 3 when tiktoken cannot load its vocabulary). The second
+render of the same paper object is the memoized one.
+
+Usage:
+    python bench_paper_render.py --examples_dir ../examples
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+
+from context_budget import count_tokens
+from paper_render import render_markdown
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--examples_dir', type=str, default="../examples")
+    args = parser.parse_args()
+
+    rows = []
+    for path in sorted(glob.glob(os.path.join(args.examples_dir, "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            paper_content = json.load(f)
+        start = time.perf_counter()
+        markdown = render_markdown(paper_content)
+        first_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        render_markdown(paper_content)
+        memo_ms = (time.perf_counter() - start) * 1000
+        rows.append((os.path.basename(path), count_tokens(str(paper_content)), count_tokens(markdown),
+                     len(str(paper_content)), len(markdown), first_ms, memo_ms))
+
+    print("\n" + "=" * 86)
+    print(f"Paper tokens per prompt: dict repr vs markdown ({len(rows)} papers)")
+    print("=" * 86)
+    print(f"{'Paper':<26} {'repr tok':>9} {'md tok':>9} {'Saved':>7} {'repr chars':>11} {'md chars':>9} "
+          f"{'Render':>8} {'Memo':>8}")
+    print("-" * 86)
+    for name, repr_tokens, md_tokens, repr_chars, md_chars, first_ms, memo_ms in rows:
+        print(f"{name:<26} {repr_tokens:>9,} {md_tokens:>9,} {1 - md_tokens / repr_tokens:>7.1%} "
+              f"{repr_chars:>11,} {md_chars:>9,} {first_ms:>6.1f}ms {memo_ms:>6.3f}ms")
+    repr_total, md_total = sum(r[1] for r in rows), sum(r[2] for r in rows)
+    print("-" * 86)
+    print(f"{'Total':<26} {repr_total:>9,} {md_total:>9,} {1 - md_total / repr_total if repr_total else 0:>7.1%}")
+    print("=" * 86)
+
+
+if __name__ == "__main__":
+    main()
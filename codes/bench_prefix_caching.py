@@ -0,0 +1,117 @@
+"""
+bench_prefix_caching.py
+
+Prefill saved by KV prefix reuse in the local analyzing and coding stages
+(2_analyzing_llm.py, 3_coding_llm.py), run back to back on one engine as
+run_local.py runs them:
+
+  off      no prefix caching: every prompt is prefilled in full
+  apc      automatic prefix caching in the engine, stages unchanged
+  layout   --prefix_caching: prompts start with the shared context
+           (prompts.py), requests are ordered and the shared prefix is
+           warmed up before each batch (backends.VLLMBackend)
+
+The stages run unchanged in this process on a backends.StubEngine whose
+PrefixCacheSimulator plays the engine's prefix cache (16-token blocks,
+--num_gpu_blocks for a finite cache with LRU eviction), so no GPU is needed;
+replies are the ones recorded in outputs/<paper>/experiments/<exp>, as in
+bench_batching.py. Prefilled tokens are counted by the engine, warm-up
+requests included; prefill time is prefilled tokens at --prefill_tps.
+
+Usage:
+    python bench_prefix_caching.py --output_root ../outputs
+    python bench_prefix_caching.py --papers fit:../examples/fit.json --num_gpu_blocks 4000
+"""
+
+import argparse
+import contextlib
+import os
+import shutil
+import tempfile
+
+from backends import StubSamplingParams, register_engine
+from bench_batching import make_engine, STUB_MODEL, PLANNING_FILES
+from bench_prompt_cache import DEFAULT_PAPERS
+from run_local import run_stage
+
+CONFIGS = {
+    "off": (False, []),
+    "apc": (True, []),
+    "layout": (True, ["--prefix_caching"]),
+}
+
+
+def run_paper(paper_name, pdf_json_path, planning_dir, exp_dir, config, args, scratch_root):
+    """{stage: (prompt tokens, prefilled tokens, prefill seconds)} of one run of analyzing + coding."""
+    enable_prefix_caching, flags = CONFIGS[config]
+    engine, tokenizer = make_engine(exp_dir, args, enable_prefix_caching=enable_prefix_caching,
+                                    num_gpu_blocks=args.num_gpu_blocks)
+    register_engine(STUB_MODEL, engine, tokenizer, StubSamplingParams)
+    out_dir = tempfile.mkdtemp(prefix=f"{paper_name}_{config}_", dir=scratch_root)
+    for name in PLANNING_FILES:
+        src = os.path.join(planning_dir, name)
+        if os.path.exists(src):
+            shutil.copy(src, out_dir)
+    stage_args = ["--paper_name", paper_name, "--pdf_json_path", pdf_json_path, "--output_dir", out_dir,
+                  "--model_name", STUB_MODEL, "--backend", "vllm"] + flags
+    stages = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        for stage, script, extra in (("analyzing", "2_analyzing_llm.py", []),
+                                     ("coding", "3_coding_llm.py", ["--output_repo_dir", os.path.join(out_dir, "repo")])):
+            prefilled, prefill_seconds = engine.prefilled_tokens, engine.prefill_seconds
+            meter = run_stage(script, stage_args + extra)["meter"]
+            stages[stage] = (meter.prompt_tokens, engine.prefilled_tokens - prefilled,
+                             engine.prefill_seconds - prefill_seconds)
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_root', type=str, default="../outputs")
+    parser.add_argument('--papers', type=str, default=DEFAULT_PAPERS,
+                        help="Comma-separated paper_name:pdf_json_path pairs")
+    parser.add_argument('--experiment', type=str, default="llm_only_json",
+                        help="Recorded experiment whose replies the stub engine serves")
+    parser.add_argument('--num_gpu_blocks', type=int, default=None,
+                        help="KV blocks of the simulated prefix cache (default: unlimited)")
+    parser.add_argument('--prefill_tps', type=float, default=20_000)
+    parser.add_argument('--step_ms', type=float, default=4.0, help="Decode step of a single sequence")
+    parser.add_argument('--per_seq_ms', type=float, default=0.2, help="Extra decode step time per running sequence")
+    parser.add_argument('--time_scale', type=float, default=0.0, help="Fraction of the simulated time actually slept")
+    args = parser.parse_args()
+
+    scratch_root = tempfile.mkdtemp(prefix="prefix_caching_")
+    rows = []
+    for item in args.papers.split(","):
+        paper_name, pdf_json_path = item.strip().split(":", 1)
+        planning_dir = os.path.join(args.output_root, paper_name)
+        exp_dir = os.path.join(planning_dir, "experiments", args.experiment)
+        if not os.path.exists(os.path.join(planning_dir, "planning_trajectories.json")) \
+                or not os.path.exists(pdf_json_path):
+            print(f"[SKIP] {paper_name}: no planning output or paper json")
+            continue
+        results = {config: run_paper(paper_name, os.path.abspath(pdf_json_path), planning_dir, exp_dir, config,
+                                     args, scratch_root) for config in CONFIGS}
+        for stage in ("analyzing", "coding"):
+            rows.append((paper_name, stage, {config: results[config][stage] for config in CONFIGS}))
+    shutil.rmtree(scratch_root, ignore_errors=True)
+
+    cache_size = f"{args.num_gpu_blocks:,} blocks" if args.num_gpu_blocks else "unlimited"
+    print("\n" + "=" * 96)
+    print(f"Prefilled prompt tokens on the stub engine (prefix cache: {cache_size}, "
+          f"prefill {args.prefill_tps:,.0f} tok/s)")
+    print("=" * 96)
+    print(f"{'Paper':<12} {'Stage':<10} {'Prompt':>9} {'off':>9} {'apc':>9} {'layout':>9} "
+          f"{'Saved apc':>10} {'Saved layout':>13} {'Prefill s off/layout':>21}")
+    print("-" * 96)
+    for paper_name, stage, r in rows:
+        prompt_tokens, off, off_seconds = r["off"]
+        apc, layout, layout_seconds = r["apc"][1], r["layout"][1], r["layout"][2]
+        print(f"{paper_name:<12} {stage:<10} {prompt_tokens:>9,} {off:>9,} {apc:>9,} {layout:>9,} "
+              f"{1 - apc / off if off else 0:>10.1%} {1 - layout / off if off else 0:>13.1%} "
+              f"{f'{off_seconds:.1f} / {layout_seconds:.1f}':>21}")
+    print("=" * 96)
+
+
+if __name__ == "__main__":
+    main()
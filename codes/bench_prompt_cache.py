@@ -0,0 +1,242 @@
+"""
+bench_prompt_cache.py
+
+Estimates the fraction of prompt tokens a provider-side prompt cache can serve
+for the analyzing and coding stages, with the legacy prompt layout (stage
+system prompt first, planning context inside each per-file user message) and
+with the prompts.py layout (shared context first, per-file delta last).
+
+The request sequences are rebuilt from existing outputs: the task list, the
+recorded revisions and critiques in debug_revisions, and the generated repo.
+The provider cache is simulated the way OpenAI documents it: the longest
+prefix shared with an earlier completed request is served from cache in
+128-token blocks once it reaches 1024 tokens. Tokens are approximated as 4
+characters. Requests issued at the same time (--concurrency) cannot hit each
+other.
+
+Usage:
+    python bench_prompt_cache.py --output_root ../outputs --experiment multi_signal_json --concurrency 4
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+
+from prompts import PromptLayout
+from utils import extract_planning, content_to_json
+
+CODES_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PAPERS = ("transformer:../examples/Transformer_cleaned.json,vdc:../examples/vdc.json,"
+                  "curbench:../examples/curbench.json,gem:../examples/gem.json,fit:../examples/fit.json")
+
+CHARS_PER_TOKEN = 4
+CACHE_BLOCK = 128
+CACHE_MIN = 1024
+
+
+def load_stage_prompt(script, name):
+    """The stage prompt exactly as the stage script defines it."""
+    with open(os.path.join(CODES_DIR, script), encoding="utf-8") as f:
+        source = f.read()
+    text = re.search(name + r' = f"""(.*?)"""', source, re.S).group(1)
+    return text.replace("{paper_format}", "JSON").replace('\\"', '"')
+
+
+def render(messages):
+    return "".join(f"<|{m['role']}|>{m['content']}<|end|>" for m in messages)
+
+
+def common_prefix_len(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+class PrefixCacheSim:
+    def __init__(self):
+        self.seen = []
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def issue(self, wave):
+        """Sends a group of simultaneous requests (rendered prompts)."""
+        for text in wave:
+            tokens = len(text) // CHARS_PER_TOKEN
+            shared = max((common_prefix_len(text, t) for t in self.seen), default=0) // CHARS_PER_TOKEN
+            cached = shared // CACHE_BLOCK * CACHE_BLOCK if shared >= CACHE_MIN else 0
+            self.prompt_tokens += tokens
+            self.cached_tokens += min(cached, tokens)
+        self.seen.extend(wave)
+
+    def fraction(self):
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+
+def run_waves(sim, per_file_requests, concurrency, warm_first):
+    """Files run `concurrency` at a time; each file's requests are sequential."""
+    queues = [list(reqs) for reqs in per_file_requests if reqs]
+    if warm_first and queues:
+        sim.issue([queues[0].pop(0)])
+    for start in range(0, len(queues), concurrency):
+        group = queues[start:start + concurrency]
+        while any(group):
+            sim.issue([q.pop(0) for q in group if q])
+
+
+def build_requests(paper_content, planning_dir, exp_dir, repo_dir, exp_name):
+    with open(os.path.join(planning_dir, "planning_config.yaml")) as f:
+        config_yaml = f.read()
+    context_lst = extract_planning(os.path.join(planning_dir, "planning_trajectories.json"))
+    task_list = content_to_json(context_lst[2])
+    todo_file_lst = [fn for fn in task_list.get("Task list", []) if fn != "config.yaml"]
+    logic_analysis_dict = {desc[0]: desc[1] for desc in task_list.get("Logic Analysis", [])}
+
+    layout = PromptLayout(paper_content, context_lst, config_yaml)
+    analysis_prompt = load_stage_prompt("2_analyzing_experiments.py", "analysis_prompt")
+    coding_prompt = load_stage_prompt("3_coding.py", "coding_prompt")
+
+    def legacy(stage_prompt, delta, with_heading):
+        context = layout.shared_context if with_heading else layout.shared_context[len("# Context\n"):]
+        return [{"role": "system", "content": stage_prompt}, {"role": "user", "content": f"{context}\n{delta}"}]
+
+    requests = {"legacy": {"analyzing": [], "coding": []}, "prefix": {"analyzing": [], "coding": []}}
+    debug_dir = os.path.join(exp_dir, "analyzing_artifacts", "debug_revisions")
+    for todo_file_name in todo_file_lst:
+        desc = logic_analysis_dict.get(todo_file_name, "")
+        draft_desc = f"Write the logic analysis in '{todo_file_name}', which is intended for '{desc}'."
+        if len(desc.strip()) == 0:
+            draft_desc = f"Write the logic analysis in '{todo_file_name}'."
+        delta = f"""## Instruction
+Conduct a Logic Analysis to assist in writing the code, based on the paper, the plan, the design, the task and the previously specified configuration file (config.yaml).
+You DON'T need to provide the actual code yet; focus on a thorough, clear analysis.
+
+{draft_desc}
+
+-----
+
+## Logic Analysis: {todo_file_name}"""
+        feedback = []
+        safe_name = todo_file_name.replace("/", "_")
+        iteration = 1
+        while os.path.exists(os.path.join(debug_dir, f"{safe_name}_rev{iteration + 1}_{exp_name}.txt")):
+            with open(os.path.join(debug_dir, f"{safe_name}_rev{iteration}_{exp_name}.txt"), encoding="utf-8") as f:
+                analysis_text = f.read()
+            with open(os.path.join(debug_dir, f"{safe_name}_rev{iteration}_{exp_name}_critiques.json")) as f:
+                hi_med = json.load(f).get("high_medium", [])
+            feedback.append([
+                {"role": "assistant", "content": analysis_text},
+                {"role": "user", "content": (f"The following critiques were raised for `{todo_file_name}`:\n\n"
+                                             f"{json.dumps(hi_med, indent=2)}\n\n"
+                                             "Please revise the analysis to address these critiques.")},
+            ])
+            iteration += 1
+
+        for name, base in (("legacy", legacy(analysis_prompt, delta, with_heading=False)),
+                           ("prefix", layout.messages(analysis_prompt, delta))):
+            file_requests, msgs = [render(base)], list(base)
+            for turn in feedback:
+                msgs = msgs + turn
+                file_requests.append(render(msgs))
+            requests[name]["analyzing"].append(file_requests)
+
+    done_file_lst, code_files = ["config.yaml"], ""
+    for todo_file_name in todo_file_lst:
+        path = os.path.join(repo_dir, todo_file_name)
+        if not os.path.exists(path):
+            break
+        with open(os.path.join(exp_dir, f"{todo_file_name.replace('/', '_')}_simple_analysis_response.json")) as f:
+            detailed_logic_analysis = json.load(f)[0].get("text", "")
+        delta = f"""## Code Files
+{code_files}
+
+-----
+
+# Format example
+## Code: {todo_file_name}
+```python
+## {todo_file_name}
+...
+```
+
+-----
+
+# Instruction
+Based on the paper, plan, design, task and configuration file(config.yaml) specified previously, follow "Format example", write the code. 
+
+We have {done_file_lst}.
+Next, you must write only the "{todo_file_name}".
+1. Only One file: do your best to implement THIS ONLY ONE FILE.
+2. COMPLETE CODE: Your code will be part of the entire project, so please implement complete, reliable, reusable code snippets.
+3. Set default value: If there is any setting, ALWAYS SET A DEFAULT VALUE, ALWAYS USE STRONG TYPE AND EXPLICIT VARIABLE. AVOID circular import.
+4. Follow design: YOU MUST FOLLOW "Data structures and interfaces". DONT CHANGE ANY DESIGN. Do not use public member functions that do not exist in your design.
+5. CAREFULLY CHECK THAT YOU DONT MISS ANY NECESSARY CLASS/FUNCTION IN THIS FILE.
+6. Before using a external variable/module, make sure you import it first.
+7. Write out EVERY CODE DETAIL, DON'T LEAVE TODO.
+8. REFER TO CONFIGURATION: you must use configuration from "config.yaml". DO NOT FABRICATE any configuration values.
+
+{detailed_logic_analysis}
+
+## Code: {todo_file_name}"""
+        requests["legacy"]["coding"].append([render(legacy(coding_prompt, delta, with_heading=True))])
+        requests["prefix"]["coding"].append([render(layout.messages(coding_prompt, delta))])
+        with open(path, encoding="utf-8") as f:
+            code_files += f"\n```python\n{f.read()}\n```\n\n"
+        done_file_lst.append(todo_file_name)
+    return requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_root', type=str, default="../outputs")
+    parser.add_argument('--papers', type=str, default=DEFAULT_PAPERS,
+                        help="Comma-separated paper_name:pdf_json_path pairs")
+    parser.add_argument('--experiment', type=str, default="multi_signal_json")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="Files analyzed at once (as 2_analyzing_experiments.py --concurrency)")
+    args = parser.parse_args()
+
+    rows = []
+    for item in args.papers.split(","):
+        paper_name, pdf_json_path = item.strip().split(":", 1)
+        planning_dir = os.path.join(args.output_root, paper_name)
+        exp_dir = os.path.join(planning_dir, "experiments", args.experiment)
+        repo_dirs = glob.glob(os.path.join(exp_dir, "*_repo"))
+        if not os.path.exists(pdf_json_path) or not os.path.isdir(exp_dir) or not repo_dirs:
+            print(f"[SKIP] {paper_name}: missing paper json or {exp_dir}")
+            continue
+        with open(pdf_json_path) as f:
+            paper_content = json.load(f)
+
+        requests = build_requests(paper_content, planning_dir, exp_dir, repo_dirs[0], args.experiment)
+        for layout_name, warm_first in (("legacy", False), ("prefix", True)):
+            # one simulated cache per paper: coding runs while the analyzing prefix is still warm
+            sim, stage_stats = PrefixCacheSim(), {}
+            for stage, concurrency in (("analyzing", args.concurrency), ("coding", 1)):
+                before = (sim.prompt_tokens, sim.cached_tokens)
+                run_waves(sim, requests[layout_name][stage], concurrency, warm_first)
+                prompt_tokens = sim.prompt_tokens - before[0]
+                cached = sim.cached_tokens - before[1]
+                stage_stats[stage] = cached / prompt_tokens if prompt_tokens else 0.0
+            rows.append((paper_name, layout_name, stage_stats["analyzing"], stage_stats["coding"],
+                         sim.fraction(), sim.prompt_tokens))
+
+    print("\n" + "=" * 78)
+    print(f"Cached-token fraction (experiment={args.experiment}, concurrency={args.concurrency})")
+    print("=" * 78)
+    print(f"{'Paper':<14} {'Layout':<8} {'Analyzing':>10} {'Coding':>10} {'Overall':>10} {'Prompt tok':>12}")
+    print("-" * 78)
+    for paper_name, layout_name, analyzing, coding, overall, prompt_tokens in rows:
+        print(f"{paper_name:<14} {layout_name:<8} {analyzing:>10.1%} {coding:>10.1%} {overall:>10.1%} "
+              f"{prompt_tokens:>12,}")
+    print("=" * 78)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+bench_replay.py
+
+Re-runs recorded experiments offline (2_analyzing_experiments.py
+--replay_from) across all papers, so a change to get_critiques,
+merge_critiques or the stopping rule can be compared in seconds without API
+calls.
+
+For each paper and recorded experiment the stage runs into a scratch
+directory with the recorded planning files, once per --stop_policy value,
+and the summaries are tabulated: iterations run, estimated tokens, which
+rule stopped each file and the mean weighted severity of the critiques
+left on the final revisions. --mode overrides the recorded mode, e.g.
+replaying LLM-only runs as multi_signal to see what the static channels add.
+
+Usage:
+    python bench_replay.py --output_root ../outputs --experiments llm_only_json,multi_signal_json \\
+        --policies ";no_improvement;jaccard:0.5"
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_prompt_cache import DEFAULT_PAPERS
+from stopping import weighted_severity
+
+CODES_DIR = os.path.dirname(os.path.abspath(__file__))
+PLANNING_FILES = ("planning_config.yaml", "planning_trajectories.json", "planning_response.json", "task_list.json")
+
+
+def replay_run(paper_name, pdf_json_path, planning_dir, exp_dir, exp_name, mode, stop_policy, scratch_root):
+    """Runs one replay; returns (summary, final severities, seconds) or None on failure."""
+    recorded_mode, feedback_format = exp_name.rsplit("_", 1)
+    mode = mode or recorded_mode
+    out_dir = tempfile.mkdtemp(prefix=f"{paper_name}_{exp_name}_", dir=scratch_root)
+    for name in PLANNING_FILES:
+        src = os.path.join(exp_dir, name) if os.path.exists(os.path.join(exp_dir, name)) \
+            else os.path.join(planning_dir, name)
+        if os.path.exists(src):
+            shutil.copy(src, out_dir)
+    repo_dirs = glob.glob(os.path.join(exp_dir, "*_repo"))
+
+    cmd = [sys.executable, os.path.join(CODES_DIR, "2_analyzing_experiments.py"),
+           "--paper_name", paper_name, "--pdf_json_path", pdf_json_path, "--output_dir", out_dir,
+           "--mode", mode, "--feedback_format", feedback_format, "--replay_from", exp_dir,
+           "--replay_tag", exp_name, "--stop_policy", stop_policy, "--cache_mode", "off"]
+    if repo_dirs:
+        cmd += ["--output_repo_dir", repo_dirs[0]]
+    start = time.time()
+    r = subprocess.run(cmd, capture_output=True, text=True, cwd=CODES_DIR,
+                       env={**os.environ, "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "replay")})
+    seconds = time.time() - start
+    summary_path = os.path.join(out_dir, f"experiment_summary_{mode}_{feedback_format}.json")
+    if r.returncode != 0 or not os.path.exists(summary_path):
+        print(f"[FAIL] {paper_name}/{exp_name} ({stop_policy or 'default'}):\n{r.stdout[-1500:]}{r.stderr[-1500:]}")
+        return None
+    with open(summary_path, encoding="utf-8") as f:
+        summary = json.load(f)
+    severities = []
+    debug_dir = os.path.join(out_dir, "analyzing_artifacts", "debug_revisions")
+    for todo_file_name, iter_logs in summary["per_file_iterations"].items():
+        if not iter_logs:
+            continue
+        path = os.path.join(debug_dir, f"{todo_file_name.replace('/', '_')}_rev{iter_logs[-1]['iteration']}_"
+                                       f"{mode}_{feedback_format}_critiques.json")
+        with open(path, encoding="utf-8") as f:
+            severities.append(weighted_severity(json.load(f).get("high_medium", [])))
+    return summary, severities, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_root', type=str, default="../outputs")
+    parser.add_argument('--papers', type=str, default=DEFAULT_PAPERS,
+                        help="Comma-separated paper_name:pdf_json_path pairs")
+    parser.add_argument('--experiments', type=str, default="llm_only_json,llm_only_freetext,multi_signal_json,"
+                                                           "static_only_json")
+    parser.add_argument('--mode', type=str, default="", choices=["", "llm_only", "static_only", "multi_signal"],
+                        help="Replay every run in this mode instead of the recorded one")
+    parser.add_argument('--policies', type=str, default=";no_improvement",
+                        help="';'-separated --stop_policy values ('' = the default rule)")
+    parser.add_argument('--keep', action="store_true", help="Keep the scratch output directories")
+    args = parser.parse_args()
+
+    scratch_root = tempfile.mkdtemp(prefix="replay_")
+    rows = []
+    total_start = time.time()
+    for item in args.papers.split(","):
+        paper_name, pdf_json_path = item.strip().split(":", 1)
+        planning_dir = os.path.join(args.output_root, paper_name)
+        for exp_name in args.experiments.split(","):
+            exp_dir = os.path.join(planning_dir, "experiments", exp_name)
+            if not os.path.exists(os.path.join(exp_dir, f"experiment_summary_{exp_name}.json")) \
+                    or not os.path.exists(pdf_json_path):
+                print(f"[SKIP] {paper_name}/{exp_name}: no recorded run or paper json")
+                continue
+            for stop_policy in args.policies.split(";"):
+                result = replay_run(paper_name, pdf_json_path, planning_dir, exp_dir, exp_name, args.mode,
+                                    stop_policy.strip(), scratch_root)
+                if result is not None:
+                    rows.append((paper_name, exp_name, stop_policy.strip() or "(default)") + result)
+    total_seconds = time.time() - total_start
+    if args.keep:
+        print(f"Replay outputs kept under {scratch_root}")
+    else:
+        shutil.rmtree(scratch_root, ignore_errors=True)
+
+    print("\n" + "=" * 100)
+    print(f"Offline replay{' as ' + args.mode if args.mode else ''}: {len(rows)} runs in {total_seconds:.1f}s")
+    print("=" * 100)
+    print(f"{'Paper':<12} {'Experiment':<18} {'Policy':<22} {'Iters':>6} {'Tokens(est)':>12} {'sev':>6} "
+          f"{'Time':>6}  Stopped by")
+    print("-" * 100)
+    for paper_name, exp_name, policy, summary, severities, seconds in rows:
+        stopped = {}
+        for rule in summary.get("stopped_by", {}).values():
+            stopped[rule] = stopped.get(rule, 0) + 1
+        iters = sum(len(logs) for logs in summary["per_file_iterations"].values())
+        sev = sum(severities) / len(severities) if severities else 0.0
+        print(f"{paper_name:<12} {exp_name:<18} {policy:<22} {iters:>6} {summary['total_tokens']:>12,} "
+              f"{sev:>6.2f} {seconds:>5.1f}s  {', '.join(f'{k}={v}' for k, v in sorted(stopped.items()))}")
+    print("=" * 100)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+bench_static_analysis.py
+
+Compares the per-call static analysis of 2_analyzing_experiments.py (ast_check
++ `python -m pylint` + import_probe, one subprocess each, for every file at
+every feedback iteration) with StaticAnalysisEngine (process pool, warm pylint,
+content-hash cache) over the generated repos in outputs/*/experiments/*/*_repo,
+and the import probe alone: one interpreter per probe versus forks of the warm
+probe_server.py.
+
+Every repo file is checked --iterations times, as in a run with
+MAX_FEEDBACK_ITERATIONS feedback iterations. The engine's critiques are
+compared with the baseline's.
+
+Usage:
+    python bench_static_analysis.py --output_root ../outputs --iterations 3 --max_repos 4
+"""
+
+import argparse
+import glob
+import os
+import tempfile
+import time
+
+from probe_server import DEFAULT_PRELOAD, ProbeService
+from static_analysis import StaticAnalysisEngine, ast_check, pylint_check, import_probe, merge_critiques, \
+    _probe_critiques
+
+
+def baseline(filepath, project_root):
+    return merge_critiques(ast_check(filepath), pylint_check(filepath), import_probe(filepath, project_root=project_root))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_root', type=str, default="../outputs")
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--max_repos', type=int, default=0, help="0 = all repos")
+    parser.add_argument('--workers', type=int, default=0, help="0 = one per CPU")
+    parser.add_argument('--probe_preload', type=str, default=DEFAULT_PRELOAD)
+    args = parser.parse_args()
+
+    repos = sorted(glob.glob(os.path.join(args.output_root, "*", "experiments", "*", "*_repo")))
+    if args.max_repos:
+        repos = repos[:args.max_repos]
+    jobs = [(fp, repo) for repo in repos for fp in sorted(glob.glob(os.path.join(repo, "**", "*.py"), recursive=True))]
+    print(f"{len(repos)} repos, {len(jobs)} files, {args.iterations} iterations")
+
+    # import probe alone
+    start = time.time()
+    cold_probes = {fp: import_probe(fp, project_root=repo) for fp, repo in jobs}
+    cold_probe_time = time.time() - start
+    service = ProbeService(args.probe_preload)
+    start = time.time()
+    warm_probes = {fp: _probe_critiques(fp, service.probe(os.path.abspath(fp), repo), 15) for fp, repo in jobs}
+    warm_probe_time = time.time() - start
+    service.close()
+    probe_mismatches = [fp for fp in cold_probes if cold_probes[fp] != warm_probes[fp]]
+
+    start = time.time()
+    expected = {}
+    for _ in range(args.iterations):
+        for fp, repo in jobs:
+            expected[fp] = baseline(fp, repo)
+    baseline_time = time.time() - start
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        engine = StaticAnalysisEngine(args.workers or None, cache_dir, args.probe_preload)
+        start = time.time()
+        for _ in range(args.iterations):
+            results = {}
+            for repo in repos:
+                results.update(engine.check_many([fp for fp, r in jobs if r == repo], project_root=repo))
+        engine_time = time.time() - start
+        engine.close()
+
+        # a second engine on the same cache: another experiment over the same repos
+        warm = StaticAnalysisEngine(args.workers or None, cache_dir)
+        start = time.time()
+        for repo in repos:
+            warm.check_many([fp for fp, r in jobs if r == repo], project_root=repo)
+        warm_time = time.time() - start
+        warm.close()
+
+    key = lambda c: (c.get("target_func_name"), c.get("severity_level"), c.get("critique"), c.get("source"))
+    mismatches = [fp for fp in expected if sorted(map(key, expected[fp])) != sorted(map(key, results[fp]))]
+
+    print("\n" + "=" * 60)
+    print(f"{'Import probe, interpreter per probe':<36} {cold_probe_time:>9.1f}s")
+    print(f"{'Import probe, warm server':<36} {warm_probe_time:>9.1f}s  "
+          f"(preloaded: {', '.join(service.preloaded) or 'nothing'}; differing: {len(probe_mismatches)})")
+    print(f"{'Baseline (subprocess per call)':<36} {baseline_time:>9.1f}s")
+    print(f"{'Engine (pool + warm pylint + cache)':<36} {engine_time:>9.1f}s  ({baseline_time / max(engine_time, 1e-9):.1f}x)")
+    print(f"{'Engine, warm disk cache':<36} {warm_time:>9.1f}s")
+    print(f"Cache: {engine.misses} checked, {engine.hits} hits; files with differing critiques: {len(mismatches)}")
+    for fp in mismatches[:10]:
+        print(f"  {fp}")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+bench_stopping.py
+
+Replays the feedback loops recorded in outputs/<paper>/experiments/<exp>/
+analyzing_artifacts/debug_revisions under stopping.py policies, and
+estimates the tokens each policy set would have saved.
+
+Every recorded iteration is fed to a StopController as the live loop does;
+when a policy fires before the last recorded iteration, the remaining
+iterations count as saved. Iteration costs are rebuilt from the recorded
+requests (bench_prompt_cache.build_requests, legacy layout: the runs predate
+prompts.py), the revision as completion and, for the LLM-judge modes, the
+judge call; tokens are approximated as 4 characters. The estimate is then
+scaled to the run's recorded total_tokens, so "saved" is in real tokens.
+
+"sev" is the mean weighted severity (stopping.SEVERITY_WEIGHTS) of the open
+critiques on the revision each file ends with: what stopping early gives up.
+
+Usage:
+    python bench_stopping.py --output_root ../outputs
+    python bench_stopping.py --policies "no_improvement;jaccard:0.5;no_improvement,token_budget:80000"
+"""
+
+import argparse
+import glob
+import json
+import os
+
+from bench_prompt_cache import DEFAULT_PAPERS, CHARS_PER_TOKEN, build_requests
+from stopping import StopController, weighted_severity
+
+DEFAULT_POLICIES = "no_improvement;jaccard:0.5;jaccard:0.8;token_budget:80000;no_improvement,jaccard:0.5"
+JUDGE_TEMPLATE_TOKENS = 350  # judge system prompt + rubric around the analysis
+
+
+def replay_file(records, controller):
+    """records: [{"critiques", "tokens"}] per recorded iteration -> (iterations kept, fired rule)."""
+    history = []
+    for record in records:
+        history.append(record)
+        fired = controller.check(history)
+        if fired is not None:
+            return len(history), fired
+    return len(history), None
+
+
+def load_run(paper_content, planning_dir, exp_dir, exp_name):
+    """{file: [{"critiques", "tokens"}]} with estimated per-iteration tokens, and the run's summary."""
+    summary_path = os.path.join(exp_dir, f"experiment_summary_{exp_name}.json")
+    with open(summary_path, encoding="utf-8") as f:
+        summary = json.load(f)
+    repo_dirs = glob.glob(os.path.join(exp_dir, "*_repo"))
+    requests = build_requests(paper_content, planning_dir, exp_dir, repo_dirs[0] if repo_dirs else exp_dir,
+                              exp_name)["legacy"]["analyzing"]
+    judged = summary.get("mode") in ("llm_only", "multi_signal")
+    debug_dir = os.path.join(exp_dir, "analyzing_artifacts", "debug_revisions")
+
+    runs = {}
+    for (todo_file_name, iter_logs), file_requests in zip(summary["per_file_iterations"].items(), requests):
+        safe_name = todo_file_name.replace("/", "_")
+        records = []
+        for iter_log, request in zip(iter_logs, file_requests):
+            prefix = os.path.join(debug_dir, f"{safe_name}_rev{iter_log['iteration']}_{exp_name}")
+            if not os.path.exists(prefix + "_critiques.json"):
+                break
+            with open(prefix + ".txt", encoding="utf-8") as f:
+                revision_tokens = len(f.read()) // CHARS_PER_TOKEN
+            with open(prefix + "_critiques.json", encoding="utf-8") as f:
+                critiques = json.load(f)
+            tokens = iter_log.get("tokens")
+            if tokens is None:
+                tokens = len(request) // CHARS_PER_TOKEN + revision_tokens
+                if judged:
+                    tokens += JUDGE_TEMPLATE_TOKENS + revision_tokens \
+                        + len(json.dumps(critiques.get("all", []))) // CHARS_PER_TOKEN
+            records.append({"critiques": critiques.get("high_medium", []), "tokens": tokens})
+        runs[todo_file_name] = records
+    return runs, summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_root', type=str, default="../outputs")
+    parser.add_argument('--papers', type=str, default=DEFAULT_PAPERS,
+                        help="Comma-separated paper_name:pdf_json_path pairs")
+    parser.add_argument('--experiments', type=str, default="llm_only_json,llm_only_freetext,multi_signal_json,"
+                                                           "static_only_json")
+    parser.add_argument('--policies', type=str, default=DEFAULT_POLICIES,
+                        help="';'-separated --stop_policy values to compare")
+    parser.add_argument('--max_iterations', type=int, default=3)
+    args = parser.parse_args()
+
+    runs = []
+    for item in args.papers.split(","):
+        paper_name, pdf_json_path = item.strip().split(":", 1)
+        planning_dir = os.path.join(args.output_root, paper_name)
+        if not os.path.exists(pdf_json_path):
+            print(f"[SKIP] {paper_name}: missing {pdf_json_path}")
+            continue
+        with open(pdf_json_path) as f:
+            paper_content = json.load(f)
+        for exp_name in args.experiments.split(","):
+            exp_dir = os.path.join(planning_dir, "experiments", exp_name)
+            if not os.path.exists(os.path.join(exp_dir, f"experiment_summary_{exp_name}.json")):
+                print(f"[SKIP] {paper_name}/{exp_name}: no experiment summary")
+                continue
+            records, summary = load_run(paper_content, planning_dir, exp_dir, exp_name)
+            estimated = sum(r["tokens"] for recs in records.values() for r in recs)
+            scale = summary.get("total_tokens", estimated) / estimated if estimated else 1.0
+            runs.append((paper_name, exp_name, records, scale))
+
+    print("\n" + "=" * 96)
+    print(f"Stopping-policy replay over {len(runs)} recorded runs (max_iterations={args.max_iterations})")
+    print("=" * 96)
+    print(f"{'Policy':<34} {'Exp':<18} {'Iters':>9} {'Tokens':>11} {'Saved':>11} {'%':>6} {'sev':>11}  Fired")
+    print("-" * 96)
+    for spec in [""] + [s for s in args.policies.split(";") if s.strip()]:
+        controller = StopController(spec, args.max_iterations)
+        by_exp = {}
+        for paper_name, exp_name, records, scale in runs:
+            row = by_exp.setdefault(exp_name, {"iters": 0, "orig_iters": 0, "tokens": 0.0, "saved": 0.0,
+                                               "sev": 0.0, "orig_sev": 0.0, "files": 0, "fired": {}})
+            for file_records in records.values():
+                if not file_records:
+                    continue
+                kept, fired = replay_file(file_records, controller)
+                row["iters"] += kept
+                row["orig_iters"] += len(file_records)
+                row["tokens"] += scale * sum(r["tokens"] for r in file_records)
+                row["saved"] += scale * sum(r["tokens"] for r in file_records[kept:])
+                row["sev"] += weighted_severity(file_records[kept - 1]["critiques"])
+                row["orig_sev"] += weighted_severity(file_records[-1]["critiques"])
+                row["files"] += 1
+                row["fired"][fired or "end"] = row["fired"].get(fired or "end", 0) + 1
+        for exp_name, row in by_exp.items():
+            fired = ", ".join(f"{k}={v}" for k, v in sorted(row["fired"].items()))
+            sev = f"{row['sev'] / row['files']:.2f}/{row['orig_sev'] / row['files']:.2f}"
+            print(f"{spec or '(default)':<34} {exp_name:<18} {row['iters']:>4}/{row['orig_iters']:<4} "
+                  f"{row['tokens']:>11,.0f} {row['saved']:>11,.0f} {row['saved'] / row['tokens']:>6.1%} "
+                  f"{sev:>11}  {fired}")
+        print("-" * 96)
+    print("Iters: iterations kept / recorded. sev: mean final weighted severity, replayed / recorded.")
+    print("=" * 96)
+
+
+if __name__ == "__main__":
+    main()
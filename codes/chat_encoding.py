@@ -0,0 +1,181 @@
+"""
+chat_encoding.py
+
+Incremental chat-template encoding for the local (vLLM) backend.
+
+tokenizer.apply_chat_template(messages) renders and tokenizes the whole
+conversation on every call. The planning conversation grows by one turn per
+call, and every analyzing and coding prompt repeats the same paper and
+planning context, so nearly all of that tokenization is repeated work.
+IncrementalChatEncoder renders the template to text and tokenizes it in
+segments, keeping the token ids of every segment-ending prefix it has seen:
+
+  - after each message (the rendering of messages[:i])
+  - after each shared prefix a stage registered with add_anchor (the
+    planning context the analyzing and coding prompts all contain)
+
+A new prompt starts from the longest prefix already encoded and only the rest
+is tokenized. Segments end right after a newline that is followed by
+non-whitespace, where the pre-tokenizers of the usual BPE tokenizers split
+anyway, so joining segment ids gives the same ids as encoding the whole text.
+That is an assumption about the tokenizer and the chat template, so it is
+checked: by default the first prompt that reuses a prefix is also encoded in
+full and compared ("first"); "always" compares every prompt; on a mismatch
+the encoder reports it and encodes everything in full from then on.
+
+Usage (compares the two encodings over recorded planning/analyzing/coding prompts):
+    python chat_encoding.py --output_dir ../outputs/fit --tokenizer deepseek-ai/DeepSeek-Coder-V2-Lite-Instruct
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+CHECK_MODES = ["off", "first", "always"]
+MAX_PREFIXES = 256  # encoded prefixes kept (least recently used dropped first)
+
+
+def segment_end(text, end):
+    """The last position <= end that follows a newline and precedes non-whitespace (0 if there is none)."""
+    i = text.rfind("\n", 0, end)
+    while i >= 0 and (i + 1 >= len(text) or text[i + 1].isspace()):
+        i = text.rfind("\n", 0, i)
+    return i + 1
+
+
+class IncrementalChatEncoder:
+    """apply_chat_template(messages, add_generation_prompt) token ids, reusing already encoded prefixes."""
+
+    def __init__(self, tokenizer, check="first"):
+        self.tokenizer = tokenizer
+        self.check = check
+        self.checked = False
+        self.incremental = True
+        self.anchors = []
+        self.prefixes = OrderedDict()  # digest of a prefix text -> its token ids
+        self.encoded_tokens = 0
+        self.reused_tokens = 0
+
+    def add_anchor(self, text):
+        """Marks `text` as a prefix segment many prompts contain (e.g. the shared planning context)."""
+        if text and text not in self.anchors:
+            self.anchors.append(text)
+
+    def render(self, messages, add_generation_prompt):
+        return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+
+    def encode_text(self, text):
+        # the rendered template carries its own special tokens
+        try:
+            return self.tokenizer.encode(text, add_special_tokens=False)
+        except TypeError:
+            return self.tokenizer.encode(text)
+
+    def segment_ends(self, messages, text):
+        ends = set()
+        for i in range(1, len(messages) + 1):
+            prefix = self.render(messages[:i], False)
+            if text.startswith(prefix):
+                ends.add(segment_end(text, len(prefix)))
+        for anchor in self.anchors:
+            at = text.find(anchor)
+            if at >= 0:
+                ends.add(segment_end(text, at + len(anchor)))
+        return sorted(end for end in ends if 0 < end < len(text))
+
+    def encode(self, messages, add_generation_prompt=True):
+        text = self.render(messages, add_generation_prompt)
+        if not self.incremental:
+            return self.encode_text(text)
+
+        ends = self.segment_ends(messages, text)
+        start, token_ids = 0, []
+        for end in reversed(ends):
+            cached = self.prefixes.get(_digest(text[:end]))
+            if cached is not None:
+                self.prefixes.move_to_end(_digest(text[:end]))
+                start, token_ids = end, list(cached)
+                break
+        reused = len(token_ids)
+        for end in ends + [len(text)]:
+            if end <= start:
+                continue
+            token_ids += self.encode_text(text[start:end])
+            start = end
+            if end < len(text):
+                self.remember(text[:end], token_ids)
+        self.reused_tokens += reused
+        self.encoded_tokens += len(token_ids) - reused
+
+        if reused and (self.check == "always" or (self.check == "first" and not self.checked)):
+            self.checked = True
+            full_ids = self.encode_text(text)
+            if full_ids != token_ids:
+                print(f"[ENCODE] incremental chat-template encoding differs from full encoding "
+                      f"({len(token_ids)} vs {len(full_ids)} tokens); encoding every prompt in full from now on")
+                self.incremental = False
+                self.prefixes.clear()
+                return full_ids
+        return token_ids
+
+    def remember(self, prefix_text, token_ids):
+        self.prefixes[_digest(prefix_text)] = tuple(token_ids)
+        self.prefixes.move_to_end(_digest(prefix_text))
+        while len(self.prefixes) > MAX_PREFIXES:
+            self.prefixes.popitem(last=False)
+
+
+def _digest(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def recorded_conversations(output_dir):
+    """Prompt message lists of a finished run: every planning turn, then every analyzing/coding request."""
+    conversations = []
+    path = os.path.join(output_dir, "planning_trajectories.json")
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            trajectories = json.load(f)
+        conversations += [trajectories[:i] for i, m in enumerate(trajectories) if m["role"] == "assistant"]
+    for path in sorted(glob.glob(os.path.join(output_dir, "*_simple_analysis_trajectories.json"))):
+        with open(path, encoding="utf-8") as f:
+            conversations.append([m for m in json.load(f) if m["role"] != "assistant"])
+    return conversations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--tokenizer', type=str, default="deepseek-ai/DeepSeek-Coder-V2-Lite-Instruct",
+                        help="Hugging Face tokenizer, or 'stub' for backends.StubTokenizer")
+    args = parser.parse_args()
+
+    if args.tokenizer == "stub":
+        from backends import StubTokenizer
+        tokenizer = StubTokenizer()
+    else:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+    conversations = recorded_conversations(args.output_dir)
+    start = time.time()
+    full = [tokenizer.apply_chat_template(m, add_generation_prompt=True) for m in conversations]
+    full_seconds = time.time() - start
+
+    encoder = IncrementalChatEncoder(tokenizer, check="off")
+    start = time.time()
+    incremental = [encoder.encode(m) for m in conversations]
+    incremental_seconds = time.time() - start
+
+    mismatches = sum(a != list(b) for a, b in zip(incremental, full))
+    print(f"{len(conversations)} prompts, {sum(map(len, full)):,} tokens: full {full_seconds:.2f}s, "
+          f"incremental {incremental_seconds:.2f}s ({encoder.reused_tokens:,} tokens reused), "
+          f"{mismatches} mismatching prompt(s)")
+
+
+if __name__ == "__main__":
+    main()
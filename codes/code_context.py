@@ -0,0 +1,203 @@
+"""
+code_context.py
+
+Dependency-aware "## Code Files" context for 3_coding.py (--code_context deps).
+
+By default every file written so far is inlined verbatim, so the last files of
+the task list (main.py) carry the whole repo. In deps mode the written files
+are parsed with `ast` into an import/call graph:
+
+  - a written file depends on the repo files it imports (absolute imports of
+    the repo layout, sibling imports and relative imports; third-party modules
+    never match) and on those it calls into through an imported package;
+  - the file about to be written depends on the written files its logic
+    analysis names (file name or an import of the module) and on the written
+    files whose edges already point at it.
+
+Direct dependencies of the file being written are sent in full; every other
+written file is reduced to a signature stub (imports, constants, classes with
+their bases and method signatures, docstrings). A file that does not parse is
+always sent in full.
+"""
+
+import ast
+import re
+
+def module_name(file_name):
+    """'pkg/model.py' -> 'pkg.model', 'pkg/__init__.py' -> 'pkg'."""
+    if not file_name.endswith(".py"):
+        return file_name
+    module = file_name[:-3].replace("/", ".")
+    return module[:-len(".__init__")] if module.endswith(".__init__") else module
+
+
+def _parse(source):
+    try:
+        return ast.parse(source)
+    except (SyntaxError, ValueError):
+        return None
+
+
+def _package(file_name):
+    """'pkg/model.py' and 'pkg/__init__.py' -> 'pkg'; '' for a top-level file."""
+    return file_name.rpartition("/")[0].replace("/", ".")
+
+
+def _imported_modules(tree, package=""):
+    """Absolute module names `tree` imports; relative imports are resolved against `package`."""
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                parts = package.split(".") if package else []
+                if node.level - 1 > len(parts):
+                    continue
+                base = ".".join(parts[:len(parts) - (node.level - 1)] + ([node.module] if node.module else []))
+            else:
+                base = node.module
+            if base:
+                modules.add(base)
+            # `from pkg import model` imports the module pkg.model
+            modules.update(f"{base}.{alias.name}" if base else alias.name for alias in node.names)
+    return modules
+
+
+def _called_modules(tree):
+    """Dotted prefixes of attribute calls (`pkg.model.build()` -> pkg.model, pkg)."""
+    prefixes = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            parts, value = [], node.func.value
+            while isinstance(value, ast.Attribute):
+                parts.append(value.attr)
+                value = value.value
+            if isinstance(value, ast.Name):
+                parts = [value.id] + parts[::-1]
+                prefixes.update(".".join(parts[:i]) for i in range(1, len(parts) + 1))
+    return prefixes
+
+
+class DependencyGraph:
+    """
+    Import/call graph over the files written so far (`{file name: source}`).
+    `pending` names files that are not written yet but can already be imported
+    (the file about to be written), so edges into them are recorded too.
+    """
+
+    def __init__(self, files, pending=()):
+        self.files = {fn: src for fn, src in files.items() if fn.endswith(".py")}
+        self.modules = {module_name(fn): fn for fn in [*self.files, *pending] if fn.endswith(".py")}
+        self.trees = {fn: _parse(src) for fn, src in self.files.items()}
+        self.edges = {fn: self._file_deps(fn) for fn in self.files}
+
+    def _resolve_module(self, module, package):
+        """
+        Repo file of an absolute module name: the module itself, or a sibling of
+        the importer (scripts run from their own directory). Third-party modules
+        that happen to share a file's name (torch.utils.data vs data.py) do not match.
+        """
+        for candidate in (module, f"{package}.{module}" if package else None):
+            if candidate in self.modules:
+                return self.modules[candidate]
+        return None
+
+    def _file_deps(self, file_name):
+        tree = self.trees[file_name]
+        if tree is None:
+            return set()
+        package = _package(file_name)
+        imported = _imported_modules(tree, package)
+        # `import pkg` + `pkg.model.build()` calls into pkg/model.py
+        roots = {m.split(".")[0] for m in imported}
+        called = {m for m in _called_modules(tree) if m.split(".")[0] in roots}
+        deps = {self._resolve_module(m, package) for m in imported | called}
+        deps.discard(None)
+        deps.discard(file_name)
+        return deps
+
+    def deps_of(self, file_name, analysis_text):
+        """
+        Direct dependencies of the (not yet written) `file_name`: written files
+        its analysis names (file name or an import of the module), plus the
+        written files whose graph edges point at it.
+        """
+        deps = {fn for fn, file_deps in self.edges.items() if file_name in file_deps}
+        for fn in self.files:
+            mod = re.escape(module_name(fn))
+            # bare module names ("model", "config") are too common in prose to count
+            if fn in analysis_text or re.search(rf"import\s+{mod}\b|from\s+{mod}\s+import", analysis_text):
+                deps.add(fn)
+        deps.discard(file_name)
+        return deps
+
+
+def _stub_function(node):
+    body = []
+    doc = ast.get_docstring(node, clean=False)
+    if doc is not None:
+        body.append(node.body[0])
+    body.append(ast.Expr(ast.Constant(Ellipsis)))
+    node.body = body
+    return node
+
+
+def signature_stub(source):
+    """Imports, constants, class/function signatures and docstrings of `source`; None if it does not parse."""
+    tree = _parse(source)
+    if tree is None:
+        return None
+    body = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            body.append(node)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            body.append(_stub_function(node))
+        elif isinstance(node, ast.ClassDef):
+            members = [n for n in node.body
+                       if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef, ast.AnnAssign))
+                       or (isinstance(n, ast.Assign) and len(ast.unparse(n)) <= 120)]
+            doc = [node.body[0]] if ast.get_docstring(node, clean=False) is not None else []
+            node.body = doc + [_stub_function(n) if not isinstance(n, (ast.Assign, ast.AnnAssign)) else n
+                               for n in members] or [ast.Expr(ast.Constant(Ellipsis))]
+            body.append(node)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)) and len(ast.unparse(node)) <= 120:
+            body.append(node)
+        elif isinstance(node, ast.Expr) and isinstance(getattr(node, "value", None), ast.Constant) \
+                and isinstance(node.value.value, str) and node is tree.body[0]:
+            body.append(node)
+    tree.body = body
+    return ast.unparse(tree)
+
+
+def build_code_context(todo_file_name, analysis_text, done_file_lst, done_file_dict):
+    """
+    Returns (code_files text, info) for `todo_file_name`; info lists the files
+    sent in full and as stubs.
+    """
+    written = {fn: done_file_dict[fn] for fn in done_file_lst if fn in done_file_dict and not fn.endswith(".yaml")}
+    graph = DependencyGraph(written, pending=[todo_file_name])
+    direct = graph.deps_of(todo_file_name, analysis_text)
+
+    code_files, full, stubbed = "", [], []
+    for fn in done_file_lst:
+        if fn not in written:
+            continue
+        source = written[fn]
+        stub = None if fn in direct or not fn.endswith(".py") else signature_stub(source)
+        if stub is None:
+            full.append(fn)
+            body = source
+        else:
+            stubbed.append(fn)
+            body = f"## {fn} (signatures only)\n{stub}"
+        code_files += f"""
+```python
+{body}
+```
+
+"""
+    info = {"full": full, "stubbed": stubbed,
+            "graph": {fn: sorted(deps) for fn, deps in graph.edges.items()}}
+    return code_files, info
@@ -0,0 +1,93 @@
+"""
+coding_dag.py
+
+File dependency DAG for 3_coding.py --max_parallel, built from the planning
+stage:
+
+  - "Logic Analysis": a file depends on the files its description names
+    (`model.py`, "imports/uses/depends on model") and on the files owning the
+    classes it mentions;
+  - "Data structures and interfaces": every class-diagram relation
+    (`A --> B`, `A *-- B`, `B <|-- A`, ...) makes the file owning A depend on
+    the file owning B.
+
+The planner writes the "Task list" in dependency order, so an edge that
+points to a later file is dropped; this keeps the graph acyclic and the
+serial order a valid schedule. Files are then grouped into waves (longest
+dependency chain first): every file of a wave only needs files of earlier
+waves and the wave can be generated concurrently.
+"""
+
+import re
+
+# (pattern, dependent side): group 1/2 are the classes left/right of the arrow
+CLASS_RELATIONS = [
+    (re.compile(r"^\s*(\w+)\s*(?:\"[^\"]*\"\s*)?<\|--\s*(?:\"[^\"]*\"\s*)?(\w+)"), 2),   # B <|-- A: A inherits B
+    (re.compile(r"^\s*(\w+)\s*(?:\"[^\"]*\"\s*)?(?:-->|\.\.>|\*--|o--|\.\.\|>|--\|>)\s*(?:\"[^\"]*\"\s*)?(\w+)"), 1),
+    (re.compile(r"^\s*(\w+)\s*(?:\"[^\"]*\"\s*)?(?:<--|<\.\.|--\*|--o)\s*(?:\"[^\"]*\"\s*)?(\w+)"), 2),
+]
+
+
+def snake_case(name):
+    return re.sub(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])", "_", name).lower()
+
+
+def file_stem(file_name):
+    return file_name.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+
+
+def class_owners(class_names, files, descriptions):
+    """Maps each class to the file that defines it, or None."""
+    owners = {}
+    for cls in class_names:
+        owner = next((fn for fn in files if file_stem(fn) == snake_case(cls)), None)
+        if owner is None:
+            owner = next((fn for fn in files if re.search(rf"\b{cls}\s+class\b|\bclass\s+{cls}\b",
+                                                          descriptions.get(fn, ""))), None)
+        if owner is None:
+            owner = next((fn for fn in files if re.search(rf"^\W*{cls}\b", descriptions.get(fn, ""))), None)
+        owners[cls] = owner
+    return owners
+
+
+def build_coding_dag(todo_file_lst, logic_analysis_dict, class_diagram=""):
+    """Returns {file: set of files it depends on} over `todo_file_lst`."""
+    files = list(todo_file_lst)
+    order = {fn: idx for idx, fn in enumerate(files)}
+    class_names = re.findall(r"^\s*class\s+(\w+)", class_diagram, re.M)
+    owners = class_owners(class_names, files, logic_analysis_dict)
+    deps = {fn: set() for fn in files}
+
+    for fn in files:
+        desc = logic_analysis_dict.get(fn, "")
+        for other in files:
+            stem = re.escape(file_stem(other))
+            if other in desc or re.search(rf"\b(?:import|imports|from|uses|use|depends on|calls)\s+(?:the\s+)?"
+                                          rf"`?{stem}\b", desc, re.I):
+                deps[fn].add(other)
+        for cls, owner in owners.items():
+            if owner is not None and re.search(rf"\b{cls}\b", desc):
+                deps[fn].add(owner)
+
+    for line in class_diagram.splitlines():
+        for pattern, dependent in CLASS_RELATIONS:
+            m = pattern.match(line)
+            if m is None:
+                continue
+            user, used = (m.group(1), m.group(2)) if dependent == 1 else (m.group(2), m.group(1))
+            if owners.get(user) and owners.get(used):
+                deps[owners[user]].add(owners[used])
+            break
+
+    return {fn: {d for d in ds if order[d] < order[fn]} for fn, ds in deps.items()}
+
+
+def topological_waves(todo_file_lst, deps):
+    """Groups files into waves; each wave keeps the Task list order."""
+    level = {}
+    for fn in todo_file_lst:
+        level[fn] = 1 + max((level[d] for d in deps.get(fn, ())), default=-1)
+    waves = [[] for _ in range(max(level.values(), default=-1) + 1)]
+    for fn in todo_file_lst:
+        waves[level[fn]].append(fn)
+    return waves
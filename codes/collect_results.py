@@ -39,11 +39,19 @@ def find_token_summary(exp_dir, mode, fmt):
         return None
     with open(path) as f:
         data = json.load(f)
+    # the coding stage records its stats next to the summary only
+    prompt_cache = {}
+    stats_path = os.path.join(exp_dir, "prompt_cache_stats.json")
+    if os.path.exists(stats_path):
+        with open(stats_path) as f:
+            prompt_cache.update(json.load(f))
+    prompt_cache.update(data.get("prompt_cache", {}))
     return {
         "prompt_tokens": data.get("total_prompt_tokens", 0),
         "completion_tokens": data.get("total_completion_tokens", 0),
         "total_tokens": data.get("total_tokens", 0),
         "per_file": data.get("per_file_iterations", {}),
+        "prompt_cache": prompt_cache,
     }
 
 
@@ -117,7 +125,31 @@ def main():
               f"{tokens.get('llm_only_freetext','??'):>12} {tokens.get('static_only_json','??'):>12} "
               f"{tokens.get('multi_signal_json','??'):>12}")
 
-    # ---- Table 3: Per-iteration critique counts ----
+    # ---- Table 3: Provider prompt-cache hit ratio ----
+    print("\n" + "=" * 70)
+    print("TABLE: Prompt-Cache Hit Ratio (cached / prompt tokens, analyzing / coding)")
+    print("=" * 70)
+    header = f"{'Paper':<25} {'LLM-JSON':>12} {'LLM-Free':>12} {'Static':>12} {'Multi':>12}"
+    print(header)
+    print("-" * 70)
+
+    for paper in papers:
+        base_dir = os.path.join(args.base_dir, paper)
+        ratios = {}
+        for mode, fmt in experiments:
+            exp_name = f"{mode}_{fmt}"
+            t = find_token_summary(os.path.join(base_dir, "experiments", exp_name), mode, fmt)
+            stages = t["prompt_cache"] if t else {}
+            ratios[exp_name] = "/".join(
+                f"{stages[st]['hit_ratio'] * 100:.0f}%" if st in stages else "??"
+                for st in ("analyzing", "coding")
+            )
+
+        print(f"{paper:<25} {ratios.get('llm_only_json','??'):>12} "
+              f"{ratios.get('llm_only_freetext','??'):>12} {ratios.get('static_only_json','??'):>12} "
+              f"{ratios.get('multi_signal_json','??'):>12}")
+
+    # ---- Table 4: Per-iteration critique counts ----
     print("\n" + "=" * 70)
     print("TABLE: Per-Iteration High-Severity Critique Counts (multi_signal)")
     print("=" * 70)
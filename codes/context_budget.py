@@ -0,0 +1,269 @@
+"""
+context_budget.py
+
+Keeps every stage's prompt within the model's context window by pruning the
+paper section by section.
+
+The S2ORC JSON from 0_pdf_process.py (or a LaTeX source) is split into
+sections: consecutive body_text paragraphs with the same heading, back-matter
+sections, and figure/table entries. When the full paper does not fit next to
+the rest of the prompt, sections are scored against the current file/task
+(TF-IDF overlap, weighted by a prior on the heading: method and experiment
+sections up, related work and acknowledgements down) and the highest-value ones
+are packed until the budget is full. Title and abstract are always kept;
+dropped sections leave a one-line marker so the model knows they exist.
+
+Every call appends one JSON line to {output_dir}/context_budget.log with the
+budget, the token counts and the dropped sections.
+"""
+
+import copy
+import json
+import math
+import os
+import re
+from collections import Counter
+from itertools import groupby
+
+from paper_render import render_ref_entry
+from prompts import render_paper
+
+# (context window, tokens reserved for the reply), matched by longest model-name prefix
+MODEL_CONTEXT_LIMITS = {
+    "o1": (200_000, 32_000),
+    "o3": (200_000, 32_000),
+    "o3-mini": (200_000, 32_000),
+    "o4-mini": (200_000, 32_000),
+    "gpt-4o": (128_000, 16_384),
+    "gpt-4o-mini": (128_000, 16_384),
+    "gpt-4.1": (1_047_576, 32_768),
+    "gpt-5": (400_000, 64_000),
+}
+DEFAULT_CONTEXT_LIMIT = (128_000, 16_384)
+LOCAL_RESERVE_OUTPUT = 16_384  # reply reservation for the local (vLLM) stages, whose window is --max_model_len
+
+OMITTED_MARKER = "[Section omitted to fit the context budget]"
+
+HEADING_PRIORS = [
+    (re.compile(r"method|approach|model|architecture|algorithm|framework|objective|loss|training|"
+                r"implementation|experiment|setup|setting|dataset|hyper|evaluation|metric|detail|"
+                r"preliminar|problem|formulation", re.I), 1.5),
+    (re.compile(r"related|acknowledg|limitation|broader|impact|conclusion|future|ethic|reference", re.I), 0.4),
+]
+
+STOPWORDS = set("""a an and are as at be by for from has have in is it its of on or that the this to was were
+with we our which these those their can also than then into using use used based via each such not""".split())
+
+_encoding = None
+
+
+def count_tokens(text):
+    """o200k_base token count; one token per 3 characters when tiktoken cannot load it."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 3 + 1
+
+
+def context_limit(model):
+    matches = [name for name in MODEL_CONTEXT_LIMITS if model.startswith(name)]
+    if not matches:
+        return DEFAULT_CONTEXT_LIMIT
+    return MODEL_CONTEXT_LIMITS[max(matches, key=len)]
+
+
+def section_terms(text):
+    words = re.findall(r"[a-z][a-z0-9]+", text.lower().replace("_", " "))
+    return [w for w in words if w not in STOPWORDS]
+
+
+class Section:
+    def __init__(self, key, title, text):
+        self.key = key  # (field, index) for body_text/back_matter/latex, ("ref_entries", ref_id)
+        self.title = title
+        self.text = text
+        self.tokens = count_tokens(text)
+
+
+def parse_sections(paper_content):
+    """Splits an S2ORC JSON paper (dict) or a LaTeX source (str) into Sections."""
+    sections = []
+    if isinstance(paper_content, str):
+        parts = re.split(r"(?=\\(?:sub)*section\*?\{)", paper_content)
+        for idx, part in enumerate(parts[1:], start=1):
+            title = re.match(r"\\(?:sub)*section\*?\{([^}]*)\}", part).group(1)
+            sections.append(Section(("latex", idx), title, part))
+        return sections
+
+    pdf_parse = paper_content.get("pdf_parse", paper_content)
+    for field in ("body_text", "back_matter"):
+        paragraphs = list(enumerate(pdf_parse.get(field, [])))
+        for sec_idx, (_, group) in enumerate(groupby(paragraphs, key=lambda p: (p[1].get("sec_num"),
+                                                                              p[1].get("section")))):
+            group = list(group)
+            heading = " ".join(filter(None, [group[0][1].get("sec_num"), group[0][1].get("section")]))
+            text = "\n".join(p["text"] for _, p in group)
+            section = Section((field, sec_idx), heading or field, text)
+            section.paragraph_ids = [i for i, _ in group]
+            sections.append(section)
+    for ref_id, entry in pdf_parse.get("ref_entries", {}).items():
+        sections.append(Section(("ref_entries", ref_id), entry.get("text", ref_id)[:80], render_ref_entry(entry)))
+    return sections
+
+
+def score_sections(sections, query):
+    """TF-IDF overlap with the query, weighted by the heading prior."""
+    doc_terms = [Counter(section_terms(s.title + "\n" + s.text)) for s in sections]
+    n_docs = len(sections)
+    df = Counter(term for terms in doc_terms for term in terms)
+    query_terms = Counter(section_terms(query))
+    scores = []
+    for section, terms in zip(sections, doc_terms):
+        length = sum(terms.values()) or 1
+        overlap = sum(min(qtf, 3) * (terms[t] / length) * math.log(1 + n_docs / df[t])
+                      for t, qtf in query_terms.items() if t in terms)
+        prior = 1.0
+        for pattern, weight in HEADING_PRIORS:
+            if pattern.search(section.title):
+                prior = weight
+                break
+        # a small floor keeps section order meaningful when the query shares no terms
+        scores.append((overlap + 0.01) * prior)
+    return scores
+
+
+def render_sections(paper_content, sections, kept_keys, mark_omitted=True):
+    """Copy of the paper holding only the sections in `kept_keys` (plus title/abstract)."""
+    if isinstance(paper_content, str):
+        first = re.search(r"\\(?:sub)*section\*?\{", paper_content)
+        out = [paper_content[:first.start()] if first else ""]
+        for s in sections:
+            if s.key in kept_keys:
+                out.append(s.text)
+            elif mark_omitted:
+                out.append(f"\\section*{{{s.title}}}\n% {OMITTED_MARKER}\n")
+        return "".join(out)
+
+    pruned = copy.deepcopy(paper_content)
+    pdf_parse = pruned.get("pdf_parse", pruned)
+    for field in ("body_text", "back_matter"):
+        paragraphs = pdf_parse.get(field, [])
+        keep = []
+        for s in sections:
+            if s.key[0] != field:
+                continue
+            if s.key in kept_keys:
+                keep.extend(paragraphs[i] for i in s.paragraph_ids)
+            elif mark_omitted:
+                first = paragraphs[s.paragraph_ids[0]]
+                keep.append({"text": OMITTED_MARKER, "section": first.get("section"), "sec_num": first.get("sec_num")})
+        if field in pdf_parse:
+            pdf_parse[field] = keep
+    if "ref_entries" in pdf_parse:
+        pdf_parse["ref_entries"] = {ref_id: entry for ref_id, entry in pdf_parse["ref_entries"].items()
+                                    if ("ref_entries", ref_id) in kept_keys}
+    return pruned
+
+
+class ContextBudgeter:
+    """
+    Per-stage budget: the model's context window minus the reply reservation
+    and `headroom` (tokens the stage adds later in the same conversation,
+    e.g. feedback iterations or further planning turns).
+    """
+
+    def __init__(self, model, output_dir, context_window=None, reserve_output=None, headroom=0):
+        window, reserve = context_limit(model)
+        self.context_window = context_window or window
+        self.reserve_output = reserve if reserve_output is None else reserve_output
+        self.budget = self.context_window - self.reserve_output - headroom
+        self.log_path = os.path.join(output_dir, "context_budget.log") if output_dir else None
+        self._paper_tokens = {}
+
+    def fit(self, paper_content, fixed_text, query="", label=""):
+        """
+        Returns `paper_content` itself when it fits next to `fixed_text`
+        (the rest of the prompt), otherwise a pruned copy of the same shape.
+        """
+        fixed_tokens = count_tokens(fixed_text)
+        # keyed by identity; the entry holds the object so its id cannot be reused
+        cached = self._paper_tokens.get(id(paper_content))
+        if cached is None or cached[0] is not paper_content:
+            cached = (paper_content, count_tokens(render_paper(paper_content)))
+            self._paper_tokens[id(paper_content)] = cached
+        paper_tokens = cached[1]
+        available = self.budget - fixed_tokens
+
+        if paper_tokens <= available:
+            self._log(label, fixed_tokens, paper_tokens, paper_tokens, [])
+            return paper_content
+
+        sections = parse_sections(paper_content)
+        scores = score_sections(sections, query)
+        # everything outside the sections (title, abstract, LaTeX preamble) is always kept
+        overhead = paper_tokens - sum(s.tokens for s in sections)
+        used = overhead + count_tokens(OMITTED_MARKER) * len(sections)
+        kept_keys = set()
+        for _, section in sorted(zip(scores, sections), key=lambda x: -x[0]):
+            if used + section.tokens <= available:
+                kept_keys.add(section.key)
+                used += section.tokens
+
+        pruned = render_sections(paper_content, sections, kept_keys)
+        pruned_tokens = count_tokens(render_paper(pruned))
+        dropped = [s.title for s in sections if s.key not in kept_keys]
+        self._log(label, fixed_tokens, paper_tokens, pruned_tokens, dropped)
+        if fixed_tokens + pruned_tokens > self.budget:
+            print(f"[WARNING] {label}: prompt still exceeds the {self.budget:,}-token budget "
+                  f"after dropping {len(dropped)} paper sections.")
+        else:
+            print(f"[BUDGET] {label}: dropped {len(dropped)} paper sections "
+                  f"({paper_tokens:,} -> {pruned_tokens:,} tokens).")
+        return pruned
+
+    def fits(self, text):
+        return count_tokens(text) <= self.budget
+
+    def _log(self, label, fixed_tokens, paper_tokens, kept_tokens, dropped):
+        if self.log_path is None:
+            return
+        record = {
+            "label": label,
+            "budget": self.budget,
+            "fixed_tokens": fixed_tokens,
+            "paper_tokens": paper_tokens,
+            "paper_tokens_kept": kept_tokens,
+            "dropped_sections": dropped,
+        }
+        os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def fit_paper_in_messages(budgeter, paper_content, messages, query="", label=""):
+    """
+    Prunes the paper where it is rendered inside `messages` (in place); the
+    rest of the messages counts as the fixed part of the prompt.
+    """
+    paper_text = render_paper(paper_content)
+    fixed_text = "".join(m["content"] for m in messages).replace(paper_text, "", 1)
+    fitted = budgeter.fit(paper_content, fixed_text, query, label)
+    if fitted is not paper_content:
+        fitted_text = render_paper(fitted)
+        for m in messages:
+            if paper_text in m["content"]:
+                m["content"] = m["content"].replace(paper_text, fitted_text, 1)
+                break
+    return fitted
+
+
+def add_budget_args(parser):
+    parser.add_argument('--context_window', type=int, default=None,
+                        help="Override the model's context window used by the context budgeter")
+    return parser
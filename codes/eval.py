@@ -1,15 +1,19 @@
-from openai import OpenAI
 import json
 import os
 import sys
 import argparse
-from utils import read_python_files, extract_planning, content_to_json, \
-        num_tokens_from_messages, read_all_files, extract_json_from_string, get_now_str, print_log_cost
+from utils import read_python_files, \
+        read_all_files, extract_json_from_string, get_now_str, print_log_cost, \
+        add_api_args, add_batch_args, load_response_cache, chat_completion, BatchQueue, BatchDeferred, \
+        make_client, get_executor
+from context_budget import ContextBudgeter, fit_paper_in_messages, add_budget_args
+from prompts import render_paper
+from planning_context import load_planning_context
 from pathlib import Path
 import re
 
 
-client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+client = None  # created in __main__, once --base_url is known
 
 # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>  ALL THIS NEW STUFF I ADDED LATER (FOR MYSELF TO NOT GET CONFUSED)  <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 # ---------- Stage-classification regexes ----------
@@ -51,8 +55,8 @@ def infer_stage(file_name: str, func_name: str, critique: str) -> str:
 
 # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>  NEW STUFF ENDS HERE  <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 
-def api_call(request_json):
-    completion = client.chat.completions.create(**request_json)
+def api_call(request_json, cache=None, batch=None):
+    completion = chat_completion(client, request_json, cache, batch)
     return completion
 
 def main(args):
@@ -78,19 +82,14 @@ def main(args):
         # python files
         target_files_dict = read_python_files(target_repo_dir)
 
-        # configuration
-        with open(f'{output_dir}/planning_config.yaml') as f:
-            config_yaml = f.read()
-
-        context_lst = extract_planning(f'{output_dir}/planning_trajectories.json')
-
-        if os.path.exists(f'{output_dir}/task_list.json'):
-            with open(f'{output_dir}/task_list.json') as f:
-                task_list = json.load(f)
-        else:
-            task_list = content_to_json(context_lst[2])
-
-        todo_file_lst = task_list['Task list']
+        # configuration and task list (planning_context.py)
+        try:
+            planning = load_planning_context(output_dir, paper_json)
+        except ValueError as e:
+            print(f"[ERROR] {e}. Please re-generate the planning.")
+            sys.exit(0)
+        config_yaml = planning.config_yaml
+        todo_file_lst = planning.todo_file_lst
         for todo_file in todo_file_lst:
             if todo_file.endswith(".yaml"):
                 continue
@@ -107,7 +106,7 @@ def main(args):
             codes += f"```## File name: {file_name}\n{code}\n```\n\n"
 
     prompt = open(f"{data_dir}/prompts/{eval_type}.txt").read()
-    cur_prompt = prompt.replace('{{Paper}}', f"{paper_json}").replace('{{Code}}', codes)
+    cur_prompt = prompt.replace('{{Paper}}', render_paper(paper_json)).replace('{{Code}}', codes)
 
     # reference-based
     if eval_type == "ref_based" and len(gold_repo_dir) > 0:
@@ -136,15 +135,11 @@ def main(args):
 
     msg = [{"role": "system", "content": cur_prompt}]
 
-    try:
-        num_tokens = num_tokens_from_messages(msg)
-    except Exception as e:
-        print(f"[WARNING] Token-counting failed for {paper_name}.")
-        print(e, "-" * 40)
-        num_tokens = 0
-
-    if num_tokens > 128_000:
-        print(f"[ERROR] {paper_name}: prompt exceeds 128 k tokens")
+    # prune the paper (sections least related to the code go first) instead of giving up
+    budgeter = ContextBudgeter(gpt_version, output_dir, args.context_window)
+    fit_paper_in_messages(budgeter, paper_json, msg, codes, f"[Evaluation] {paper_name} - {eval_type}")
+    if not budgeter.fits(msg[0]["content"]):
+        print(f"[ERROR] {paper_name}: prompt exceeds the {budgeter.budget:,}-token budget even without the paper body")
         sys.exit(0)
 
     if "o3-mini" in gpt_version and generated_n > 8:
@@ -160,7 +155,15 @@ def main(args):
         "n": generated_n
     }
 
-    completion      = api_call(request_json)
+    cache           = load_response_cache(args)
+    batch           = BatchQueue(args.batch_dir, output_dir, f"[Evaluation] {paper_name} - {eval_type}") \
+                      if args.batch else None
+    try:
+        completion  = api_call(request_json, cache, batch)
+    except BatchDeferred:
+        print(f"[BATCH] {paper_name}: request queued in {args.batch_dir}. "
+              f"Run batch_api.py; it re-runs this evaluation once the batch completes.")
+        return
     completion_json = json.loads(completion.model_dump_json())
 
     score_key     = "score"
@@ -261,6 +264,9 @@ def main(args):
     print_log_cost(completion_json, gpt_version,
                    f"[Evaluation] {paper_name} - {eval_type}",
                    output_dir, 0)
+    if cache is not None:
+        cache.write_stats(output_dir, f"[Evaluation] {paper_name} - {eval_type}")
+    get_executor().write_stats(output_dir, f"[Evaluation] {paper_name} - {eval_type}")
 
 
 if __name__ == "__main__":
@@ -283,8 +289,12 @@ if __name__ == "__main__":
 
     ap.add_argument('--selected_file_path', type=str, default="")
     ap.add_argument('--papercoder',         action="store_true")
+    add_api_args(ap)
+    add_budget_args(ap)
+    add_batch_args(ap)
 
     args = ap.parse_args()
+    client = make_client(args)
     main(args)
 
 # =======================================================================
@@ -0,0 +1,277 @@
+"""
+exec_smoke.py
+
+Runner for the exec-smoke channel of static_analysis.py (exec_smoke_check).
+
+Runs inside a sandboxed copy of the generated repo whose config.yaml has
+been shrunk by `shrink_config`. Every torch.nn.Module defined in the target
+file that no other class of that file builds (the "root" modules, e.g.
+TransformerModel rather than EncoderLayer) is instantiated from the config
+and put through one forward and one backward step on CPU with synthetic
+tensors. Input shapes are inferred from the module's first layer
+(Embedding -> token ids, ConvNd -> images/signals, Linear/LayerNorm ->
+features).
+
+Prints one JSON line: {"exec_smoke": [failure, ...]} or
+{"exec_smoke": [], "skipped": reason}. A failure is
+  {"class", "phase": init|forward|backward, "exc_type", "message",
+   "frame": {"file", "line", "func"}}
+with the deepest traceback frame inside the repo. Failures caused by the
+runner's own guesses (constructor or forward signatures it cannot satisfy,
+i.e. TypeErrors raised before any repo frame) are not reported.
+
+Usage (normally called by exec_smoke_check):
+    python exec_smoke.py --file model.py --config config.yaml --project_root /tmp/smoke_xyz
+"""
+
+import argparse
+import importlib.util
+import inspect
+import json
+import os
+import re
+import sys
+import traceback
+
+import yaml
+
+BATCH = 2
+SEQ_LEN = 8
+IMAGE_SIZE = 32
+MIN_WIDTH = 4
+
+# config keys -> tiny values; widths are divided by a common factor instead so
+# relations such as d_model == num_heads * d_k survive the shrinking
+WIDTH_KEYS = re.compile(r"d_model|d_ff|d_k|d_v|dim|hidden|width|channel|embed|feature|units|filters|image_size|"
+                        r"img_size|resolution", re.I)
+FIXED_KEYS = [
+    (re.compile(r"layer|depth|block|stage", re.I), 1),
+    (re.compile(r"batch", re.I), BATCH),
+    (re.compile(r"epoch|step|iter|warmup|patience", re.I), 1),
+    (re.compile(r"seq|len|length|context|max_pos|n_ctx|tokens", re.I), SEQ_LEN),
+    (re.compile(r"vocab", re.I), 64),
+    (re.compile(r"worker", re.I), 0),
+    (re.compile(r"sample|num_train|num_test|num_val|size_limit", re.I), 4),
+]
+
+
+def _walk_ints(node, fn, key=""):
+    """Applies fn(key path, value) to every int; the path ("total_steps.base_model") is matched by the patterns."""
+    if isinstance(node, dict):
+        return {k: _walk_ints(v, fn, f"{key}.{k}" if key else str(k)) for k, v in node.items()}
+    if isinstance(node, list):
+        return [_walk_ints(v, fn, key) for v in node]
+    if isinstance(node, int) and not isinstance(node, bool):
+        return fn(key, node)
+    return node
+
+
+def shrink_config(config):
+    """Tiny-but-consistent copy of a config dict (see WIDTH_KEYS / FIXED_KEYS)."""
+    widths = []
+    _walk_ints(config, lambda k, v: widths.append(v) if WIDTH_KEYS.search(k.rsplit(".", 1)[-1]) and v > 0 else v)
+    divisor = 1
+    if widths:
+        # largest power of two dividing every width while keeping the smallest >= MIN_WIDTH
+        while all(w % (divisor * 2) == 0 for w in widths) and min(widths) // (divisor * 2) >= MIN_WIDTH:
+            divisor *= 2
+
+    def shrink(path, value):
+        leaf = path.rsplit(".", 1)[-1]
+        if WIDTH_KEYS.search(leaf) and value > 0:
+            return value // divisor
+        for pattern, tiny in FIXED_KEYS:
+            if pattern.search(leaf) or pattern.search(path):
+                return min(value, tiny)
+        return value
+    return _walk_ints(config, shrink)
+
+
+# ---------------------------------------------------------------------------
+# Sandbox side
+# ---------------------------------------------------------------------------
+
+class GuessError(Exception):
+    """The runner could not build a call; not the generated code's fault."""
+
+
+def _flat_config(config, out=None):
+    out = {} if out is None else out
+    if isinstance(config, dict):
+        for k, v in config.items():
+            if isinstance(v, dict):
+                _flat_config(v, out)
+            else:
+                out.setdefault(str(k), v)
+    return out
+
+
+def _default_for(name, annotation):
+    lname = name.lower()
+    if "vocab" in lname or "num_embeddings" in lname:
+        return 64
+    if "class" in lname or "label" in lname:
+        return 4
+    if "head" in lname:
+        return 2
+    if "layer" in lname or "depth" in lname:
+        return 1
+    if "len" in lname or "seq" in lname:
+        return SEQ_LEN
+    if annotation is float or "dropout" in lname or "rate" in lname:
+        return 0.0
+    if annotation is bool:
+        return False
+    if annotation is int or re.search(r"dim|size|hidden|d_|channel|width|num", lname):
+        return 16
+    raise GuessError(f"no value for constructor argument '{name}'")
+
+
+def build_module(cls, config):
+    flat = _flat_config(config)
+    kwargs = {}
+    for name, param in list(inspect.signature(cls.__init__).parameters.items())[1:]:
+        if param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+            continue
+        if re.fullmatch(r"config|cfg|conf|params|hparams|hyperparams|args|opt|settings|.*_config", name):
+            section = config.get(name.replace("_config", ""), config) if name.endswith("_config") else config
+            kwargs[name] = section
+        elif name in flat and not isinstance(flat[name], (dict, list)):
+            kwargs[name] = flat[name]
+        elif param.default is not param.empty:
+            continue
+        else:
+            kwargs[name] = _default_for(name, param.annotation)
+    return cls(**kwargs)
+
+
+def synth_inputs(torch, module, forward):
+    first = next((m for m in module.modules() if m is not module and not list(m.children())), None)
+    name = type(first).__name__ if first is not None else ""
+    if name == "Embedding":
+        make = lambda: torch.randint(1, first.num_embeddings, (BATCH, SEQ_LEN))
+    elif name in ("Conv2d", "ConvTranspose2d"):
+        make = lambda: torch.randn(BATCH, first.in_channels, IMAGE_SIZE, IMAGE_SIZE)
+    elif name in ("Conv1d", "ConvTranspose1d"):
+        make = lambda: torch.randn(BATCH, first.in_channels, IMAGE_SIZE)
+    elif name == "Linear":
+        make = lambda: torch.randn(BATCH, SEQ_LEN, first.in_features)
+    elif name == "LayerNorm":
+        make = lambda: torch.randn(BATCH, SEQ_LEN, *first.normalized_shape)
+    else:
+        raise GuessError(f"cannot infer inputs from first layer '{name or 'none'}'")
+
+    args = []
+    for pname, param in list(inspect.signature(forward).parameters.items())[1:]:
+        if param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD) or param.default is not param.empty:
+            continue
+        lname = pname.lower()
+        if "mask" in lname:
+            args.append(None)
+        elif lname in ("t", "timestep", "timesteps", "time", "step"):
+            args.append(torch.randint(0, 10, (BATCH,)))
+        elif lname in ("y", "label", "labels", "target", "targets", "class_labels"):
+            args.append(torch.randint(0, 4, (BATCH,)))
+        else:
+            args.append(make())
+    return args
+
+
+def _first_tensor(torch, out):
+    if isinstance(out, torch.Tensor):
+        return out
+    values = out.values() if isinstance(out, dict) else out if isinstance(out, (list, tuple)) else []
+    for v in values:
+        t = _first_tensor(torch, v)
+        if t is not None:
+            return t
+    return None
+
+
+def _failure(cls_name, phase, exc, project_root):
+    frames = [f for f in traceback.extract_tb(exc.__traceback__)
+              if os.path.abspath(f.filename).startswith(project_root + os.sep)]
+    frame = frames[-1] if frames else None
+    return {"class": cls_name, "phase": phase, "exc_type": type(exc).__name__, "message": str(exc)[:500],
+            "frame": {"file": os.path.relpath(frame.filename, project_root), "line": frame.lineno,
+                      "func": frame.name} if frame else None}
+
+
+def root_modules(nn, module):
+    classes = [obj for obj in vars(module).values()
+               if inspect.isclass(obj) and issubclass(obj, nn.Module) and obj.__module__ == module.__name__]
+    used = set()
+    for cls in classes:
+        try:
+            body = inspect.getsource(cls)
+        except (OSError, TypeError):
+            continue
+        used.update(other.__name__ for other in classes
+                    if other is not cls and re.search(rf"\b{other.__name__}\s*\(", body))
+    return [cls for cls in classes if cls.__name__ not in used] or classes
+
+
+def run(filepath, config, project_root):
+    try:
+        import torch
+        import torch.nn as nn
+    except ImportError:
+        return {"exec_smoke": [], "skipped": "torch is not installed"}
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+
+    module_name = os.path.splitext(os.path.basename(filepath))[0]
+    spec = importlib.util.spec_from_file_location(module_name, filepath)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except Exception:
+        # import failures are import_probe's to report
+        return {"exec_smoke": [], "skipped": "import failed"}
+
+    failures = []
+    for cls in root_modules(nn, module):
+        phase = "init"
+        try:
+            model = build_module(cls, config)
+            model.train()
+            phase = "forward"
+            out = model(*synth_inputs(torch, model, type(model).forward))
+            phase = "backward"
+            loss = _first_tensor(torch, out)
+            if loss is not None and loss.requires_grad:
+                loss.float().sum().backward()
+        except GuessError:
+            continue
+        except TypeError as e:
+            # raised before entering the repo's code: a signature the runner guessed wrong
+            failure = _failure(cls.__name__, phase, e, project_root)
+            if failure["frame"] is not None:
+                failures.append(failure)
+        except Exception as e:
+            failures.append(_failure(cls.__name__, phase, e, project_root))
+    return {"exec_smoke": failures}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--file', type=str, required=True)
+    parser.add_argument('--config', type=str, default="config.yaml")
+    parser.add_argument('--project_root', type=str, default=".")
+    args = parser.parse_args()
+
+    project_root = os.path.abspath(args.project_root)
+    os.chdir(project_root)
+    # the repo, not this script's directory, comes first on sys.path
+    sys.path[0] = project_root
+    config = {}
+    if os.path.exists(args.config):
+        with open(args.config, encoding="utf-8") as f:
+            config = yaml.safe_load(f) or {}
+    result = run(os.path.join(project_root, args.file), config if isinstance(config, dict) else {}, project_root)
+    print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
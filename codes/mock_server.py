@@ -0,0 +1,373 @@
+"""
+mock_server.py
+
+Local OpenAI-compatible stand-in for timing and load-testing the pipeline
+without an API key. Serves POST /v1/chat/completions (with usage, including
+prompt_tokens_details.cached_tokens), GET /v1/models and GET /stats.
+
+Responses:
+  --script_from <experiment dir>   replies recorded by an earlier run, picked by
+                                   the kind of request:
+      planning  -> planning_trajectories.json, by the number of assistant turns
+      analysis  -> debug_revisions revision i of the file ("## Logic Analysis: <file>")
+      judge     -> debug_revisions critiques i of the file (see replay.py)
+      coding    -> coding_artifacts/<file>_coding.txt ("## Code: <file>")
+      eval      -> eval_results/*.json recorded choices
+    The i-th request for a file gets iteration i (the last one recorded
+    beyond that).
+  otherwise (and for requests the recording lacks) short synthetic replies in
+  the format each stage parses.
+
+Behaviour:
+  --latency fixed:S | uniform:A:B | normal:MEAN:STD | lognormal:MEDIAN:SIGMA
+                                   seconds before the reply, plus
+  --decode_tps N                   completion tokens / N seconds
+  --error_rate P                   fraction of requests answered 429 (Retry-After: --retry_after)
+  --rpm N                          429 beyond N requests in any 60 s window
+  stream=True                      server-sent events, the first chunk after the
+                                   latency; a client that disconnects early is
+                                   billed only for the chunks sent
+  --seed S                         latencies and injected errors are drawn from
+                                   seed + request content, so a rerun sees the same ones
+
+Tokens are 4 characters. cached_tokens follows the documented provider rule:
+the longest prefix shared with an earlier request, in 128-token blocks once it
+reaches 1024 tokens.
+
+Usage:
+    python mock_server.py --port 8000 --script_from ../outputs/fit/experiments/llm_only_json \\
+        --latency lognormal:2.0:0.5 --error_rate 0.05
+    python 3_coding.py --base_url http://127.0.0.1:8000/v1 ...   (OPENAI_API_KEY may be anything)
+    curl http://127.0.0.1:8000/stats
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench_prompt_cache import CACHE_BLOCK, CACHE_MIN, CHARS_PER_TOKEN, common_prefix_len, render
+from replay import ReplayMissError, ReplaySource
+
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60]
+STREAM_CHUNK_CHARS = 16
+
+
+def parse_latency(spec):
+    """'lognormal:2.0:0.5' -> fn(rng) returning seconds."""
+    kind, *values = spec.split(":")
+    values = [float(v) for v in values]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        import math
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution '{kind}'")
+
+
+class ScriptedResponses:
+    """Replies recorded in one experiment directory (see module docstring)."""
+
+    def __init__(self, experiment_dir):
+        self.experiment_dir = experiment_dir
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.planning_turns = []
+        path = os.path.join(experiment_dir, "planning_trajectories.json")
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.planning_turns = [m["content"] for m in json.load(f) if m["role"] == "assistant"]
+        try:
+            self.replay = ReplaySource(experiment_dir)
+        except (FileNotFoundError, ValueError):
+            self.replay = None
+        self.eval_choices = []
+        for path in sorted(glob.glob(os.path.join(experiment_dir, "eval_results", "*.json"))):
+            with open(path, encoding="utf-8") as f:
+                self.eval_choices += [c["message"]["content"] for c in json.load(f)["completion_json"]["choices"]]
+
+    def _next(self, kind, todo_file_name):
+        with self.lock:
+            self.counters[(kind, todo_file_name)] = self.counters.get((kind, todo_file_name), 0) + 1
+            return self.counters[(kind, todo_file_name)]
+
+    def _recorded_iteration(self, todo_file_name, iteration):
+        while iteration > 1 and not self.replay.has(todo_file_name, iteration):
+            iteration -= 1
+        return iteration
+
+    def reply(self, kind, todo_file_name, messages, n):
+        """n recorded replies, or None when the recording has none for this request."""
+        try:
+            if kind == "planning":
+                turn = sum(1 for m in messages if m["role"] == "assistant")
+                return [self.planning_turns[turn]] * n if turn < len(self.planning_turns) else None
+            if kind == "eval":
+                return [self.eval_choices[i % len(self.eval_choices)] for i in range(n)] if self.eval_choices else None
+            if kind == "coding":
+                path = os.path.join(self.experiment_dir, "coding_artifacts",
+                                    f"{todo_file_name.replace('/', '_')}_coding.txt")
+                if not os.path.exists(path):
+                    return None
+                with open(path, encoding="utf-8") as f:
+                    return [f.read()] * n
+            if self.replay is None:
+                return None
+            iteration = self._recorded_iteration(todo_file_name, self._next(kind, todo_file_name))
+            if kind == "analysis":
+                return [self.replay.revision(todo_file_name, iteration)] * n
+            fmt = "freetext" if self.replay.tag.endswith("freetext") else "json"
+            return [self.replay.judge_response(todo_file_name, iteration, fmt)] * n
+        except ReplayMissError:
+            return None
+
+
+def classify(messages):
+    """(kind, file name) of a chat request from the stage prompts' markers."""
+    last = messages[-1]["content"] if messages else ""
+    if any("rate the code repository" in m["content"] for m in messages if m["role"] == "system"):
+        return "eval", ""
+    m = re.search(r"Here is the logic analysis for `([^`]+)`", last)
+    if m:
+        return "judge", m.group(1)
+    m = re.search(r"## Code: (\S+)\s*$", last)
+    if m and m.group(1) != "config.yaml":
+        return "coding", m.group(1)
+    for message in reversed(messages):
+        m = re.search(r"## Logic Analysis: (\S+)\s*$", message["content"]) \
+            or re.search(r"The following critiques were raised for `([^`]+)`", message["content"])
+        if m and message["role"] == "user":
+            return "analysis", m.group(1)
+    return "planning", ""
+
+
+def synthetic_reply(kind, todo_file_name, messages):
+    if kind == "judge":
+        return json.dumps({"critique_list": [{"target_func_name": "__init__", "severity_level": "medium",
+                                              "critique": "Synthetic critique from mock_server."}]})
+    if kind == "eval":
+        return json.dumps({"score": 3, "critique_list": []})
+    if kind == "coding":
+        return f"## Code: {todo_file_name}\n```python\n## {todo_file_name}\n\ndef main():\n    return None\n```\n"
+    if kind == "analysis":
+        return f"Logic analysis of {todo_file_name} (synthetic, {len(messages)} messages)."
+    if "config.yaml" in messages[-1]["content"]:
+        return "## Code: config.yaml\n```yaml\ntraining:\n  learning_rate: 0.001\n  batch_size: 32\n```\n"
+    return '[CONTENT]\n{"Task list": ["main.py"], "Logic Analysis": [["main.py", "Entry point."]]}\n[/CONTENT]'
+
+
+class MockState:
+    def __init__(self, args):
+        self.args = args
+        self.latency = parse_latency(args.latency)
+        self.script = ScriptedResponses(args.script_from) if args.script_from else None
+        self.lock = threading.Lock()
+        self.seen_prompts = []
+        self.occurrences = {}
+        self.window = deque()
+        self.stats = {"requests": 0, "ok": 0, "rate_limited": 0, "scripted": 0, "synthetic": 0,
+                      "streamed": 0, "cancelled": 0, "completion_tokens_saved": 0,
+                      "in_flight": 0, "max_in_flight": 0, "prompt_tokens": 0, "cached_tokens": 0,
+                      "completion_tokens": 0, "by_kind": {},
+                      "latency_hist": {str(b): 0 for b in LATENCY_BUCKETS + ["inf"]}}
+
+    def rng_for(self, body):
+        digest = hashlib.sha256(body).hexdigest()
+        with self.lock:
+            self.occurrences[digest] = self.occurrences.get(digest, 0) + 1
+            return random.Random(f"{self.args.seed}:{digest}:{self.occurrences[digest]}")
+
+    def admit(self, rng):
+        """None, or the Retry-After seconds of an injected 429."""
+        now = time.time()
+        with self.lock:
+            self.stats["requests"] += 1
+            if rng.random() < self.args.error_rate:
+                self.stats["rate_limited"] += 1
+                return self.args.retry_after
+            if self.args.rpm:
+                while self.window and self.window[0] <= now - 60:
+                    self.window.popleft()
+                if len(self.window) >= self.args.rpm:
+                    self.stats["rate_limited"] += 1
+                    return max(0.05, self.window[0] + 60 - now)
+                self.window.append(now)
+            self.stats["in_flight"] += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+        return None
+
+    def cached_tokens(self, text):
+        with self.lock:
+            shared = max((common_prefix_len(text, seen) for seen in self.seen_prompts), default=0)
+            self.seen_prompts.append(text)
+        shared //= CHARS_PER_TOKEN
+        return shared // CACHE_BLOCK * CACHE_BLOCK if shared >= CACHE_MIN else 0
+
+    def finish(self, kind, scripted, latency, usage):
+        with self.lock:
+            self.stats["in_flight"] -= 1
+            self.stats["ok"] += 1
+            self.stats["scripted" if scripted else "synthetic"] += 1
+            self.stats["by_kind"][kind] = self.stats["by_kind"].get(kind, 0) + 1
+            for key in ("prompt_tokens", "completion_tokens"):
+                self.stats[key] += usage[key]
+            self.stats["cached_tokens"] += usage["prompt_tokens_details"]["cached_tokens"]
+            bucket = next((b for b in LATENCY_BUCKETS if latency <= b), "inf")
+            self.stats["latency_hist"][str(bucket)] += 1
+
+
+class Handler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload, headers=None):
+        out = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(out)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send(200, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+        elif self.path.rstrip("/") == "/stats":
+            with self.state.lock:
+                self._send(200, self.state.stats)
+        else:
+            self._send(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+        start = time.time()
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.loads(raw)
+        state = self.state
+        rng = state.rng_for(raw)
+        retry_after = state.admit(rng)
+        if retry_after is not None:
+            self._send(429, {"error": {"message": "Rate limit reached (mock)", "type": "requests",
+                                       "code": "rate_limit_exceeded"}},
+                       {"retry-after": f"{retry_after:.3f}", "retry-after-ms": str(int(retry_after * 1000))})
+            return
+
+        messages = body.get("messages", [])
+        n = int(body.get("n") or 1)
+        kind, todo_file_name = classify(messages)
+        replies = state.script.reply(kind, todo_file_name, messages, n) if state.script else None
+        scripted = replies is not None
+        if replies is None:
+            replies = [synthetic_reply(kind, todo_file_name, messages)] * n
+
+        prompt_text = render(messages)
+        prompt_tokens = len(prompt_text) // CHARS_PER_TOKEN + 1
+        completion_tokens = sum(len(r) // CHARS_PER_TOKEN + 1 for r in replies)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens,
+                 "prompt_tokens_details": {"cached_tokens": state.cached_tokens(prompt_text)},
+                 "completion_tokens_details": {"reasoning_tokens": 0}}
+
+        delay = state.latency(rng)
+        if body.get("stream"):
+            self._stream(body, raw, kind, scripted, replies[0], usage, start, delay)
+            return
+        if state.args.decode_tps:
+            delay += completion_tokens / state.args.decode_tps
+        time.sleep(max(0.0, delay - (time.time() - start)))
+        payload = {"id": f"chatcmpl-mock-{hashlib.sha256(raw).hexdigest()[:16]}", "object": "chat.completion",
+                   "created": int(time.time()), "model": body.get("model", "mock"),
+                   "choices": [{"index": i, "finish_reason": "stop", "logprobs": None,
+                                "message": {"role": "assistant", "content": r}} for i, r in enumerate(replies)],
+                   "usage": usage}
+        state.finish(kind, scripted, time.time() - start, usage)
+        self._send(200, payload)
+
+    def _stream(self, body, raw, kind, scripted, reply, usage, start, delay):
+        """Server-sent events: the first chunk after `delay` (time to first token), then --decode_tps."""
+        state = self.state
+        base = {"id": f"chatcmpl-mock-{hashlib.sha256(raw).hexdigest()[:16]}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": body.get("model", "mock")}
+        pieces = [reply[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(reply), STREAM_CHUNK_CHARS)]
+        per_piece = STREAM_CHUNK_CHARS / CHARS_PER_TOKEN / state.args.decode_tps if state.args.decode_tps else 0.0
+        sent = 0
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            time.sleep(max(0.0, delay - (time.time() - start)))
+            self._event({**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""},
+                                              "finish_reason": None}]})
+            for piece in pieces:
+                self._event({**base, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+                sent += len(piece)
+                if per_piece:
+                    time.sleep(per_piece)
+            self._event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self._event({**base, "choices": [], "usage": usage})
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client cancelled: it only pays for what was sent
+            usage = {**usage, "completion_tokens": sent // CHARS_PER_TOKEN,
+                     "total_tokens": usage["prompt_tokens"] + sent // CHARS_PER_TOKEN}
+            with state.lock:
+                state.stats["cancelled"] += 1
+                state.stats["completion_tokens_saved"] += (len(reply) - sent) // CHARS_PER_TOKEN
+        self.close_connection = True
+        with state.lock:
+            state.stats["streamed"] += 1
+        state.finish(kind, scripted, time.time() - start, usage)
+
+    def _event(self, payload):
+        self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode())
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--script_from', type=str, default="",
+                        help="Experiment dir whose recorded replies are served (default: synthetic replies)")
+    parser.add_argument('--latency', type=str, default="fixed:0",
+                        help="fixed:S | uniform:A:B | normal:MEAN:STD | lognormal:MEDIAN:SIGMA (seconds)")
+    parser.add_argument('--decode_tps', type=float, default=0, help="Completion tokens per second (0 = instant)")
+    parser.add_argument('--error_rate', type=float, default=0.0, help="Fraction of requests answered 429")
+    parser.add_argument('--retry_after', type=float, default=1.0, help="Retry-After of injected 429s (seconds)")
+    parser.add_argument('--rpm', type=int, default=0, help="Requests per minute before 429 (0 = unlimited)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    Handler.state = MockState(args)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"[MOCK] Serving on http://{args.host}:{args.port}/v1 "
+          f"({'recorded replies from ' + args.script_from if args.script_from else 'synthetic replies'})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(Handler.state.stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
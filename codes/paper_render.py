@@ -0,0 +1,113 @@
+"""
+paper_render.py
+
+Renders the S2ORC JSON of 0_pdf_process.py as compact markdown for prompts.
+
+The stages used to interpolate the loaded JSON into their prompts as a Python
+dict repr: quotes, braces, the 'text'/'section'/'sec_num' keys of every
+paragraph, null fields and escaped unicode, repeated on every call. The
+markdown keeps only what the model reads:
+
+  # Title
+  ## Abstract
+  ## 3.2 Attention            heading level from the section number
+  paragraphs                  separated by blank lines
+  $$ ... $$ (1)               equations, where the parse kept them (eq_spans)
+  ## Figures and Tables       captions, tables as | cell | rows
+
+render_markdown is memoized per paper object, so the stages that render the
+same paper for every file pay for it once. bench_paper_render.py compares the
+token counts of both renderings over examples/*.json.
+"""
+
+import html
+import re
+from collections import OrderedDict
+from itertools import groupby
+
+RENDER_VERSION = 1  # bump when the markdown changes: planning_context.py keys stored renderings by it
+MAX_RENDERED = 64  # papers (incl. pruned copies from the context budgeter) kept rendered
+
+_RENDERED = OrderedDict()  # id(paper) -> (paper, markdown); the entry holds the paper so its id is not reused
+
+
+def heading(sec_num, section):
+    sec_num = (sec_num or "").strip().rstrip(".")
+    level = 2 + min(sec_num.count("."), 2) if sec_num else 2
+    return "#" * level + " " + " ".join(filter(None, [sec_num, (section or "").strip()]))
+
+
+def render_paragraph(paragraph):
+    text = paragraph.get("text", "")
+    # equations survive as "EQUATION" placeholders; the raw parse keeps their text in eq_spans
+    for span in sorted(paragraph.get("eq_spans") or [], key=lambda s: -s.get("start", 0)):
+        if not span.get("raw_str"):
+            continue
+        equation = f"$$ {span['raw_str']} $${' ' + span['eq_num'] if span.get('eq_num') else ''}"
+        text = text[:span["start"]] + equation + text[span["end"]:]
+    return text.strip()
+
+
+def render_table(content):
+    rows = []
+    for row in re.findall(r"<tr>(.*?)</tr>", content or "", flags=re.S):
+        cells = [html.unescape(re.sub(r"<[^>]+>", "", cell)).strip()
+                 for cell in re.findall(r"<td[^>]*>(.*?)</td>|<td[^>]*/>", row, flags=re.S)]
+        if any(cells):
+            rows.append("| " + " | ".join(cells) + " |")
+    return "\n".join(rows)
+
+
+def render_ref_entry(entry):
+    """A figure caption, or a table caption followed by its rows."""
+    text = (entry.get("text") or "").strip()
+    if entry.get("type_str") == "table":
+        label = f"Table {entry['fig_num']}: " if entry.get("fig_num") else "Table: "
+        table = render_table(entry.get("content"))
+        return label + text + ("\n" + table if table else "")
+    return text
+
+
+def render_paragraphs(paragraphs):
+    blocks = []
+    for (sec_num, section), group in groupby(paragraphs, key=lambda p: (p.get("sec_num"), p.get("section"))):
+        if sec_num or section:
+            blocks.append(heading(sec_num, section))
+        blocks.extend(text for text in map(render_paragraph, group) if text)
+    return blocks
+
+
+def render_markdown(paper_content):
+    """Markdown of an S2ORC JSON paper (the whole file or its pdf_parse); memoized per paper object."""
+    cached = _RENDERED.get(id(paper_content))
+    if cached is not None and cached[0] is paper_content:
+        _RENDERED.move_to_end(id(paper_content))
+        return cached[1]
+
+    pdf_parse = paper_content.get("pdf_parse", paper_content)
+    blocks = []
+    if paper_content.get("title"):
+        blocks.append(f"# {paper_content['title'].strip()}")
+    abstract = pdf_parse.get("abstract") or paper_content.get("abstract")
+    if abstract:
+        blocks.append("## Abstract")
+        if isinstance(abstract, str):
+            blocks.append(abstract.strip())
+        else:
+            blocks.extend(text for text in map(render_paragraph, abstract) if text)
+    blocks += render_paragraphs(pdf_parse.get("body_text", []))
+    blocks += render_paragraphs(pdf_parse.get("back_matter", []))
+    ref_entries = [render_ref_entry(entry) for entry in pdf_parse.get("ref_entries", {}).values()]
+    if any(ref_entries):
+        blocks.append("## Figures and Tables")
+        blocks.extend(text for text in ref_entries if text)
+    return remember_markdown(paper_content, "\n\n".join(blocks))
+
+
+def remember_markdown(paper_content, markdown):
+    """Memoizes `markdown` as the rendering of `paper_content` (e.g. one stored in a planning bundle)."""
+    _RENDERED[id(paper_content)] = (paper_content, markdown)
+    _RENDERED.move_to_end(id(paper_content))
+    while len(_RENDERED) > MAX_RENDERED:
+        _RENDERED.popitem(last=False)
+    return markdown
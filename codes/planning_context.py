@@ -0,0 +1,206 @@
+"""
+planning_context.py
+
+The planning output every downstream stage reads, parsed once and stored as a
+versioned bundle ({output_dir}/planning_context.json):
+
+  context_lst           overall plan, design and task turns (extract_planning)
+  design                "Data structures and interfaces" etc. (content_to_json)
+  task_list             task_list.json if present, else the parsed task turn
+  todo_file_lst         the task list under any of its key spellings
+  logic_analysis_dict   file -> description
+  config_yaml           planning_config.yaml
+  papers                paper hash -> rendered paper (paper_render.py)
+
+1.1_extract_config.py builds and validates it right after planning. A stage
+calls load_planning_context(output_dir), which hashes the planning files
+(planning_trajectories.json, task_list.json, planning_config.yaml) and
+returns, in this order, the bundle already loaded in this process, the one in
+output_dir, or the one under the same hash in the shared store
+(DEFAULT_CACHE_DIR/planning_context/). Every experiment directory of a sweep
+carries copies of the same planning files, so all of them reuse one bundle.
+Only when none matches, e.g. after planning_config.yaml was edited, is the
+bundle rebuilt. Invalid planning raises ValueError.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import re
+
+from paper_render import RENDER_VERSION, remember_markdown
+from prompts import render_paper
+from utils import extract_planning, content_to_json, DEFAULT_CACHE_DIR
+
+BUNDLE_VERSION = 1
+BUNDLE_NAME = "planning_context.json"
+PLANNING_SOURCES = ("planning_trajectories.json", "task_list.json", "planning_config.yaml")
+PLANNING_CONTEXT_DIR = os.path.join(DEFAULT_CACHE_DIR, "planning_context")
+
+_BUNDLES = {}  # source hash -> bundle loaded in this process
+
+
+def find_config_yaml(trajectories):
+    """The config.yaml block of the last assistant turn that has one (None if there is none)."""
+    for turn in reversed(trajectories):
+        if turn.get("role") != "assistant":
+            continue
+        content = turn["content"].split("</think>")[-1]
+        match = re.search(r"```yaml\n(.*?)\n```", content, re.DOTALL) \
+            or re.search(r"```yaml\\n(.*?)\\n```", content, re.DOTALL)
+        if match:
+            return match.group(1)
+    return None
+
+
+def lookup(task_list, keys):
+    for key in keys:
+        if key in task_list:
+            return task_list[key]
+    return None
+
+
+def source_hash(output_dir):
+    h = hashlib.sha256(f"v{BUNDLE_VERSION}".encode())
+    for name in PLANNING_SOURCES:
+        path = os.path.join(output_dir, name)
+        h.update(f"\0{name}\0".encode())
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def paper_hash(paper_content):
+    text = paper_content if isinstance(paper_content, str) else json.dumps(paper_content, sort_keys=True)
+    return hashlib.sha256(f"r{RENDER_VERSION}\0{text}".encode()).hexdigest()[:16]
+
+
+def build_bundle(output_dir):
+    """Parses the planning files of output_dir into a bundle; raises ValueError when they are unusable."""
+    with open(os.path.join(output_dir, "planning_trajectories.json"), encoding="utf-8") as f:
+        trajectories = json.load(f)
+    context_lst = extract_planning(os.path.join(output_dir, "planning_trajectories.json"))
+    if len(context_lst) < 3:
+        raise ValueError(f"planning has {len(context_lst)} of the 3 plan/design/task turns")
+
+    config_path = os.path.join(output_dir, "planning_config.yaml")
+    if os.path.exists(config_path):
+        with open(config_path, encoding="utf-8") as f:
+            config_yaml = f.read()
+    else:
+        config_yaml = find_config_yaml(trajectories)
+    if not config_yaml:
+        raise ValueError("no config.yaml in the planning output")
+
+    task_list_path = os.path.join(output_dir, "task_list.json")
+    if os.path.exists(task_list_path):
+        with open(task_list_path, encoding="utf-8") as f:
+            task_list = json.load(f)
+    else:
+        task_list = content_to_json(context_lst[2])
+    todo_file_lst = lookup(task_list, ["Task list", "task_list", "task list"])
+    if not todo_file_lst or not all(isinstance(fn, str) for fn in todo_file_lst):
+        raise ValueError("'Task list' does not exist")
+    logic_analysis = lookup(task_list, ["Logic Analysis", "logic_analysis", "logic analysis"])
+    if logic_analysis is None:
+        raise ValueError("'Logic Analysis' does not exist")
+    logic_analysis_dict = {desc[0]: desc[1] for desc in logic_analysis
+                           if isinstance(desc, (list, tuple)) and len(desc) >= 2}
+
+    warnings = [f"'{fn}' has no logic analysis" for fn in todo_file_lst
+                if fn not in logic_analysis_dict and not fn.endswith(".yaml")]
+    try:
+        import yaml
+        yaml.safe_load(config_yaml)
+    except ImportError:
+        pass
+    except yaml.YAMLError as e:
+        warnings.append(f"config.yaml does not parse: {str(e).splitlines()[0]}")
+
+    return {
+        "version": BUNDLE_VERSION,
+        "hash": source_hash(output_dir),
+        "context_lst": context_lst,
+        "design": content_to_json(context_lst[1]),
+        "task_list": task_list,
+        "todo_file_lst": todo_file_lst,
+        "logic_analysis_dict": logic_analysis_dict,
+        "config_yaml": config_yaml,
+        "warnings": warnings,
+        "papers": {},
+    }
+
+
+def save_bundle(output_dir, bundle):
+    for path in (os.path.join(output_dir, BUNDLE_NAME), os.path.join(PLANNING_CONTEXT_DIR, f"{bundle['hash']}.json")):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(bundle, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+def read_bundle(path, current_hash):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            bundle = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if bundle.get("version") != BUNDLE_VERSION or bundle.get("hash") != current_hash:
+        return None
+    return bundle
+
+
+class PlanningContext:
+    """Attribute view of a bundle (see the module docstring for the fields); stages may modify their copy."""
+
+    def __init__(self, bundle):
+        bundle = copy.deepcopy(bundle)
+        self.bundle = bundle
+        self.hash = bundle["hash"]
+        self.context_lst = bundle["context_lst"]
+        self.design = bundle["design"]
+        self.task_list = bundle["task_list"]
+        self.todo_file_lst = bundle["todo_file_lst"]
+        self.logic_analysis_dict = bundle["logic_analysis_dict"]
+        self.config_yaml = bundle["config_yaml"]
+        self.warnings = bundle["warnings"]
+
+
+def load_planning_context(output_dir, paper_content=None):
+    """
+    The planning bundle of output_dir (see the module docstring). With
+    `paper_content` its rendering is taken from the bundle, or rendered and
+    added to it, so render_paper() returns it without rendering again.
+    """
+    current_hash = source_hash(output_dir)
+    local_path = os.path.join(output_dir, BUNDLE_NAME)
+    bundle = _BUNDLES.get(current_hash)
+    dirty = False
+    if bundle is None:
+        bundle = read_bundle(local_path, current_hash)
+    if bundle is None:
+        bundle = read_bundle(os.path.join(PLANNING_CONTEXT_DIR, f"{current_hash}.json"), current_hash)
+        dirty = bundle is not None  # written into output_dir below
+    if bundle is None:
+        bundle = build_bundle(output_dir)
+        dirty = True
+        for warning in bundle["warnings"]:
+            print(f"[WARNING] planning: {warning}")
+
+    if paper_content is not None and not isinstance(paper_content, str):
+        key = paper_hash(paper_content)
+        if key in bundle["papers"]:
+            remember_markdown(paper_content, bundle["papers"][key])
+        else:
+            bundle["papers"][key] = render_paper(paper_content)
+            dirty = True
+
+    _BUNDLES[current_hash] = bundle
+    if dirty or not os.path.exists(local_path):
+        save_bundle(output_dir, bundle)
+    return PlanningContext(bundle)
@@ -0,0 +1,256 @@
+"""
+probe_server.py
+
+Warm import-probe service for static_analysis.import_probe.
+
+Generated repos import torch, transformers and friends, so a fresh interpreter
+per probe spends most of its time importing them. This server imports a
+configurable set of heavy packages once, then serves each probe from a forked
+child of that warm parent:
+
+  - the child gets a hard time limit (SIGALRM with the default action) and,
+    with --memory_mb, an address-space limit (RLIMIT_AS) of that much on top
+    of what the preload already maps (off by default, as in import_probe);
+  - the child's sys.modules is reset to the post-preload snapshot minus any
+    module a repo file would shadow, and sys.path / PYTHONPATH are set up
+    as for `PYTHONPATH=<project_root> python -c ...`;
+  - the child reports (returncode, stderr) as the interpreter would, so the
+    critiques built from it match import_probe exactly. Each child is forked
+    from a small supervisor process that waits for it, so a child killed by a
+    signal is reported like a killed interpreter (returncode -N).
+
+Probes arrive on a Unix socket, one connection per probe, and are forked as
+they arrive, so probes from every static-analysis worker run concurrently.
+The server itself stays single-threaded, which keeps fork safe.
+
+Usage (normally started by ProbeService):
+    python probe_server.py --socket /tmp/probe.sock --preload torch,transformers
+"""
+
+import argparse
+import importlib
+import io
+import json
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import traceback
+
+DEFAULT_PRELOAD = "numpy,torch,torchvision,transformers"
+DEFAULT_MEMORY_MB = 0  # no limit, as import_probe
+
+
+# ---------------------------------------------------------------------------
+# Server
+# ---------------------------------------------------------------------------
+
+def preload_modules(names):
+    loaded = []
+    for name in names:
+        try:
+            __import__(name)
+            loaded.append(name)
+        except Exception:
+            pass
+    return loaded
+
+
+def _repo_module_names(project_root):
+    names = set()
+    if project_root and os.path.isdir(project_root):
+        for entry in os.listdir(project_root):
+            if entry.endswith(".py"):
+                names.add(entry[:-3])
+            elif os.path.isdir(os.path.join(project_root, entry)):
+                names.add(entry)
+    return names
+
+
+def run_probe(filepath, project_root, baseline_modules):
+    """
+    Runs in the forked child: the import_probe script, with interpreter-style
+    exit handling. Returns (returncode, stderr).
+    """
+    # sys.modules hygiene: nothing imported after preload, nothing a repo file would shadow
+    shadowed = _repo_module_names(project_root)
+    for name in list(sys.modules):
+        top = name.split(".", 1)[0]
+        if name not in baseline_modules or top in shadowed:
+            del sys.modules[name]
+    # `python -c`: the working directory first (not this script's directory), then PYTHONPATH
+    sys.path[0] = ""
+    if project_root:
+        os.environ["PYTHONPATH"] = project_root + ":" + os.environ.get("PYTHONPATH", "")
+        sys.path.insert(1, project_root)
+    sys.argv = ["-c"]
+    importlib.invalidate_caches()
+
+    stderr = io.StringIO()
+    sys.stderr = stderr
+    sys.stdout = io.StringIO()
+    code = (f"import importlib.util,sys\n"
+            f"s=importlib.util.spec_from_file_location('_p',r'{os.path.abspath(filepath)}')\n"
+            f"if s and s.loader:\n m=importlib.util.module_from_spec(s)\n s.loader.exec_module(m)\n"
+            f"else: sys.exit(1)\n")
+    returncode = 0
+    try:
+        exec(compile(code, "<string>", "exec"), {"__name__": "__main__"})
+    except SystemExit as e:
+        if e.code is None:
+            returncode = 0
+        elif isinstance(e.code, int):
+            returncode = e.code
+        else:
+            print(e.code, file=stderr)
+            returncode = 1
+    except BaseException:
+        traceback.print_exc(file=stderr)
+        returncode = 1
+    return returncode, stderr.getvalue()
+
+
+def _address_space():
+    """Virtual memory currently mapped by this process (0 where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _serve_one(conn, baseline_modules, memory_mb):
+    """Probe side of one probe; never returns."""
+    status = 1
+    try:
+        request = json.loads(conn.makefile("r").readline())
+        # output written below the interpreter level must not reach the server's terminal
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        if memory_mb:
+            # on top of the preloaded packages, which the cold probe would not count against it
+            limit = _address_space() + memory_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        # hard stop slightly after the client gives up
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        signal.alarm(int(request.get("timeout", 15)) + 1)
+        returncode, stderr = run_probe(request["filepath"], request.get("project_root"), baseline_modules)
+        conn.sendall((json.dumps({"returncode": returncode, "stderr": stderr}) + "\n").encode())
+        status = 0
+    except BaseException:
+        pass
+    finally:
+        os._exit(status)
+
+
+def _supervise_one(conn, baseline_modules, memory_mb):
+    """Child side of one probe: forks the probe and reports it if it dies of a signal; never returns."""
+    try:
+        # the server ignores SIGCHLD, which would make waitpid fail
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        pid = os.fork()
+        if pid == 0:
+            _serve_one(conn, baseline_modules, memory_mb)
+        _, status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            conn.sendall((json.dumps({"returncode": -os.WTERMSIG(status), "stderr": ""}) + "\n").encode())
+    except BaseException:
+        pass
+    finally:
+        os._exit(0)
+
+
+def serve(socket_path, preload, memory_mb):
+    loaded = preload_modules(preload)
+    baseline_modules = set(sys.modules)
+    # children are reaped by the kernel
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(64)
+    print(json.dumps({"ready": True, "preloaded": loaded}), flush=True)
+
+    while True:
+        conn, _ = listener.accept()
+        if os.fork() == 0:
+            listener.close()
+            _supervise_one(conn, baseline_modules, memory_mb)
+        conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Client
+# ---------------------------------------------------------------------------
+
+class ProbeService:
+    """
+    Starts probe_server.py in the background and sends it probes.
+
+    `probe` returns the raw (returncode, stderr) of the import, or None if the
+    probe timed out; static_analysis turns it into critiques.
+    """
+
+    def __init__(self, preload=DEFAULT_PRELOAD, memory_mb=DEFAULT_MEMORY_MB):
+        self.socket_dir = tempfile.mkdtemp(prefix="probe_")
+        self.socket_path = os.path.join(self.socket_dir, "probe.sock")
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--socket", self.socket_path,
+             "--preload", preload if isinstance(preload, str) else ",".join(preload),
+             "--memory_mb", str(memory_mb)],
+            stdout=subprocess.PIPE, text=True)
+        # the server prints one line once the preloads are imported and the socket is listening
+        line = self.proc.stdout.readline()
+        if not line:
+            self.close()
+            raise RuntimeError("probe server failed to start")
+        self.preloaded = json.loads(line).get("preloaded", [])
+
+    def probe(self, filepath, project_root=None, timeout=15):
+        return probe_via_socket(self.socket_path, filepath, project_root, timeout)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        os.rmdir(self.socket_dir)
+
+
+def probe_via_socket(socket_path, filepath, project_root=None, timeout=15):
+    """One probe against a running server; usable from any process (see StaticAnalysisEngine)."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(socket_path)
+        conn.sendall((json.dumps({"filepath": filepath, "project_root": project_root,
+                                  "timeout": timeout}) + "\n").encode())
+        try:
+            data = conn.makefile("r").readline()
+        except socket.timeout:
+            return None
+    if not data:
+        # neither the child nor its supervisor answered: count it as killed
+        return -signal.SIGKILL, ""
+    result = json.loads(data)
+    return result["returncode"], result["stderr"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', type=str, required=True)
+    parser.add_argument('--preload', type=str, default=DEFAULT_PRELOAD)
+    parser.add_argument('--memory_mb', type=int, default=DEFAULT_MEMORY_MB,
+                        help="Address space a probe may add on top of the preload (0 = no limit)")
+    args = parser.parse_args()
+    serve(args.socket, [m for m in args.preload.split(",") if m], args.memory_mb)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+prompts.py
+
+Prompt assembly for the stages that send the planning context (analyzing and
+coding), laid out for provider-side prompt caching.
+
+Providers cache on the longest exact token prefix shared with a recent request,
+so every request is built as
+
+  [system] shared context   paper, plan overview, design, task, config.yaml
+           + stage prompt   identical for every file of a stage
+  [user]   per-file delta   growing-but-append-only parts first (code files
+                            written so far), the file-specific instruction last
+
+The shared context is rendered once per process from the same inputs, so it is
+byte-identical for every file, every feedback iteration, every experiment on
+the same planning output and across the analyzing and coding stages.
+"""
+
+import json
+import os
+
+from paper_render import render_markdown
+
+
+def render_paper(paper_content):
+    """Paper text as sent to the model: LaTeX as is, S2ORC JSON as compact markdown (paper_render.py)."""
+    if isinstance(paper_content, str):
+        return paper_content
+    return render_markdown(paper_content)
+
+
+def render_shared_context(paper_content, context_lst, config_yaml):
+    return f"""# Context
+## Paper
+{render_paper(paper_content)}
+
+-----
+
+## Overview of the plan
+{context_lst[0]}
+
+-----
+
+## Design
+{context_lst[1]}
+
+-----
+
+## Task
+{context_lst[2]}
+
+-----
+
+## Configuration file
+```yaml
+{config_yaml}
+```
+-----
+"""
+
+
+class PromptLayout:
+    """
+    Builds cache-friendly message lists for one planning output.
+
+    `stage_prompt` is the stage's former system message; it follows the shared
+    context so that every stage starts with the same bytes. With a
+    ContextBudgeter (context_budget.py) the paper is pruned for the request's
+    `query` only when the full prompt would not fit.
+    """
+
+    def __init__(self, paper_content, context_lst, config_yaml, budgeter=None):
+        self.paper_content = paper_content
+        self.context_lst = context_lst
+        self.config_yaml = config_yaml
+        self.budgeter = budgeter
+        self.shared_context = render_shared_context(paper_content, context_lst, config_yaml)
+
+    def messages(self, stage_prompt, delta, query="", label="", paper_content=None):
+        """`paper_content` replaces the full paper for this request (e.g. retrieved sections)."""
+        paper = self.paper_content if paper_content is None else paper_content
+        if self.budgeter is not None:
+            fixed_text = render_shared_context("", self.context_lst, self.config_yaml) + stage_prompt + delta
+            paper = self.budgeter.fit(paper, fixed_text, query, label)
+        shared_context = self.shared_context
+        if paper is not self.paper_content:
+            shared_context = render_shared_context(paper, self.context_lst, self.config_yaml)
+        return [
+            {"role": "system", "content": f"{shared_context}\n{stage_prompt}"},
+            {"role": "user", "content": delta},
+        ]
+
+
+def prompt_cache_stats(prompt_tokens, cached_tokens):
+    return {
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "hit_ratio": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+    }
+
+
+def cached_tokens_of(completion):
+    """usage.prompt_tokens_details.cached_tokens, or 0 when the provider does not report it."""
+    usage = getattr(completion, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None) if usage else None
+    return (getattr(details, "cached_tokens", 0) or 0) if details else 0
+
+
+def record_prompt_cache_stats(output_dir, stage, stats, summary_path=None):
+    """
+    Stores `stats` under `stage` in {output_dir}/prompt_cache_stats.json and,
+    when given, in the "prompt_cache" section of this run's experiment summary.
+    """
+    paths = [os.path.join(output_dir, "prompt_cache_stats.json")]
+    if summary_path is not None:
+        paths.append(str(summary_path))
+    for path in paths:
+        data = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        if path == paths[0]:
+            data[stage] = stats
+        else:
+            data.setdefault("prompt_cache", {})[stage] = stats
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+
+    print(f"📦 Prompt cache [{stage}]: {stats['cached_tokens']:,} / {stats['prompt_tokens']:,} "
+          f"prompt tokens cached ({stats['hit_ratio']:.1%})")
@@ -0,0 +1,88 @@
+"""
+replay.py
+
+Offline replay for 2_analyzing_experiments.py (--replay_from <experiment dir>).
+
+A finished run leaves every revision and its critiques in
+analyzing_artifacts/debug_revisions:
+
+  <file>_rev<i>_<tag>.txt               revision i (after hunks were applied)
+  <file>_rev<i>_<tag>_patch.txt         the raw patch reply (--revision_mode patch)
+  <file>_rev<i>_<tag>_critiques.json    {"all", "high_medium"[, "judge_response"]}
+
+where <tag> is "<mode>_<feedback_format>" of the recorded run. ReplaySource
+serves these as the LLM replies of a new run, keyed by (file, iteration), so
+get_critiques, merge_critiques and the stopping policies run for real while
+no request leaves the machine. Static channels run live on the repo.
+
+Judge replies are served verbatim when the run recorded them
+("judge_response", written since replay support). Older runs only kept the
+parsed critiques: for the JSON format those are serialized back into a
+critique_list, which parses to the same critiques; for the free-text format
+the recorded critique text (the first 500 characters of the reply) is served.
+
+Token usage is estimated from the served text (4 characters per token).
+"""
+
+import glob
+import json
+import os
+
+CHARS_PER_TOKEN = 4
+
+
+class ReplayMissError(RuntimeError):
+    """The recorded run has no reply for this file and iteration."""
+
+
+class ReplaySource:
+    def __init__(self, experiment_dir, tag=None):
+        self.debug_dir = os.path.join(experiment_dir, "analyzing_artifacts", "debug_revisions")
+        if not os.path.isdir(self.debug_dir):
+            raise FileNotFoundError(f"No debug_revisions under {experiment_dir}")
+        self.tag = tag or self.detect_tag(experiment_dir)
+        self.served = 0
+
+    @staticmethod
+    def detect_tag(experiment_dir):
+        """The <mode>_<feedback_format> of the run recorded in `experiment_dir`."""
+        summaries = glob.glob(os.path.join(experiment_dir, "experiment_summary_*.json"))
+        if len(summaries) != 1:
+            raise ValueError(f"Cannot tell which run to replay in {experiment_dir}; pass --replay_tag")
+        return os.path.basename(summaries[0])[len("experiment_summary_"):-len(".json")]
+
+    def _path(self, todo_file_name, iteration, suffix=""):
+        safe_name = todo_file_name.replace("/", "_")
+        return os.path.join(self.debug_dir, f"{safe_name}_rev{iteration}_{self.tag}{suffix}")
+
+    def has(self, todo_file_name, iteration):
+        return os.path.exists(self._path(todo_file_name, iteration, ".txt"))
+
+    def _read(self, path):
+        if not os.path.exists(path):
+            raise ReplayMissError(f"Nothing recorded at {path}")
+        self.served += 1
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+
+    def revision(self, todo_file_name, iteration, patch=False):
+        """The generation reply of `iteration`: the raw patch reply if asked for and recorded."""
+        patch_path = self._path(todo_file_name, iteration, "_patch.txt")
+        if patch and os.path.exists(patch_path):
+            return self._read(patch_path)
+        return self._read(self._path(todo_file_name, iteration, ".txt"))
+
+    def judge_response(self, todo_file_name, iteration, feedback_format):
+        recorded = json.loads(self._read(self._path(todo_file_name, iteration, "_critiques.json")))
+        if "judge_response" in recorded:
+            return recorded["judge_response"]
+        judged = [c for c in recorded.get("all", []) if str(c.get("source", "")).startswith("llm-judge")]
+        if feedback_format == "freetext":
+            return "\n\n".join(c.get("critique", "") for c in judged)
+        return json.dumps({"critique_list": [{k: v for k, v in c.items() if k != "source"} for c in judged]})
+
+
+def add_usage(usage, prompt_messages, reply):
+    """Estimated token usage of a replayed call."""
+    usage["prompt_tokens"] += sum(len(str(m.get("content", ""))) for m in prompt_messages) // CHARS_PER_TOKEN + 1
+    usage["completion_tokens"] += len(reply) // CHARS_PER_TOKEN + 1
@@ -0,0 +1,184 @@
+"""
+retrieval.py
+
+Local retrieval over paper sections, used by 3_coding.py (--retrieval_top_k)
+to give each file only the sections relevant to its logic analysis.
+
+Sections are the ones of context_budget.parse_sections. The index is built once
+per paper (keyed by a hash of the paper file) under --retrieval_index_dir and
+read back through mmap, so later runs and stages only map the files:
+
+  meta.json        section titles, BM25 parameters, embedding model
+  vocab.json       term -> [term id, document frequency]
+  offsets.i32      per-term start offsets into postings.i32 (n_terms + 1)
+  postings.i32     (section id, term frequency) pairs grouped by term
+  doclen.i32       section lengths in terms
+  embeddings.f32   optional unit-normalized section vectors (n_sections x dim)
+
+Scoring is BM25, optionally mixed with the cosine similarity of a local
+sentence-transformers model (--retrieval_embed_model).
+"""
+
+import hashlib
+import json
+import math
+import mmap
+import os
+import shutil
+import tempfile
+from array import array
+from collections import Counter
+
+from context_budget import parse_sections, render_sections, section_terms
+
+INDEX_VERSION = 2
+BM25_K1 = 1.5
+BM25_B = 0.75
+EMBED_WEIGHT = 0.5
+
+
+def _load_embedder(model_name):
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        print("[WARNING] sentence-transformers is not installed; retrieval uses BM25 only.")
+        return None
+    return SentenceTransformer(model_name)
+
+
+def _map(path, typecode):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(array(typecode))
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mm).cast(typecode)
+
+
+class SectionIndex:
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, "vocab.json"), encoding="utf-8") as f:
+            self.vocab = json.load(f)
+        self.offsets = _map(os.path.join(index_dir, "offsets.i32"), "i")
+        self.postings = _map(os.path.join(index_dir, "postings.i32"), "i")
+        self.doclen = _map(os.path.join(index_dir, "doclen.i32"), "i")
+        self.embeddings = None
+        self.embedder = None
+        if self.meta.get("embed_model"):
+            self.embeddings = _map(os.path.join(index_dir, "embeddings.f32"), "f")
+            self.embedder = _load_embedder(self.meta["embed_model"])
+
+    @staticmethod
+    def paper_hash(paper_path):
+        with open(paper_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @classmethod
+    def load_or_build(cls, paper_path, paper_content, index_root, embed_model=""):
+        key = f"{cls.paper_hash(paper_path)[:16]}_v{INDEX_VERSION}"
+        if embed_model:
+            key += "_" + hashlib.sha256(embed_model.encode()).hexdigest()[:8]
+        index_dir = os.path.join(index_root, key)
+        if not os.path.exists(os.path.join(index_dir, "meta.json")):
+            print(f"[RETRIEVAL] Building section index for {paper_path} -> {index_dir}")
+            cls.build(paper_content, index_dir, embed_model)
+        return cls(index_dir)
+
+    @staticmethod
+    def build(paper_content, index_dir, embed_model=""):
+        sections = parse_sections(paper_content)
+        doc_terms = [Counter(section_terms(s.title + "\n" + s.text)) for s in sections]
+
+        vocab = {}
+        postings_by_term = {}
+        for doc_id, terms in enumerate(doc_terms):
+            for term, tf in sorted(terms.items()):
+                postings_by_term.setdefault(term, []).append((doc_id, tf))
+        offsets, postings = array("i", [0]), array("i")
+        for term_id, term in enumerate(sorted(postings_by_term)):
+            vocab[term] = [term_id, len(postings_by_term[term])]
+            for doc_id, tf in postings_by_term[term]:
+                postings.extend((doc_id, tf))
+            offsets.append(len(postings) // 2)
+        doclen = array("i", [sum(terms.values()) for terms in doc_terms])
+
+        meta = {
+            "version": INDEX_VERSION,
+            "n_sections": len(sections),
+            "avgdl": sum(doclen) / len(doclen) if doclen else 0.0,
+            "k1": BM25_K1,
+            "b": BM25_B,
+            "embed_model": "",
+            "dim": 0,
+            "sections": [s.title for s in sections],
+        }
+
+        # build next to the final location, then move into place in one step
+        os.makedirs(os.path.dirname(index_dir) or ".", exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(index_dir) or ".")
+        for name, data in (("offsets.i32", offsets), ("postings.i32", postings), ("doclen.i32", doclen)):
+            with open(os.path.join(tmp_dir, name), "wb") as f:
+                data.tofile(f)
+
+        embedder = _load_embedder(embed_model) if embed_model else None
+        if embedder is not None:
+            vectors = embedder.encode([s.title + "\n" + s.text for s in sections], normalize_embeddings=True)
+            with open(os.path.join(tmp_dir, "embeddings.f32"), "wb") as f:
+                array("f", [float(x) for row in vectors for x in row]).tofile(f)
+            meta["embed_model"] = embed_model
+            meta["dim"] = len(vectors[0]) if len(vectors) else 0
+
+        with open(os.path.join(tmp_dir, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(vocab, f)
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        try:
+            os.rename(tmp_dir, index_dir)
+        except OSError:
+            # another process built it first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def search(self, query, k):
+        """Returns [(section_id, score)] for the k best sections that match the query at all."""
+        n_docs = self.meta["n_sections"]
+        k1, b, avgdl = self.meta["k1"], self.meta["b"], self.meta["avgdl"] or 1.0
+        scores = [0.0] * n_docs
+        for term, qtf in Counter(section_terms(query)).items():
+            if term not in self.vocab:
+                continue
+            term_id, df = self.vocab[term]
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for pos in range(self.offsets[term_id], self.offsets[term_id + 1]):
+                doc_id, tf = self.postings[2 * pos], self.postings[2 * pos + 1]
+                norm = tf + k1 * (1 - b + b * self.doclen[doc_id] / avgdl)
+                scores[doc_id] += min(qtf, 3) * idf * tf * (k1 + 1) / norm
+
+        if self.embedder is not None:
+            top = max(scores) or 1.0
+            dim = self.meta["dim"]
+            q = self.embedder.encode([query], normalize_embeddings=True)[0]
+            for doc_id in range(n_docs):
+                vec = self.embeddings[doc_id * dim:(doc_id + 1) * dim]
+                cosine = sum(float(a) * float(b_) for a, b_ in zip(q, vec))
+                scores[doc_id] = scores[doc_id] / top + EMBED_WEIGHT * cosine
+
+        ranked = sorted((d for d in range(n_docs) if scores[d] > 0), key=lambda d: -scores[d])
+        return [(doc_id, scores[doc_id]) for doc_id in ranked[:k]]
+
+    def retrieve(self, paper_content, query, k):
+        """
+        Returns (paper subset holding the top-k sections in paper order, hits);
+        the whole paper when no section matches. `paper_content` must be the
+        paper the index was built from.
+        """
+        sections = parse_sections(paper_content)
+        if len(sections) != self.meta["n_sections"]:
+            raise ValueError(f"Index {self.index_dir} was built from a different paper")
+        hits = self.search(query, k)
+        if not hits:
+            return paper_content, []
+        kept_keys = {sections[doc_id].key for doc_id, _ in hits}
+        subset = render_sections(paper_content, sections, kept_keys, mark_omitted=False)
+        return subset, [{"section": sections[doc_id].title, "score": round(score, 4)} for doc_id, score in hits]
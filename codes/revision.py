@@ -0,0 +1,77 @@
+"""
+revision.py
+
+Patch-based revision for the analyzing feedback loop
+(2_analyzing_experiments.py --revision_mode patch).
+
+Instead of rewriting the whole analysis, the model answers the critiques with
+a list of hunks against the current analysis, which are applied locally:
+
+  {"hunks": [
+     {"op": "replace",      "target": "<exact text>", "text": "<new text>"},
+     {"op": "insert_after", "target": "<exact text>", "text": "<text to add>"},
+     {"op": "delete",       "target": "<exact text>"}
+  ]}
+
+Each revision prompt carries only the current analysis and its open critiques,
+not the transcript of earlier revisions.
+"""
+
+import json
+
+HUNK_OPS = ("replace", "insert_after", "delete")
+
+
+def patch_request(todo_file_name, hi_med):
+    return f"""The following critiques were raised for `{todo_file_name}`:
+
+{json.dumps(hi_med, indent=2)}
+
+Revise the analysis above to address these critiques. Do NOT rewrite it; respond only with the edits as JSON:
+{{
+  "hunks": [
+    {{"op": "replace", "target": "<exact text copied from the analysis>", "text": "<replacement>"}},
+    {{"op": "insert_after", "target": "<exact text copied from the analysis>", "text": "<text to insert>"}},
+    {{"op": "delete", "target": "<exact text copied from the analysis>"}}
+  ]
+}}
+
+Each "target" must appear verbatim in the current analysis and be long enough to be unique."""
+
+
+def parse_hunks(response):
+    """Returns the hunk list, or None if the response is not a hunk document."""
+    start = response.find('{')
+    end = response.rfind('}') + 1
+    if start < 0 or end <= start:
+        return None
+    try:
+        data = json.loads(response[start:end])
+    except json.JSONDecodeError:
+        return None
+    hunks = data.get("hunks") if isinstance(data, dict) else None
+    if not isinstance(hunks, list):
+        return None
+    return [h for h in hunks if isinstance(h, dict) and h.get("op") in HUNK_OPS and h.get("target")]
+
+
+def apply_hunks(text, hunks):
+    """
+    Applies hunks in order. A hunk whose target is missing or ambiguous is
+    skipped. Returns (new_text, n_applied, failed_hunks).
+    """
+    applied, failed = 0, []
+    for hunk in hunks:
+        target = hunk["target"]
+        if text.count(target) != 1:
+            failed.append(hunk)
+            continue
+        new_text = hunk.get("text", "")
+        if hunk["op"] == "replace":
+            text = text.replace(target, new_text, 1)
+        elif hunk["op"] == "insert_after":
+            text = text.replace(target, target + new_text, 1)
+        else:
+            text = text.replace(target, "", 1)
+        applied += 1
+    return text, applied, failed
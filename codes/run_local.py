@@ -0,0 +1,78 @@
+"""
+run_local.py
+
+Runs the local-model pipeline of scripts/run_llm.sh for one paper in a single
+process:
+
+    1_planning_llm -> 1.1_extract_config -> (config.yaml into the repo dir)
+                   -> 2_analyzing_llm -> 3_coding_llm
+
+Every stage script runs as __main__ with its usual command line, so they all
+share backends._ENGINES: the vLLM engine is loaded (and its CUDA graphs
+captured) once per paper instead of once per stage. Flags this script does not
+know are passed on to the model stages, e.g. --tp_size, --temperature,
+--enforce_eager, or --backend server --base_url ... for a running `vllm serve`.
+With --prefix_caching the KV cache of the shared planning context also carries
+over from analyzing to coding.
+
+Usage:
+    python run_local.py --paper_name Transformer --pdf_json_path ../examples/Transformer_cleaned.json \\
+        --output_dir ../outputs/Transformer_dscoder --output_repo_dir ../outputs/Transformer_dscoder_repo \\
+        --model_name deepseek-ai/DeepSeek-Coder-V2-Lite-Instruct --tp_size 2
+"""
+
+import argparse
+import os
+import runpy
+import shutil
+import sys
+import time
+
+CODES_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGES = ["planning", "extract_config", "analyzing", "coding"]
+
+
+def run_stage(script, argv):
+    """Runs codes/<script> as __main__ with `argv` in this process; returns the script's globals."""
+    saved_argv = sys.argv
+    sys.argv = [script] + argv
+    start = time.time()
+    try:
+        stage_globals = runpy.run_path(os.path.join(CODES_DIR, script), run_name="__main__")
+    finally:
+        sys.argv = saved_argv
+    print(f"[run_local] {script} finished in {time.time() - start:.1f}s")
+    return stage_globals
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paper_name', type=str, required=True)
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--output_repo_dir', type=str, required=True)
+    parser.add_argument('--stages', type=str, default=",".join(STAGES),
+                        help=f"Comma-separated subset of {STAGES} to run")
+    args, stage_args = parser.parse_known_args()
+
+    stages = {s.strip() for s in args.stages.split(",") if s.strip()}
+    common = ["--paper_name", args.paper_name, "--output_dir", args.output_dir]
+    os.makedirs(args.output_dir, exist_ok=True)
+    os.makedirs(args.output_repo_dir, exist_ok=True)
+
+    start = time.time()
+    if "planning" in stages:
+        run_stage("1_planning_llm.py", common + stage_args)
+    if "extract_config" in stages:
+        run_stage("1.1_extract_config.py", common)
+        shutil.copy(os.path.join(args.output_dir, "planning_config.yaml"),
+                    os.path.join(args.output_repo_dir, "config.yaml"))
+    if "analyzing" in stages:
+        run_stage("2_analyzing_llm.py", common + stage_args)
+    if "coding" in stages:
+        run_stage("3_coding_llm.py", common + ["--output_repo_dir", args.output_repo_dir] + stage_args)
+    print(f"[run_local] {args.paper_name}: {', '.join(s for s in STAGES if s in stages)} "
+          f"in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+run_pipeline.py
+
+Resumable, checkpointed replacement for the shell orchestration in
+scripts/run_all_experiments.sh. Runs the whole pipeline for one paper as a DAG:
+
+    planning -> extract_config -> analyzing[mode,format] -> coding[mode,format]
+             -> eval[mode,format] -> collect_results
+
+Every node writes a manifest to <output_dir>/.pipeline/<node>.json holding a
+hash of its inputs (command line, upstream node hashes and the contents of the
+files it reads). On the next run:
+  - a node whose manifest is complete and whose input hash is unchanged is skipped,
+  - a node that crashed with the same inputs is re-run with --resume, so
+    2_analyzing_experiments.py and 3_coding.py continue at file / iteration granularity,
+  - a node whose inputs changed is re-run from scratch.
+A failing node only blocks its own dependents; independent experiments keep going.
+
+Usage:
+    python run_pipeline.py --paper_name transformer \
+        --pdf_json_path ../examples/Transformer_cleaned.json \
+        --output_dir ../outputs/transformer --data_dir ../data
+
+    # only (re-)run the analyzing experiments, planning must already exist
+    python run_pipeline.py ... --stages analyzing
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from utils import CACHE_MODES
+
+CODES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = ["planning", "extract_config", "analyzing", "coding", "eval", "collect_results"]
+DEFAULT_EXPERIMENTS = "llm_only:json,llm_only:freetext,static_only:json,multi_signal:json"
+
+
+class Node:
+    """One step of the pipeline: a stage script invocation plus what it reads and writes."""
+
+    def __init__(self, name, stage, cmd, runtime_args=(), deps=(), inputs=(), outputs=(),
+                 resumable=False, adopt_existing=False, before=None, stdout_path=None):
+        self.name = name
+        self.stage = stage
+        self.cmd = cmd
+        self.runtime_args = list(runtime_args)  # flags that do not change results; not hashed
+        self.deps = list(deps)
+        self.inputs = list(inputs)          # files / globs whose contents feed the hash
+        self.outputs = list(outputs)        # files / globs that must exist afterwards
+        self.resumable = resumable          # script understands --resume
+        self.adopt_existing = adopt_existing  # outputs made before the runner existed count as done
+        self.before = before                # callable run before the command
+        self.stdout_path = stdout_path
+        self.input_hash = None
+
+
+def _expand(patterns):
+    paths = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern, recursive=True))
+        paths.extend(p for p in matched if os.path.isfile(p))
+    return paths
+
+
+def hash_inputs(node, nodes):
+    h = hashlib.sha256()
+    h.update(json.dumps(node.cmd).encode("utf-8"))
+    for dep in node.deps:
+        h.update((nodes[dep].input_hash or "").encode("utf-8"))
+    for path in _expand(node.inputs):
+        h.update(path.encode("utf-8"))
+        with open(path, "rb") as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+def outputs_exist(node):
+    return all(glob.glob(pattern, recursive=True) for pattern in node.outputs)
+
+
+def load_manifest(manifest_dir, node):
+    path = os.path.join(manifest_dir, f"{node.name}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_dir, node, status):
+    os.makedirs(manifest_dir, exist_ok=True)
+    path = os.path.join(manifest_dir, f"{node.name}.json")
+    manifest = {
+        "node": node.name,
+        "status": status,
+        "input_hash": node.input_hash,
+        "cmd": node.cmd,
+        "outputs": node.outputs,
+        "updated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def run_node(node, nodes, manifest_dir, force=False):
+    """Run (or skip) one node. Returns True when its outputs are up to date."""
+    node.input_hash = hash_inputs(node, nodes)
+    manifest = load_manifest(manifest_dir, node)
+
+    if not force:
+        if manifest is None and node.adopt_existing and outputs_exist(node):
+            print(f"[ADOPT] {node.name}: outputs already exist, recording manifest")
+            save_manifest(manifest_dir, node, "complete")
+            return True
+        if (manifest and manifest["status"] == "complete"
+                and manifest["input_hash"] == node.input_hash and outputs_exist(node)):
+            print(f"[SKIP] {node.name}: inputs unchanged")
+            return True
+
+    cmd = node.cmd + node.runtime_args
+    same_inputs = manifest is not None and manifest["input_hash"] == node.input_hash
+    if node.resumable and same_inputs and manifest["status"] != "complete" and not force:
+        print(f"[RESUME] {node.name}")
+        cmd.append("--resume")
+    else:
+        print(f"[RUN] {node.name}")
+
+    save_manifest(manifest_dir, node, "running")
+    if node.before:
+        node.before()
+
+    if node.stdout_path:
+        with open(node.stdout_path, "w", encoding="utf-8") as f:
+            result = subprocess.run(cmd, cwd=CODES_DIR, stdout=f)
+    else:
+        result = subprocess.run(cmd, cwd=CODES_DIR)
+
+    if result.returncode != 0 or not outputs_exist(node):
+        print(f"[FAILED] {node.name} (exit code {result.returncode})")
+        save_manifest(manifest_dir, node, "failed")
+        return False
+
+    save_manifest(manifest_dir, node, "complete")
+    return True
+
+
+def build_nodes(args):
+    py = sys.executable
+    out = os.path.abspath(args.output_dir)
+    pdf_json_path = os.path.abspath(args.pdf_json_path) if args.pdf_json_path else ""
+    pdf_latex_path = os.path.abspath(args.pdf_latex_path) if args.pdf_latex_path else ""
+    paper_path = pdf_json_path if args.paper_format == "JSON" else pdf_latex_path
+    data_dir = os.path.abspath(args.data_dir)
+    paper_args = ["--paper_name", args.paper_name, "--paper_format", args.paper_format,
+                  "--pdf_json_path", pdf_json_path, "--pdf_latex_path", pdf_latex_path]
+    runtime_args = ["--cache_mode", args.cache_mode]
+    if args.base_url:
+        runtime_args += ["--base_url", args.base_url]
+    planning_files = [f"{out}/planning_trajectories.json", f"{out}/planning_config.yaml", f"{out}/task_list.json"]
+
+    nodes = {}
+    nodes["planning"] = Node(
+        "planning", "planning",
+        [py, "1_planning.py", *paper_args, "--gpt_version", args.gpt_version,
+         "--output_dir", out],
+        runtime_args=runtime_args,
+        inputs=[paper_path],
+        outputs=[f"{out}/planning_trajectories.json"],
+        adopt_existing=True)
+    nodes["extract_config"] = Node(
+        "extract_config", "extract_config",
+        [py, "1.1_extract_config.py", "--paper_name", args.paper_name, "--output_dir", out],
+        deps=["planning"],
+        inputs=[f"{out}/planning_trajectories.json"],
+        outputs=[f"{out}/planning_config.yaml", f"{out}/planning_context.json"],
+        adopt_existing=True)
+
+    for experiment in args.experiments.split(","):
+        mode, fmt = experiment.strip().split(":")
+        exp_name = f"{mode}_{fmt}"
+        exp_out = f"{out}/experiments/{exp_name}"
+        repo_dir = f"{exp_out}/{args.paper_name}_repo"
+
+        def copy_planning(exp_out=exp_out):
+            os.makedirs(exp_out, exist_ok=True)
+            # the parsed bundle (planning_context.py) too; it is keyed by the hash of the files above
+            for path in planning_files + [f"{out}/planning_context.json"]:
+                if os.path.exists(path):
+                    shutil.copy(path, exp_out)
+
+        def copy_config(repo_dir=repo_dir):
+            os.makedirs(repo_dir, exist_ok=True)
+            shutil.copy(f"{out}/planning_config.yaml", f"{repo_dir}/config.yaml")
+
+        nodes[f"analyzing[{exp_name}]"] = Node(
+            f"analyzing[{exp_name}]", "analyzing",
+            [py, "2_analyzing_experiments.py", *paper_args, "--gpt_version", args.gpt_version,
+             "--output_dir", exp_out, "--mode", mode, "--feedback_format", fmt,
+             "--output_repo_dir", f"{out}/{args.paper_name}_repo"],
+            runtime_args=[*runtime_args, "--concurrency", str(args.concurrency)],
+            deps=["extract_config"],
+            inputs=[paper_path, *planning_files],
+            outputs=[f"{exp_out}/experiment_summary_{mode}_{fmt}.json"],
+            resumable=True,
+            before=copy_planning)
+        nodes[f"coding[{exp_name}]"] = Node(
+            f"coding[{exp_name}]", "coding",
+            [py, "3_coding.py", *paper_args, "--gpt_version", args.gpt_version,
+             "--output_dir", exp_out, "--output_repo_dir", repo_dir],
+            runtime_args=runtime_args,
+            deps=[f"analyzing[{exp_name}]"],
+            inputs=[f"{exp_out}/*_simple_analysis_response.json"],
+            outputs=[f"{exp_out}/coding_artifacts/coding_progress.json"],
+            resumable=True,
+            before=copy_config)
+        nodes[f"eval[{exp_name}]"] = Node(
+            f"eval[{exp_name}]", "eval",
+            [py, "eval.py", "--paper_name", args.paper_name, "--pdf_json_path", pdf_json_path,
+             "--data_dir", data_dir, "--output_dir", exp_out, "--target_repo_dir", repo_dir,
+             "--eval_result_dir", f"{exp_out}/eval_results", "--eval_type", args.eval_type,
+             "--generated_n", str(args.generated_n), "--gpt_version", args.gpt_version,
+             "--papercoder"],
+            runtime_args=runtime_args,
+            deps=[f"coding[{exp_name}]"],
+            inputs=[f"{repo_dir}/**/*.py", f"{repo_dir}/config.yaml"],
+            outputs=[f"{exp_out}/eval_results/{args.paper_name}_eval_{args.eval_type}_*.json"])
+
+    nodes["collect_results"] = Node(
+        "collect_results", "collect_results",
+        [py, "collect_results.py", "--base_dir", os.path.dirname(out),
+         "--papers", os.path.basename(out)],
+        deps=[name for name in nodes if name.startswith("eval[")],
+        inputs=[f"{out}/experiments/*/experiment_summary_*.json",
+                f"{out}/experiments/*/eval_results/*.json"],
+        outputs=[f"{out}/results_tables.txt"],
+        stdout_path=f"{out}/results_tables.txt")
+    return nodes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paper_name', type=str, required=True)
+    parser.add_argument('--paper_format', type=str, default="JSON", choices=["JSON", "LaTeX"])
+    parser.add_argument('--pdf_json_path', type=str, default="")
+    parser.add_argument('--pdf_latex_path', type=str, default="")
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help="Per-paper output dir (experiments go under <output_dir>/experiments)")
+    parser.add_argument('--data_dir', type=str, default="../data")
+    parser.add_argument('--gpt_version', type=str, default="o3-mini")
+    parser.add_argument('--experiments', type=str, default=DEFAULT_EXPERIMENTS,
+                        help="Comma-separated mode:feedback_format pairs")
+    parser.add_argument('--stages', type=str, default=",".join(STAGES),
+                        help=f"Comma-separated subset of {STAGES} to run")
+    parser.add_argument('--force', type=str, default="",
+                        help="Comma-separated node names (or stage names) to re-run regardless of manifests")
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--eval_type', type=str, default="ref_free", choices=["ref_free", "ref_based"])
+    parser.add_argument('--generated_n', type=int, default=8)
+    parser.add_argument('--cache_mode', type=str, default="readwrite", choices=CACHE_MODES)
+    parser.add_argument('--base_url', type=str, default=None,
+                        help="OpenAI-compatible endpoint passed to every stage (e.g. mock_server.py)")
+    args = parser.parse_args()
+
+    stages = {s.strip() for s in args.stages.split(",") if s.strip()}
+    force = {f.strip() for f in args.force.split(",") if f.strip()}
+    manifest_dir = os.path.join(os.path.abspath(args.output_dir), ".pipeline")
+
+    nodes = build_nodes(args)
+    status = {}  # name -> "ok" | "failed" | "blocked" | "not-selected"
+    for name, node in nodes.items():  # insertion order is a topological order
+        if node.stage not in stages:
+            node.input_hash = hash_inputs(node, nodes)
+            manifest = load_manifest(manifest_dir, node)
+            done = outputs_exist(node) and (manifest is None or manifest["status"] == "complete")
+            status[name] = "ok" if done else "not-selected"
+            continue
+        if any(status.get(dep) != "ok" for dep in node.deps):
+            print(f"[BLOCKED] {name}: an upstream node failed or has not been run")
+            status[name] = "blocked"
+            continue
+        ok = run_node(node, nodes, manifest_dir, force=name in force or node.stage in force)
+        status[name] = "ok" if ok else "failed"
+
+    print("\n" + "=" * 60)
+    print("PIPELINE STATUS")
+    for name, st in status.items():
+        print(f"  {name:<40} {st}")
+    print("=" * 60)
+
+    if any(st in ("failed", "blocked") for st in status.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
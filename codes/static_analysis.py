@@ -1,10 +1,17 @@
 """
 static_analysis.py  -  Drop into your codes/ directory.
 
-Three zero-token feedback channels + merge/filter helpers.
+Three zero-token feedback channels, the opt-in exec-smoke channel (one tiny
+forward/backward step, see exec_smoke.py), merge/filter helpers, and
+StaticAnalysisEngine, which runs them cached and in parallel.
 """
 
-import ast, json, subprocess, sys, os
+import ast, hashlib, json, multiprocessing, re, subprocess, sys, os, threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from probe_server import ProbeService, probe_via_socket
+
+PYLINT_ARGS = ["--disable=all", "--enable=E0001,E0401,E0602,E1101"]
 
 
 def ast_check(filepath: str) -> list:
@@ -23,11 +30,9 @@ def ast_check(filepath: str) -> list:
 
 
 def pylint_check(filepath: str, timeout: int = 60) -> list:
-    HIGH = {"E0001", "E0401", "E0602"}
     try:
         r = subprocess.run(
-            [sys.executable, "-m", "pylint", "--disable=all",
-             "--enable=E0001,E0401,E0602,E1101",
+            [sys.executable, "-m", "pylint", *PYLINT_ARGS,
              "--output-format=json", filepath],
             capture_output=True, text=True, timeout=timeout)
     except (FileNotFoundError, subprocess.TimeoutExpired):
@@ -36,6 +41,11 @@ def pylint_check(filepath: str, timeout: int = 60) -> list:
         items = json.loads(r.stdout.strip() or "[]")
     except json.JSONDecodeError:
         return []
+    return _pylint_critiques(items)
+
+
+def _pylint_critiques(items: list) -> list:
+    HIGH = {"E0001", "E0401", "E0602"}
     out = []
     for it in items:
         mid = it.get("message-id", "")
@@ -59,11 +69,31 @@ def import_probe(filepath: str, project_root: str = None, timeout: int = 15) ->
         r = subprocess.run([sys.executable, "-c", code],
                            capture_output=True, text=True, timeout=timeout, env=env)
     except subprocess.TimeoutExpired:
+        return _probe_critiques(filepath, None, timeout)
+    return _probe_critiques(filepath, (r.returncode, r.stderr), timeout)
+
+
+def warm_import_probe(filepath: str, probe_socket: str, project_root: str = None, timeout: int = 15) -> list:
+    """import_probe served by a running probe_server.py (same critiques, no interpreter start-up)."""
+    try:
+        result = probe_via_socket(probe_socket, os.path.abspath(filepath), project_root, timeout)
+    except OSError:
+        return import_probe(filepath, project_root, timeout)
+    return _probe_critiques(filepath, result, timeout)
+
+
+def _probe_critiques(filepath: str, result, timeout: int) -> list:
+    """`result` is the probe's (returncode, stderr), or None if it timed out."""
+    if result is None:
         return [{"target_func_name": os.path.basename(filepath),
                  "severity_level": "medium",
                  "critique": f"Import timed out ({timeout}s)", "source": "exec-probe"}]
-    if r.returncode != 0:
-        err = (r.stderr.strip().split("\n") or ["Unknown"])[-1]
+    returncode, stderr = result
+    if returncode < 0 and not stderr.strip():
+        # killed by a signal (e.g. SIGKILL when out of memory, SIGSEGV) before writing a traceback
+        stderr = f"killed by signal {-returncode}"
+    if returncode != 0:
+        err = (stderr.strip().split("\n") or ["Unknown"])[-1]
         sev = "medium" if any(k in err for k in ("FileNotFoundError", "RuntimeError")) else "high"
         return [{"target_func_name": os.path.basename(filepath),
                  "severity_level": sev, "critique": f"Import failed: {err}",
@@ -71,8 +101,68 @@ def import_probe(filepath: str, project_root: str = None, timeout: int = 15) ->
     return []
 
 
+def exec_smoke_check(filepath: str, project_root: str = None, config_path: str = None, timeout: int = 120,
+                     memory_mb: int = 8192) -> list:
+    """
+    Runs one forward/backward step of the file's nn.Modules on a shrunk
+    config.yaml (exec_smoke.py) in a throwaway copy of the repo.
+    """
+    import shutil, tempfile
+    import yaml
+    from exec_smoke import shrink_config
+
+    project_root = os.path.abspath(project_root or os.path.dirname(filepath))
+    config_path = config_path or os.path.join(project_root, "config.yaml")
+    rel = os.path.relpath(os.path.abspath(filepath), project_root)
+    with tempfile.TemporaryDirectory(prefix="smoke_") as sandbox:
+        shutil.copytree(project_root, sandbox, dirs_exist_ok=True,
+                        ignore=shutil.ignore_patterns("__pycache__", "*.pt", "*.pth", "*.ckpt", "data", "checkpoints"))
+        config = {}
+        if os.path.exists(config_path):
+            with open(config_path, encoding="utf-8") as f:
+                config = yaml.safe_load(f) or {}
+        with open(os.path.join(sandbox, "config.yaml"), "w", encoding="utf-8") as f:
+            yaml.safe_dump(shrink_config(config) if isinstance(config, dict) else {}, f)
+
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES="", HF_HUB_OFFLINE="1", TRANSFORMERS_OFFLINE="1",
+                   HF_DATASETS_OFFLINE="1", WANDB_MODE="disabled", OMP_NUM_THREADS="1", HOME=sandbox)
+
+        def limit():
+            import resource
+            if memory_mb:
+                resource.setrlimit(resource.RLIMIT_AS, (memory_mb * 1024 * 1024,) * 2)
+
+        runner = os.path.join(os.path.dirname(os.path.abspath(__file__)), "exec_smoke.py")
+        try:
+            r = subprocess.run([sys.executable, runner, "--file", rel, "--project_root", sandbox],
+                               capture_output=True, text=True, timeout=timeout, env=env, cwd=sandbox,
+                               preexec_fn=limit)
+        except subprocess.TimeoutExpired:
+            return [{"target_func_name": os.path.basename(filepath), "severity_level": "medium",
+                     "critique": f"Smoke forward/backward step timed out ({timeout}s)", "source": "exec-smoke"}]
+
+    lines = [l for l in r.stdout.splitlines() if l.startswith('{"exec_smoke"')]
+    if not lines:
+        err = (r.stderr.strip().split("\n") or ["Unknown"])[-1]
+        return [{"target_func_name": os.path.basename(filepath), "severity_level": "medium",
+                 "critique": f"Smoke run crashed: {err}", "source": "exec-smoke"}] if r.returncode else []
+    out = []
+    for fail in json.loads(lines[-1])["exec_smoke"]:
+        frame = fail.get("frame") or {}
+        in_file = frame.get("file") == rel
+        target = _enclosing_func(filepath, frame.get("line")) if in_file else fail["class"]
+        shape = fail["exc_type"] == "RuntimeError" and re.search(r"shape|size|dimension|mat1|mat2", fail["message"])
+        where = f"{frame['file']}:{frame['line']} in {frame['func']}" if frame else "outside the repo"
+        out.append({"target_func_name": target,
+                    "severity_level": "high" if shape or fail["phase"] == "init" else "medium",
+                    "critique": f"Smoke {fail['phase']} of {fail['class']} on tiny synthetic inputs failed: "
+                                f"{fail['exc_type']}: {fail['message']} ({where})",
+                    "source": "exec-smoke"})
+    return out
+
+
 def merge_critiques(*lists) -> list:
-    PRI = {"ast-parse": 0, "pylint": 1, "exec-probe": 2, "llm-judge": 3}
+    PRI = {"ast-parse": 0, "pylint": 1, "exec-probe": 2, "exec-smoke": 3, "llm-judge": 4}
     seen = {}
     for cl in lists:
         for c in cl:
@@ -96,4 +186,207 @@ def _enclosing_func(fp, ln):
                 if hasattr(n, "end_lineno") and n.lineno <= ln <= n.end_lineno:
                     return n.name
     except Exception: pass
-    return "<module>"
\ No newline at end of file
+    return "<module>"
+
+# ---------------------------------------------------------------------------
+# Cached, parallel engine
+# ---------------------------------------------------------------------------
+# StaticAnalysisEngine runs ast_check + pylint + import_probe for many files in
+# a process pool. Each worker keeps one warm pylint linter instead of starting
+# `python -m pylint` per call, and results are cached by the file's content
+# hash together with the rest of the repo (imports make a file's result depend
+# on its neighbours), so unchanged files are never re-checked.
+
+_linter = None
+_linted_root = None
+
+
+def _env_fingerprint() -> str:
+    try:
+        from importlib.metadata import version
+        pylint_version = version("pylint")
+    except Exception:
+        pylint_version = "none"
+    return f"{sys.executable}|{sys.version}|pylint={pylint_version}|{' '.join(PYLINT_ARGS)}"
+
+
+def _repo_fingerprint(project_root: str) -> str:
+    h = hashlib.sha256()
+    if project_root and os.path.isdir(project_root):
+        for dirpath, dirnames, filenames in os.walk(project_root):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                if fn.endswith(".py"):
+                    path = os.path.join(dirpath, fn)
+                    h.update(os.path.relpath(path, project_root).encode())
+                    with open(path, "rb") as f:
+                        h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+def warm_pylint_check(filepath: str) -> list:
+    """pylint_check through a linter kept alive in this process."""
+    global _linter, _linted_root
+    try:
+        from pylint.lint import Run
+        from pylint.reporters import CollectingReporter
+        import astroid
+    except ImportError:
+        return []
+    ap = os.path.abspath(filepath)
+    root = os.path.join(os.path.dirname(ap), "")
+    try:
+        if _linter is None:
+            _linter = Run([*PYLINT_ARGS, ap], reporter=CollectingReporter(), exit=False).linter
+        else:
+            if root != _linted_root:
+                # another repo: its modules (config.py, model.py) must not resolve to the last one's
+                astroid.MANAGER.clear_cache()
+            else:
+                # same repo: drop its cached ASTs, the files may have changed since the last call
+                for name, mod in list(astroid.MANAGER.astroid_cache.items()):
+                    if (getattr(mod, "file", None) or "").startswith(root):
+                        del astroid.MANAGER.astroid_cache[name]
+            _linter.set_reporter(CollectingReporter())
+            _linter.check([ap])
+        _linted_root = root
+        messages = _linter.reporter.messages
+    except Exception:
+        return pylint_check(filepath)
+    return _pylint_critiques([{"message-id": m.msg_id, "obj": m.obj, "message": m.msg, "line": m.line}
+                              for m in messages])
+
+
+def _init_worker():
+    try:
+        import pylint.lint  # noqa: F401  (pay the import once per worker)
+    except ImportError:
+        pass
+
+
+def check_file(filepath: str, project_root: str = None, probe_socket: str = None, smoke_config: str = None) -> list:
+    """
+    ast_check + pylint + import_probe for one file, the import probe running
+    alongside pylint; plus exec_smoke_check when `smoke_config` is given.
+    """
+    with ThreadPoolExecutor(max_workers=1) as probe_pool:
+        if probe_socket:
+            probe = probe_pool.submit(warm_import_probe, filepath, probe_socket, project_root)
+        else:
+            probe = probe_pool.submit(import_probe, filepath, project_root)
+        c_ast = ast_check(filepath)
+        c_lint = warm_pylint_check(filepath)
+        c_exec = probe.result()
+    c_smoke = exec_smoke_check(filepath, project_root, smoke_config) if smoke_config and not c_ast and not c_exec else []
+    return merge_critiques(c_ast, c_lint, c_exec, c_smoke)
+
+
+class StaticAnalysisEngine:
+    """
+    Content-hash-cached static analysis over a process pool.
+
+    `cache_dir` keeps results across runs (one JSON file per key); without it
+    results are cached for the lifetime of the engine only. With
+    `probe_preload` the import probes go to a warm probe_server.py that has
+    those packages imported already. With `smoke_config` (a config.yaml) the
+    exec-smoke channel runs too, for files that parse and import. The pool
+    forks its workers in the constructor, so create the engine on the main
+    thread before starting any other threads (asyncio.to_thread etc.).
+    """
+
+    def __init__(self, max_workers: int = None, cache_dir: str = None, probe_preload: str = None,
+                 probe_memory_mb: int = 0, smoke_config: str = None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.smoke_config = smoke_config
+        self.env = _env_fingerprint()
+        if smoke_config:
+            with open(smoke_config, "rb") as f:
+                self.env += "|smoke=" + hashlib.sha256(f.read()).hexdigest()
+        self.hits = 0
+        self.misses = 0
+        self._memory = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.probe_service = None
+        if probe_preload is not None:
+            try:
+                self.probe_service = ProbeService(probe_preload, probe_memory_mb)
+            except (OSError, RuntimeError) as e:
+                print(f"[WARNING] probe server unavailable ({e}); using one interpreter per import probe.")
+        self._pool = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("fork"),
+                                         initializer=_init_worker)
+        # a fork pool starts all its workers on the first submit: do that here, not from a worker thread
+        self._pool.submit(os.getpid).result()
+
+    def _key(self, filepath: str, project_root: str) -> str:
+        with open(filepath, "rb") as f:
+            file_hash = hashlib.sha256(f.read()).hexdigest()
+        repo_hash = _repo_fingerprint(project_root or os.path.dirname(os.path.abspath(filepath)))
+        # the file name shows up in critiques (import_probe), so it is part of the key
+        return hashlib.sha256(f"{self.env}|{os.path.basename(filepath)}|{file_hash}|{repo_hash}".encode()).hexdigest()
+
+    def _load(self, key: str):
+        if key in self._memory:
+            return self._memory[key]
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, f"{key}.json")
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    self._memory[key] = json.load(f)
+                return self._memory[key]
+        return None
+
+    def _store(self, key: str, critiques: list):
+        self._memory[key] = critiques
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, f"{key}.json")
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(critiques, f)
+            os.replace(tmp, path)
+
+    def _submit(self, filepath: str, project_root: str):
+        """Returns a Future for the file's critiques (shared with identical in-flight checks)."""
+        key = self._key(filepath, project_root)
+        with self._lock:
+            cached = self._load(key)
+            if cached is not None:
+                self.hits += 1
+                fut = Future()
+                fut.set_result(cached)
+                return fut
+            if key in self._pending:
+                self.hits += 1
+                return self._pending[key]
+            self.misses += 1
+            if self._pool is None:
+                raise RuntimeError("StaticAnalysisEngine is closed")
+            probe_socket = self.probe_service.socket_path if self.probe_service else None
+            fut = self._pool.submit(check_file, filepath, project_root, probe_socket, self.smoke_config)
+            self._pending[key] = fut
+
+        def done(f, key=key):
+            with self._lock:
+                self._pending.pop(key, None)
+                if f.exception() is None:
+                    self._store(key, f.result())
+        fut.add_done_callback(done)
+        return fut
+
+    def check(self, filepath: str, project_root: str = None) -> list:
+        return self._submit(filepath, project_root).result()
+
+    def check_many(self, filepaths: list, project_root: str = None) -> dict:
+        futures = {fp: self._submit(fp, project_root) for fp in filepaths}
+        return {fp: fut.result() for fp, fut in futures.items()}
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self.probe_service is not None:
+            self.probe_service.close()
+            self.probe_service = None
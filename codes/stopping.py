@@ -0,0 +1,127 @@
+"""
+stopping.py
+
+Stopping policies for the feedback loop of 2_analyzing_experiments.py
+(--stop_policy).
+
+After every iteration the loop appends {"critiques": high/medium critiques,
+"tokens": prompt + completion tokens of the iteration} to the file's history
+and asks a StopController whether to go on. The controller checks, in order:
+
+  resolved          no high/medium critiques left (always on)
+  <policies>        the ones named in --stop_policy, in the given order
+  max_iterations    the iteration cap (always on)
+
+and returns the name of the first one that fires, which the loop records.
+
+Policies (spec "name" or "name:value", comma-separated):
+
+  no_improvement[:min_delta]   the weighted severity of the open critiques
+                               (SEVERITY_WEIGHTS) dropped by less than
+                               min_delta (default 0) since the last iteration
+  jaccard[:threshold]          the open critiques, keyed by target and
+                               severity, overlap the previous iteration's by
+                               at least threshold (default 0.8)
+  token_budget:max_tokens      the tokens spent on the file so far plus the
+                               cost of one more iteration (the last one's)
+                               would exceed max_tokens
+
+New policies are added to POLICIES.
+"""
+
+import re
+
+SEVERITY_WEIGHTS = {"high": 3.0, "medium": 1.0, "low": 0.0}
+
+
+def weighted_severity(critiques):
+    return sum(SEVERITY_WEIGHTS.get(str(c.get("severity_level", "")).lower(), 0.0) for c in critiques)
+
+
+def critique_key(critique):
+    """
+    (target, severity). Reviewers reword the same critique from one iteration to
+    the next ("train()", "train() method / Logging"), so the target is reduced
+    to its first identifier.
+    """
+    m = re.search(r"[A-Za-z_][A-Za-z0-9_]*", str(critique.get("target_func_name", "")))
+    return (m.group(0).lower() if m else "", str(critique.get("severity_level", "")).lower())
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+class NoImprovement:
+    name = "no_improvement"
+
+    def __init__(self, min_delta=0.0):
+        self.min_delta = float(min_delta)
+
+    def __call__(self, history):
+        if len(history) < 2:
+            return False
+        return weighted_severity(history[-2]["critiques"]) - weighted_severity(history[-1]["critiques"]) \
+            < max(self.min_delta, 1e-9)
+
+
+class CritiqueStagnation:
+    name = "jaccard"
+
+    def __init__(self, threshold=0.8):
+        self.threshold = float(threshold)
+
+    def __call__(self, history):
+        if len(history) < 2:
+            return False
+        previous = {critique_key(c) for c in history[-2]["critiques"]}
+        current = {critique_key(c) for c in history[-1]["critiques"]}
+        return jaccard(previous, current) >= self.threshold
+
+
+class TokenBudget:
+    name = "token_budget"
+
+    def __init__(self, max_tokens):
+        self.max_tokens = int(max_tokens)
+
+    def __call__(self, history):
+        spent = sum(h["tokens"] for h in history)
+        return spent + (history[-1]["tokens"] if history else 0) > self.max_tokens
+
+
+POLICIES = {cls.name: cls for cls in (NoImprovement, CritiqueStagnation, TokenBudget)}
+
+
+def parse_policies(spec):
+    """'no_improvement,jaccard:0.7,token_budget:60000' -> policy objects."""
+    policies = []
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, value = item.partition(":")
+        if name not in POLICIES:
+            raise ValueError(f"Unknown stop policy '{name}' (known: {', '.join(POLICIES)})")
+        if name == "token_budget" and not value:
+            raise ValueError("token_budget needs a value, e.g. token_budget:60000")
+        policies.append(POLICIES[name](value) if value else POLICIES[name]())
+    return policies
+
+
+class StopController:
+    def __init__(self, spec="", max_iterations=3):
+        self.spec = spec or ""
+        self.policies = parse_policies(spec)
+        self.max_iterations = max_iterations
+
+    def check(self, history):
+        """Name of the first rule that stops the loop after the last entry of `history`, or None."""
+        if not history[-1]["critiques"]:
+            return "resolved"
+        for policy in self.policies:
+            if policy(history):
+                return policy.name
+        if len(history) >= self.max_iterations:
+            return "max_iterations"
+        return None
@@ -0,0 +1,220 @@
+"""
+sweep.py
+
+Runs the pipeline for many papers and feedback modes at once, under one global
+tokens-per-minute / requests-per-minute budget.
+
+Each (paper, mode, format) experiment is a run_pipeline.py job; every paper
+first gets a planning job and finally a collect_results job. All launched
+processes share a RateLimiter (utils.py) through a SQLite file, so the budget
+is global: a 429 seen by any job halves everyone's budget and pauses them for
+Retry-After, and the budget grows back as requests succeed.
+
+Scheduling:
+  - LLM-heavy jobs (planning and every experiment, since even static_only runs
+    the coding and eval stages) use --max_llm_jobs slots and are started
+    largest-first, but only while the shared budget has headroom.
+  - Cheap jobs (collect_results) have their own --max_cheap_jobs slots and are
+    started whenever one is free, so they fill the gaps while the heavy jobs
+    wait on the rate limit.
+  - A failed job only skips the jobs that depend on it.
+
+Usage:
+    python sweep.py --papers transformer:../examples/Transformer_cleaned.json,vdc:../examples/vdc.json \
+        --output_root ../outputs --data_dir ../data --tpm 2000000 --rpm 500
+
+    # every benchmark paper listed in dataset_info.json
+    python sweep.py --dataset_info ../data/paper2code/dataset_info.json \
+        --paper_data_dir ../data/paper2code --output_root ../outputs/benchmark
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from run_pipeline import DEFAULT_EXPERIMENTS
+from utils import CACHE_MODES, RateLimiter
+
+CODES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# rough number of paper-sized prompts per experiment, used only to order jobs
+MODE_WEIGHT = {"planning": 4, "llm_only": 6, "multi_signal": 6, "static_only": 3, "collect_results": 0}
+
+
+class Job:
+    def __init__(self, name, cmd, weight, heavy, deps=()):
+        self.name = name
+        self.cmd = cmd
+        self.weight = weight
+        self.heavy = heavy
+        self.deps = list(deps)
+        self.proc = None
+        self.log_file = None
+        self.started_at = None
+        self.status = "pending"  # pending | running | done | failed | skipped
+
+
+def load_papers(args):
+    """Returns [(paper_name, pdf_json_path)]."""
+    papers = []
+    if args.papers:
+        for item in args.papers.split(","):
+            name, path = item.strip().split(":", 1)
+            papers.append((name, path))
+    if args.dataset_info:
+        with open(args.dataset_info) as f:
+            dataset_info = json.load(f)
+        for conference, entries in dataset_info.items():
+            for entry in entries:
+                path = os.path.join(args.paper_data_dir, conference, f"{entry['repo_name']}_cleaned.json")
+                if not os.path.exists(path):
+                    print(f"[SKIP] {entry['repo_name']}: {path} not found")
+                    continue
+                papers.append((entry["repo_name"], path))
+    return papers
+
+
+def build_jobs(args, papers):
+    py = sys.executable
+    experiments = [e.strip() for e in args.experiments.split(",") if e.strip()]
+    jobs = []
+    for paper_name, pdf_json_path in papers:
+        paper_tokens = os.path.getsize(pdf_json_path) // 4
+        base_cmd = [py, "run_pipeline.py",
+                    "--paper_name", paper_name,
+                    "--pdf_json_path", os.path.abspath(pdf_json_path),
+                    "--output_dir", os.path.abspath(os.path.join(args.output_root, paper_name)),
+                    "--data_dir", os.path.abspath(args.data_dir),
+                    "--gpt_version", args.gpt_version,
+                    "--cache_mode", args.cache_mode,
+                    *(["--base_url", args.base_url] if args.base_url else []),
+                    "--concurrency", str(args.concurrency)]
+
+        planning = Job(f"{paper_name}/planning",
+                       base_cmd + ["--stages", "planning,extract_config", "--experiments", ",".join(experiments)],
+                       paper_tokens * MODE_WEIGHT["planning"], heavy=True)
+        jobs.append(planning)
+
+        experiment_jobs = []
+        for experiment in experiments:
+            mode = experiment.split(":")[0]
+            job = Job(f"{paper_name}/{experiment.replace(':', '_')}",
+                      base_cmd + ["--stages", "analyzing,coding,eval", "--experiments", experiment],
+                      paper_tokens * MODE_WEIGHT.get(mode, 6),
+                      heavy=True,
+                      deps=[planning.name])
+            experiment_jobs.append(job)
+        jobs.extend(experiment_jobs)
+
+        jobs.append(Job(f"{paper_name}/collect_results",
+                        base_cmd + ["--stages", "collect_results", "--experiments", ",".join(experiments)],
+                        0, heavy=False, deps=[j.name for j in experiment_jobs]))
+    return jobs
+
+
+def start_job(job, log_dir, env):
+    os.makedirs(log_dir, exist_ok=True)
+    job.log_file = open(os.path.join(log_dir, job.name.replace("/", "__") + ".log"), "w")
+    job.proc = subprocess.Popen(job.cmd, cwd=CODES_DIR, env=env,
+                                stdout=job.log_file, stderr=subprocess.STDOUT)
+    job.started_at = time.time()
+    job.status = "running"
+    print(f"[START] {job.name} ({'llm' if job.heavy else 'cheap'}, weight={job.weight:,})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--papers', type=str, default="",
+                        help="Comma-separated paper_name:pdf_json_path pairs")
+    parser.add_argument('--dataset_info', type=str, default="",
+                        help="dataset_info.json listing benchmark papers (uses <repo_name>_cleaned.json)")
+    parser.add_argument('--paper_data_dir', type=str, default="../data/paper2code")
+    parser.add_argument('--output_root', type=str, required=True)
+    parser.add_argument('--data_dir', type=str, default="../data")
+    parser.add_argument('--gpt_version', type=str, default="o3-mini")
+    parser.add_argument('--experiments', type=str, default=DEFAULT_EXPERIMENTS,
+                        help="Mode matrix as comma-separated mode:feedback_format pairs")
+    parser.add_argument('--tpm', type=int, default=2_000_000, help="Global tokens-per-minute budget")
+    parser.add_argument('--rpm', type=int, default=500, help="Global requests-per-minute budget")
+    parser.add_argument('--max_llm_jobs', type=int, default=4)
+    parser.add_argument('--max_cheap_jobs', type=int, default=4)
+    parser.add_argument('--launch_threshold', type=float, default=0.8,
+                        help="Only start LLM-heavy jobs while budget utilization is below this")
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help="Per-experiment file concurrency passed to 2_analyzing_experiments.py")
+    parser.add_argument('--cache_mode', type=str, default="readwrite", choices=CACHE_MODES)
+    parser.add_argument('--base_url', type=str, default=None,
+                        help="OpenAI-compatible endpoint passed to every stage (e.g. mock_server.py)")
+    parser.add_argument('--poll_interval', type=float, default=2.0)
+    args = parser.parse_args()
+
+    papers = load_papers(args)
+    if not papers:
+        print("[ERROR] No papers to run.")
+        sys.exit(1)
+
+    os.makedirs(args.output_root, exist_ok=True)
+    limiter_path = os.path.abspath(os.path.join(args.output_root, ".sweep_rate_limit.sqlite"))
+    limiter = RateLimiter(limiter_path, args.tpm, args.rpm)
+    env = os.environ.copy()
+    env.update({"PAPER2CODE_RATE_LIMIT_DB": limiter_path,
+                "PAPER2CODE_TPM": str(args.tpm),
+                "PAPER2CODE_RPM": str(args.rpm)})
+    log_dir = os.path.join(args.output_root, ".sweep_logs")
+
+    jobs = build_jobs(args, papers)
+    by_name = {job.name: job for job in jobs}
+    print(f"[SWEEP] {len(papers)} papers, {len(jobs)} jobs")
+    sweep_start = time.time()
+
+    while any(job.status in ("pending", "running") for job in jobs):
+        # reap finished jobs
+        for job in jobs:
+            if job.status == "running" and job.proc.poll() is not None:
+                job.log_file.close()
+                job.status = "done" if job.proc.returncode == 0 else "failed"
+                print(f"[{job.status.upper()}] {job.name} ({time.time() - job.started_at:.0f}s)")
+
+        # propagate failures
+        for job in jobs:
+            if job.status == "pending" and any(by_name[d].status in ("failed", "skipped") for d in job.deps):
+                job.status = "skipped"
+                print(f"[SKIPPED] {job.name}: an upstream job failed")
+
+        ready = [job for job in jobs
+                 if job.status == "pending" and all(by_name[d].status == "done" for d in job.deps)]
+        ready.sort(key=lambda j: -j.weight)
+        running_heavy = sum(1 for j in jobs if j.status == "running" and j.heavy)
+        running_cheap = sum(1 for j in jobs if j.status == "running" and not j.heavy)
+        has_headroom = limiter.utilization() < args.launch_threshold
+
+        for job in ready:
+            if job.heavy and has_headroom and running_heavy < args.max_llm_jobs:
+                start_job(job, log_dir, env)
+                running_heavy += 1
+            elif not job.heavy and running_cheap < args.max_cheap_jobs:
+                start_job(job, log_dir, env)
+                running_cheap += 1
+
+        time.sleep(args.poll_interval)
+
+    status = {job.name: job.status for job in jobs}
+    with open(os.path.join(args.output_root, "sweep_status.json"), "w") as f:
+        json.dump(status, f, indent=2)
+
+    print("\n" + "=" * 60)
+    print(f"SWEEP COMPLETE in {time.time() - sweep_start:.0f}s")
+    for st in ("done", "failed", "skipped"):
+        print(f"  {st:<8} {sum(1 for v in status.values() if v == st)}")
+    print(f"Logs: {log_dir}")
+    print("=" * 60)
+
+    if any(v != "done" for v in status.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,12 @@
 import json
 import re
 import os
+import random
+import sys
+import hashlib
+import sqlite3
+import threading
+import time
 from datetime import datetime
 
 def extract_planning(trajectories_json_file_path):
@@ -149,6 +155,9 @@ def format_json_data(data):
     return formatted_text
 
 
+BATCH_DISCOUNT = 0.5  # Batch API requests are billed at half the synchronous price
+
+
 def cal_cost(response_json, model_name):
     model_cost = {
         # gpt-4.1
@@ -239,13 +248,17 @@ def cal_cost(response_json, model_name):
     
     prompt_tokens = response_json["usage"]["prompt_tokens"]
     completion_tokens = response_json["usage"]["completion_tokens"]
-    cached_tokens = response_json["usage"]["prompt_tokens_details"].get("cached_tokens", 0)
+    cached_tokens = (response_json["usage"].get("prompt_tokens_details") or {}).get("cached_tokens", 0)
 
     # input token = (prompt_tokens - cached_tokens)
     actual_input_tokens = prompt_tokens - cached_tokens
     output_tokens = completion_tokens
 
-    cost_info = model_cost[model_name]
+    # generated by a local model (backends.py) -> nothing was billed for this call
+    if response_json.get("x_local"):
+        cost_info = {"input": 0.0, "cached_input": 0.0, "output": 0.0}
+    else:
+        cost_info = model_cost[model_name]
 
     input_cost = (actual_input_tokens / 1_000_000) * cost_info['input']
     cached_input_cost = (cached_tokens / 1_000_000) * cost_info['cached_input']
@@ -253,6 +266,17 @@ def cal_cost(response_json, model_name):
 
     total_cost = input_cost + cached_input_cost + output_cost
 
+    # answered through the Batch API (batch_api.py marks these)
+    if response_json.get("x_batch"):
+        input_cost *= BATCH_DISCOUNT
+        cached_input_cost *= BATCH_DISCOUNT
+        output_cost *= BATCH_DISCOUNT
+        total_cost *= BATCH_DISCOUNT
+
+    # served from the local response cache -> nothing was billed for this call
+    if response_json.get("x_cache_hit"):
+        input_cost = cached_input_cost = output_cost = total_cost = 0.0
+
     return {
         'model_name': model_name,
         'actual_input_tokens': actual_input_tokens,
@@ -294,6 +318,12 @@ def print_log_cost(completion_json, gpt_version, current_stage, output_dir, tota
     output_lines.append("🌟 Usage Summary 🌟")
     output_lines.append(f"{current_stage}")
     output_lines.append(f"🛠️ Model: {usage_info['model_name']}")
+    if completion_json.get("x_cache_hit"):
+        output_lines.append("♻️ Served from local response cache (not billed)")
+    if completion_json.get("x_local"):
+        output_lines.append("🖥️ Generated by a local model (not billed)")
+    if completion_json.get("x_batch"):
+        output_lines.append(f"📬 Batch API ({BATCH_DISCOUNT:.0%} of synchronous price)")
     output_lines.append(f"📥 Input tokens: {usage_info['actual_input_tokens']} (Cost: ${usage_info['input_cost']:.8f})")
     output_lines.append(f"📦 Cached input tokens: {usage_info['cached_tokens']} (Cost: ${usage_info['cached_input_cost']:.8f})")
     output_lines.append(f"📤 Output tokens: {usage_info['output_tokens']} (Cost: ${usage_info['output_cost']:.8f})")
@@ -440,3 +470,927 @@ def get_now_str():
     now = now.split(".")[0]
     now = now.replace("-","").replace(" ","_").replace(":","")
     return now # now - "20250427_205124"
+
+
+
+# ---------------------------------------------------------------------------
+# LLM response cache
+# ---------------------------------------------------------------------------
+
+CACHE_MODES = ["off", "read", "readwrite", "replay-only"]
+CACHE_KEY_FIELDS = ["model", "messages", "reasoning_effort", "temperature", "n"]
+DEFAULT_CACHE_DIR = os.environ.get("PAPER2CODE_CACHE_DIR", os.path.expanduser("~/.cache/paper2code"))
+OPENAI_API_URL = "https://api.openai.com/v1"
+
+
+class CacheMissError(RuntimeError):
+    """Raised in replay-only mode when a request has no cached response."""
+
+
+class ResponseCache:
+    """
+    Content-addressed store of chat-completion responses, shared by all stages.
+
+    Entries live in one SQLite file and are keyed by a hash of the request
+    fields in CACHE_KEY_FIELDS and of `namespace`, the endpoint that answers
+    (cache_namespace), so replies of mock_server.py or a local model are never
+    served for the OpenAI API's. When the total stored size exceeds
+    `max_bytes` the least recently used entries are evicted.
+
+    Modes:
+      read        serve hits, call the API on a miss but do not store it
+      readwrite   serve hits, call the API on a miss and store the response
+      replay-only serve hits, raise CacheMissError on a miss (no API calls)
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, mode="readwrite", max_bytes=2 * 1024 ** 3, namespace=""):
+        if mode not in CACHE_MODES or mode == "off":
+            raise ValueError(f"Invalid cache mode for ResponseCache: {mode}")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.path = os.path.join(cache_dir, "responses.sqlite")
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # several stage processes may share the cache; WAL + timeout lets them interleave
+        self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, "
+            "size INTEGER, created REAL, last_access REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON entries(last_access)")
+        self._db.commit()
+
+    def make_key(self, request_json):
+        keyed = {k: request_json.get(k) for k in CACHE_KEY_FIELDS}
+        if self.namespace:
+            # the OpenAI API keeps the bare key, so existing entries stay valid
+            keyed["endpoint"] = self.namespace
+        blob = json.dumps(keyed, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT response FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, response_json):
+        blob = json.dumps(response_json, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, model, response, size, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, response_json.get("model", ""), blob, len(blob.encode("utf-8")), now, now),
+            )
+            self.writes += 1
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute(
+                "SELECT key, size FROM entries ORDER BY last_access ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+    def write_stats(self, output_dir, current_stage):
+        """Append this run's hit/miss stats to cache_stats.log (next to cost_info.log)."""
+        st = self.stats()
+        output_lines = []
+        output_lines.append("♻️ Response Cache Summary ♻️")
+        output_lines.append(f"{current_stage}")
+        output_lines.append(f"🗄️ Cache: {self.path} (mode: {st['mode']})")
+        output_lines.append(f"✅ Hits: {st['hits']}  ❌ Misses: {st['misses']}  (hit rate: {st['hit_rate']:.2%})")
+        output_lines.append(f"💾 Writes: {st['writes']}  🧹 Evictions: {st['evictions']}")
+        output_lines.append("============================================\n")
+
+        output_text = "\n".join(output_lines)
+        print(output_text)
+
+        os.makedirs(output_dir, exist_ok=True)
+        with open(f"{output_dir}/cache_stats.log", "a", encoding="utf-8") as f:
+            f.write(output_text + "\n")
+
+
+def add_api_args(parser):
+    """Register the API-layer flags shared by every stage script."""
+    parser.add_argument('--cache_mode', type=str, default="off", choices=CACHE_MODES,
+                        help="LLM response cache: off, read, readwrite or replay-only")
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR,
+                        help="Directory of the shared response cache")
+    parser.add_argument('--cache_max_mb', type=int, default=2048,
+                        help="Cache size limit; least recently used entries are evicted beyond it")
+    parser.add_argument('--base_url', type=str, default=None,
+                        help="OpenAI-compatible endpoint, e.g. http://127.0.0.1:8000/v1 for mock_server.py "
+                             "(default: OPENAI_BASE_URL or the OpenAI API)")
+    parser.add_argument('--max_retries', type=int, default=6,
+                        help="Retries of a failed API call (429, timeout, 5xx) with jittered exponential backoff")
+    parser.add_argument('--request_timeout', type=float, default=600,
+                        help="Seconds before an API request counts as timed out (and is retried)")
+    parser.add_argument('--hedge_after', type=str, default="0",
+                        help="Send a duplicate request when the first has not answered after this many seconds, "
+                             "or 'p95' (observed percentile); 0 = never")
+    return parser
+
+
+def cache_namespace(args):
+    """
+    The endpoint a stage's replies come from, as part of its cache keys: ""
+    for the OpenAI API, else backend and base URL (--backend server, a
+    --base_url such as mock_server.py, or vLLM in this process).
+    """
+    backend = getattr(args, "backend", "openai")
+    if backend == "vllm":
+        return "vllm"
+    base_url = (getattr(args, "base_url", None) or os.environ.get("OPENAI_BASE_URL") or "").rstrip("/")
+    if backend == "openai" and base_url in ("", OPENAI_API_URL):
+        return ""
+    return f"{backend}|{base_url}"
+
+
+def load_response_cache(args):
+    cache_mode = args.cache_mode
+    if getattr(args, "batch", False) and cache_mode == "off":
+        # batch results reach the stage through the cache
+        cache_mode = "readwrite"
+    if cache_mode == "off":
+        return None
+    return ResponseCache(args.cache_dir, cache_mode, args.cache_max_mb * 1024 * 1024, cache_namespace(args))
+
+
+# ---------------------------------------------------------------------------
+# Batch API queue (see batch_api.py)
+# ---------------------------------------------------------------------------
+
+class BatchDeferred(Exception):
+    """Raised when a request was queued for the Batch API instead of being sent."""
+
+
+class BatchQueue:
+    """
+    Collects requests for an OpenAI Batch job. A stage run with --batch queues
+    every request it has no cached response for and stops; batch_api.py submits
+    the queue, stores the results in the response cache and re-runs the queued
+    command, which now finds its responses as cache hits. A stage with per-file
+    checkpoints passes its `resume_flag`, which batch_api.py adds to the re-run
+    so files finished in earlier rounds are not logged (and costed) again.
+    """
+
+    def __init__(self, batch_dir, output_dir, current_stage, resume_flag=None):
+        os.makedirs(batch_dir, exist_ok=True)
+        self.batch_dir = batch_dir
+        self.output_dir = os.path.abspath(output_dir)
+        self.current_stage = current_stage
+        self.resume_flag = resume_flag
+
+    def defer(self, key, request_json, namespace=""):
+        import fcntl
+
+        request_line = {"custom_id": key, "method": "POST", "url": "/v1/chat/completions", "body": request_json}
+        meta_line = {
+            "custom_id": key,
+            "model": request_json.get("model"),
+            "output_dir": self.output_dir,
+            "stage": self.current_stage,
+            "cmd": [sys.executable] + sys.argv,
+            "cwd": os.getcwd(),
+            "resume_flag": self.resume_flag,
+            "endpoint": namespace,
+        }
+        # several stage processes may queue at once
+        with open(os.path.join(self.batch_dir, "queue.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(os.path.join(self.batch_dir, "requests.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(request_line, ensure_ascii=False) + "\n")
+            with open(os.path.join(self.batch_dir, "meta.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(meta_line, ensure_ascii=False) + "\n")
+        raise BatchDeferred(key)
+
+
+def add_batch_args(parser):
+    parser.add_argument('--batch', action="store_true",
+                        help="Queue uncached requests for the OpenAI Batch API (run batch_api.py afterwards)")
+    parser.add_argument('--batch_dir', type=str, default=os.path.join(DEFAULT_CACHE_DIR, "batch"),
+                        help="Queue directory shared by all stages of one batch run")
+    return parser
+
+
+def _cache_lookup(cache, request_json):
+    """Returns (key, completion or None). Raises CacheMissError in replay-only mode."""
+    if cache is None:
+        return None, None
+    from openai.types.chat import ChatCompletion
+
+    key = cache.make_key(request_json)
+    cached = cache.get(key)
+    if cached is not None:
+        cached["x_cache_hit"] = True
+        return key, ChatCompletion.model_validate(cached)
+    if cache.mode == "replay-only":
+        raise CacheMissError(f"No cached response for request {key[:12]} (model={request_json.get('model')})")
+    return key, None
+
+
+def _cache_store(cache, key, completion):
+    if cache is not None and cache.mode == "readwrite":
+        completion_json = json.loads(completion.model_dump_json())
+        if completion_json.get("x_partial"):
+            return
+        cache.put(key, completion_json)
+
+
+# ---------------------------------------------------------------------------
+# Global rate limiting (shared by every stage process of a sweep)
+# ---------------------------------------------------------------------------
+
+class RateLimiter:
+    """
+    Sliding-window tokens-per-minute / requests-per-minute budget shared by all
+    processes that point at the same SQLite file (see sweep.py).
+
+    The budget adapts to the provider: a 429 halves the effective TPM/RPM and
+    pauses every process until Retry-After has passed; each successful request
+    grows it back by 5% of the configured limit.
+    """
+
+    WINDOW = 60.0
+
+    def __init__(self, path, tpm, rpm):
+        self.path = path
+        self.tpm = tpm
+        self.rpm = rpm
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL, tokens INTEGER)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value REAL)")
+
+    def _get(self, key, default):
+        row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    def _limits(self):
+        scale = self._get("scale", 1.0)
+        return max(1, int(self.rpm * scale)), max(1, int(self.tpm * scale))
+
+    def try_acquire(self, tokens):
+        """Reserve budget for one request. Returns (event_id, 0.0) or (None, seconds_to_wait)."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                self._db.execute("DELETE FROM events WHERE ts < ?", (now - self.WINDOW,))
+                paused_until = self._get("paused_until", 0.0)
+                if now < paused_until:
+                    return None, paused_until - now
+                rpm, tpm = self._limits()
+                n_requests, used_tokens, oldest = self._db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(tokens), 0), MIN(ts) FROM events").fetchone()
+                # an oversized request is still let through once the window is empty
+                if n_requests + 1 > rpm or (n_requests > 0 and used_tokens + tokens > tpm):
+                    return None, max(0.05, oldest + self.WINDOW - now)
+                cur = self._db.execute("INSERT INTO events (ts, tokens) VALUES (?, ?)", (now, tokens))
+                return cur.lastrowid, 0.0
+            finally:
+                self._db.execute("COMMIT")
+
+    def settle(self, event_id, tokens):
+        """Replace the estimate with the real usage and grow the budget back."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute("UPDATE events SET tokens = ? WHERE id = ?", (tokens, event_id))
+            self._set("scale", min(1.0, self._get("scale", 1.0) + 0.05))
+            self._db.execute("COMMIT")
+
+    def release(self, event_id):
+        """Drop the reservation of a request that failed and used no budget."""
+        with self._lock:
+            self._db.execute("DELETE FROM events WHERE id = ?", (event_id,))
+
+    def penalize(self, retry_after):
+        """Called on a 429: halve the budget and pause everyone for `retry_after` seconds."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._set("scale", max(0.1, self._get("scale", 1.0) * 0.5))
+            self._set("paused_until", max(self._get("paused_until", 0.0), time.time() + retry_after))
+            self._db.execute("COMMIT")
+
+    def utilization(self):
+        """Fraction (0..1+) of the current effective budget used in the last minute."""
+        with self._lock:
+            now = time.time()
+            if now < self._get("paused_until", 0.0):
+                return 1.0
+            rpm, tpm = self._limits()
+            n_requests, used_tokens = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM events WHERE ts >= ?",
+                (now - self.WINDOW,)).fetchone()
+        return max(n_requests / rpm, used_tokens / tpm)
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """
+    Process-wide limiter configured through the environment, so sweep.py can hand
+    one budget to every stage it launches:
+      PAPER2CODE_RATE_LIMIT_DB, PAPER2CODE_TPM, PAPER2CODE_RPM
+    Returns None when no limiter is configured.
+    """
+    global _rate_limiter
+    path = os.environ.get("PAPER2CODE_RATE_LIMIT_DB")
+    if not path:
+        return None
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(path,
+                                    tpm=int(os.environ.get("PAPER2CODE_TPM", "2000000")),
+                                    rpm=int(os.environ.get("PAPER2CODE_RPM", "500")))
+    return _rate_limiter
+
+
+def estimate_request_tokens(request_json):
+    """Cheap pre-flight estimate (~4 characters per token) used to reserve TPM budget."""
+    chars = sum(len(str(m.get("content", ""))) for m in request_json.get("messages", []))
+    return chars // 4 + 1
+
+
+# ---------------------------------------------------------------------------
+# Request executor: retries, backoff, circuit breaking, hedging, latency stats
+# ---------------------------------------------------------------------------
+
+LATENCY_BUCKETS = [0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600]
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def _retry_after(error):
+    """Seconds the provider asked us to wait (Retry-After / retry-after-ms), or None."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is None:
+        return None
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers.get(name)) * scale
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def _is_retryable(error):
+    import openai
+
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError,
+                          openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in RETRYABLE_STATUS
+
+
+class RequestExecutor:
+    """
+    Runs every API call of a stage process (chat_completion / achat_completion):
+
+      - retryable failures (429, 408/409, 5xx, timeouts, connection errors) are
+        retried up to `max_retries` times with full-jitter exponential backoff,
+        never sooner than the provider's Retry-After;
+      - after `breaker_threshold` consecutive failures the circuit opens: every
+        call of the process waits `breaker_cooldown` seconds (doubling while the
+        failures go on, up to 10 minutes) instead of hammering the provider;
+      - with `hedge_after` (seconds, or "p95" for the observed 95th percentile
+        once 20 calls have finished) a duplicate request is sent when the
+        first one has not answered in time, and the first answer wins. A
+        hedge costs a second request, so it is opt-in;
+      - every call's latency (first attempt to answer, retries included) lands
+        in a histogram that `write_stats` appends to api_latency.log.
+    """
+
+    def __init__(self, max_retries=6, base_delay=1.0, max_delay=60.0, breaker_threshold=5,
+                 breaker_cooldown=30.0, hedge_after="0"):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.hedge_after = str(hedge_after or "0")
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+        self._open_streak = 0
+        self._hedge_pool = None
+        self.latencies = []
+        self.ttfts = []
+        self.counts = {"calls": 0, "attempts": 0, "retries": 0, "failures": 0, "rate_limited": 0,
+                       "breaker_opens": 0, "hedges": 0, "hedges_won": 0}
+
+    # -- bookkeeping ---------------------------------------------------------
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counts[key] += n
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = _retry_after(error)
+        return max(delay, retry_after) if retry_after is not None else delay
+
+    def _breaker_wait(self):
+        with self._lock:
+            return max(0.0, self._open_until - time.time())
+
+    def _record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= self.breaker_threshold and time.time() >= self._open_until:
+                cooldown = min(600.0, self.breaker_cooldown * 2 ** self._open_streak)
+                self._open_until = time.time() + cooldown
+                self._open_streak += 1
+                self.counts["breaker_opens"] += 1
+                print(f"[CIRCUIT] {self._consecutive_failures} consecutive API failures; "
+                      f"pausing calls for {cooldown:.1f}s")
+
+    def _record_success(self, latency):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._open_streak = 0
+            self.latencies.append(latency)
+
+    def _hedge_delay(self):
+        if self.hedge_after.startswith("p"):
+            with self._lock:
+                if len(self.latencies) < 20:
+                    return None
+                ranked = sorted(self.latencies)
+            return ranked[min(len(ranked) - 1, int(len(ranked) * float(self.hedge_after[1:]) / 100))]
+        delay = float(self.hedge_after)
+        return delay if delay > 0 else None
+
+    def _should_retry(self, error, attempt):
+        self._count("failures")
+        if not _is_retryable(error):
+            return False
+        import openai
+
+        if isinstance(error, openai.RateLimitError):
+            self._count("rate_limited")
+        self._record_failure()
+        return attempt < self.max_retries
+
+    # -- sync ----------------------------------------------------------------
+
+    def record_ttft(self, seconds):
+        with self._lock:
+            self.ttfts.append(seconds)
+
+    def _attempt(self, fn, hedge):
+        """One attempt, hedged when configured."""
+        self._count("attempts")
+        delay = self._hedge_delay() if hedge else None
+        if delay is None:
+            return fn()
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+        with self._lock:
+            if self._hedge_pool is None:
+                self._hedge_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+        futures = [self._hedge_pool.submit(fn)]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            self._count("hedges")
+            futures.append(self._hedge_pool.submit(fn))
+        # the slower request is left to finish in the background; its answer is dropped
+        pending, error = set(futures), None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None:
+                    if f is not futures[0]:
+                        self._count("hedges_won")
+                    return f.result()
+                error = f.exception()
+        raise error
+
+    def call(self, fn, label="", hedge=True):
+        """fn() with retries; `fn` performs one request (hedge=False: never duplicate it)."""
+        self._count("calls")
+        start = time.time()
+        for attempt in range(self.max_retries + 1):
+            wait_s = self._breaker_wait()
+            if wait_s > 0:
+                time.sleep(wait_s)
+            try:
+                result = self._attempt(fn, hedge)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                delay = self._backoff(attempt, e)
+                self._count("retries")
+                print(f"[RETRY] {label or 'API call'}: {type(e).__name__}; retry {attempt + 1}/{self.max_retries} "
+                      f"in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            self._record_success(time.time() - start)
+            return result
+
+    # -- async ---------------------------------------------------------------
+
+    async def _aattempt(self, afn, hedge):
+        import asyncio
+
+        self._count("attempts")
+        delay = self._hedge_delay() if hedge else None
+        if delay is None:
+            return await afn()
+        tasks = [asyncio.ensure_future(afn())]
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            self._count("hedges")
+            tasks.append(asyncio.ensure_future(afn()))
+        try:
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        if t is not tasks[0]:
+                            self._count("hedges_won")
+                        return t.result()
+                    error = t.exception()
+            raise error
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    async def acall(self, afn, label="", hedge=True):
+        """Async twin of `call`; `afn` returns a coroutine performing one request."""
+        import asyncio
+
+        self._count("calls")
+        start = time.time()
+        for attempt in range(self.max_retries + 1):
+            wait_s = self._breaker_wait()
+            if wait_s > 0:
+                await asyncio.sleep(wait_s)
+            try:
+                result = await self._aattempt(afn, hedge)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                delay = self._backoff(attempt, e)
+                self._count("retries")
+                print(f"[RETRY] {label or 'API call'}: {type(e).__name__}; retry {attempt + 1}/{self.max_retries} "
+                      f"in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            self._record_success(time.time() - start)
+            return result
+
+    # -- stats ---------------------------------------------------------------
+
+    def stats(self):
+        with self._lock:
+            ranked = sorted(self.latencies)
+            ttfts = sorted(self.ttfts)
+            counts = dict(self.counts)
+        quantile = lambda q: ranked[min(len(ranked) - 1, int(len(ranked) * q))] if ranked else 0.0
+        hist = {}
+        for latency in ranked:
+            bucket = next((f"<={b}s" for b in LATENCY_BUCKETS if latency <= b), f">{LATENCY_BUCKETS[-1]}s")
+            hist[bucket] = hist.get(bucket, 0) + 1
+        return {**counts, "p50": quantile(0.5), "p90": quantile(0.9), "p99": quantile(0.99),
+                "max": ranked[-1] if ranked else 0.0, "histogram": hist, "streamed": len(ttfts),
+                "ttft_p50": ttfts[len(ttfts) // 2] if ttfts else 0.0,
+                "ttft_p90": ttfts[min(len(ttfts) - 1, int(len(ttfts) * 0.9))] if ttfts else 0.0}
+
+    def write_stats(self, output_dir, current_stage):
+        """Append this run's call latencies and retry counts to api_latency.log."""
+        st = self.stats()
+        if not st["calls"]:
+            return
+        output_lines = []
+        output_lines.append("⏱️ API Call Summary ⏱️")
+        output_lines.append(f"{current_stage}")
+        output_lines.append(f"📞 Calls: {st['calls']}  Attempts: {st['attempts']}  Retries: {st['retries']}  "
+                            f"(429s: {st['rate_limited']}, breaker opens: {st['breaker_opens']})")
+        output_lines.append(f"🐇 Hedges: {st['hedges']} sent, {st['hedges_won']} won")
+        output_lines.append(f"📈 Latency p50 {st['p50']:.2f}s  p90 {st['p90']:.2f}s  p99 {st['p99']:.2f}s  "
+                            f"max {st['max']:.2f}s")
+        output_lines.append("📊 " + "  ".join(f"{b}: {n}" for b, n in st["histogram"].items()))
+        if st["streamed"]:
+            output_lines.append(f"🚿 Streamed: {st['streamed']}  time to first token p50 {st['ttft_p50']:.2f}s  "
+                                f"p90 {st['ttft_p90']:.2f}s")
+        output_lines.append("============================================\n")
+
+        output_text = "\n".join(output_lines)
+        print(output_text)
+
+        os.makedirs(output_dir, exist_ok=True)
+        with open(f"{output_dir}/api_latency.log", "a", encoding="utf-8") as f:
+            f.write(output_text + "\n")
+
+
+_executor = RequestExecutor()
+
+
+def get_executor():
+    return _executor
+
+
+def make_client(args, use_async=False):
+    """
+    The stage's OpenAI client (--base_url, --request_timeout). Retries are left
+    to the RequestExecutor, which this configures from --max_retries /
+    --hedge_after.
+    """
+    import openai
+
+    global _executor
+    _executor = RequestExecutor(max_retries=args.max_retries, hedge_after=args.hedge_after)
+    cls = openai.AsyncOpenAI if use_async else openai.OpenAI
+    return cls(api_key=os.environ.get("OPENAI_API_KEY"), base_url=args.base_url, max_retries=0,
+               timeout=args.request_timeout)
+
+
+def _usage_tokens(completion, default):
+    usage = getattr(completion, "usage", None)
+    return usage.total_tokens if usage else default
+
+
+def _limited(request_json, create):
+    """create() (one request) under the global rate limiter, if configured."""
+    limiter = get_rate_limiter()
+    if limiter is None:
+        return create()
+    import openai
+
+    estimate = estimate_request_tokens(request_json)
+    event_id, wait = limiter.try_acquire(estimate)
+    while event_id is None:
+        time.sleep(wait)
+        event_id, wait = limiter.try_acquire(estimate)
+    try:
+        completion = create()
+    except BaseException as e:
+        limiter.release(event_id)
+        if isinstance(e, openai.RateLimitError):
+            limiter.penalize(_retry_after(e) or 1.0)
+        raise
+    limiter.settle(event_id, _usage_tokens(completion, estimate))
+    return completion
+
+
+async def _alimited(request_json, acreate):
+    import asyncio
+
+    limiter = get_rate_limiter()
+    if limiter is None:
+        return await acreate()
+    import openai
+
+    estimate = estimate_request_tokens(request_json)
+    event_id, wait = limiter.try_acquire(estimate)
+    while event_id is None:
+        await asyncio.sleep(wait)
+        event_id, wait = limiter.try_acquire(estimate)
+    try:
+        completion = await acreate()
+    except BaseException as e:
+        limiter.release(event_id)
+        if isinstance(e, openai.RateLimitError):
+            limiter.penalize(_retry_after(e) or 1.0)
+        raise
+    limiter.settle(event_id, _usage_tokens(completion, estimate))
+    return completion
+
+
+def chat_completion(client, request_json, cache=None, batch=None):
+    """
+    client.chat.completions.create(**request_json) behind the response cache,
+    rate limiter and request executor. With a BatchQueue, a cache miss is
+    queued and BatchDeferred raised.
+    """
+    key, completion = _cache_lookup(cache, request_json)
+    if completion is not None:
+        return completion
+    if batch is not None:
+        batch.defer(key, request_json, cache.namespace)
+
+    completion = get_executor().call(
+        lambda: _limited(request_json, lambda: client.chat.completions.create(**request_json)),
+        label=request_json.get("model", ""))
+    _cache_store(cache, key, completion)
+    return completion
+
+
+async def achat_completion(client, request_json, cache=None):
+    """Async twin of chat_completion for openai.AsyncOpenAI clients."""
+    key, completion = _cache_lookup(cache, request_json)
+    if completion is not None:
+        return completion
+
+    completion = await get_executor().acall(
+        lambda: _alimited(request_json, lambda: client.chat.completions.create(**request_json)),
+        label=request_json.get("model", ""))
+    _cache_store(cache, key, completion)
+    return completion
+
+
+# ---------------------------------------------------------------------------
+# Streaming (--stream)
+# ---------------------------------------------------------------------------
+
+def fenced_code_so_far(content):
+    """
+    (code of the first fenced block received so far, whether its closing fence
+    has arrived), as extract_code_from_content would read it. An unfinished
+    last line is held back: it may turn out to be the fence.
+    """
+    m = re.search(r'^```(?:\w+)?\s*\n', content, re.MULTILINE)
+    if m is None:
+        return "", False
+    body = content[m.end():]
+    close = re.search(r'^```', body, re.MULTILINE)
+    if close is not None:
+        return body[:close.start()], True
+    return body[:body.rfind("\n") + 1], False
+
+
+class IncrementalWriter:
+    """Keeps a file equal to a growing text, appending only what is new."""
+
+    def __init__(self, path):
+        self.path = path
+        self.written = ""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        open(path, "w", encoding="utf-8").close()
+
+    def update(self, text):
+        if text == self.written:
+            return
+        if text.startswith(self.written):
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(text[len(self.written):])
+        else:
+            # a retried stream starts over
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.write(text)
+        self.written = text
+
+
+def _streamed_completion(request_json, chunks_meta, content, usage, finish_reason, cancelled=False):
+    from openai.types.chat import ChatCompletion
+
+    usage_estimated = usage is None
+    if usage_estimated:
+        # cancelled before the provider sent usage: estimate it like the rate limiter does
+        prompt_tokens = estimate_request_tokens(request_json)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4 + 1,
+                 "total_tokens": prompt_tokens + len(content) // 4 + 1}
+    else:
+        usage = usage.model_dump()
+    completion_json = {
+        "id": chunks_meta.get("id") or "chatcmpl-stream", "object": "chat.completion",
+        "created": chunks_meta.get("created") or int(time.time()),
+        "model": chunks_meta.get("model") or request_json.get("model", ""),
+        "choices": [{"index": 0, "finish_reason": finish_reason or "stop",
+                     "message": {"role": "assistant", "content": content}}],
+        "usage": usage,
+    }
+    if cancelled or usage_estimated:
+        # cut off by stop_when, or without the provider's usage: kept out of the response cache
+        completion_json["x_partial"] = True
+    return ChatCompletion.model_validate(completion_json)
+
+
+def _stream_request(request_json):
+    return {**request_json, "stream": True, "stream_options": {"include_usage": True}}
+
+
+def _consume_chunk(chunk, state, on_text, stop_when):
+    """Folds one stream chunk into `state`; True once `stop_when` says the reply is complete."""
+    for field in ("id", "created", "model"):
+        state["meta"].setdefault(field, getattr(chunk, field, None))
+    if getattr(chunk, "usage", None):
+        state["usage"] = chunk.usage
+    if not chunk.choices:
+        return False
+    choice = chunk.choices[0]
+    if choice.finish_reason:
+        state["finish_reason"] = choice.finish_reason
+    delta = choice.delta.content if choice.delta else None
+    if not delta:
+        return False
+    if state["ttft"] is None:
+        state["ttft"] = time.time() - state["start"]
+    state["content"] += delta
+    if on_text is not None:
+        on_text(state["content"])
+    return stop_when is not None and stop_when(state["content"])
+
+
+def _stream_once(client, request_json, on_text, stop_when):
+    state = {"meta": {}, "content": "", "usage": None, "finish_reason": None, "ttft": None, "start": time.time(),
+             "cancelled": False}
+    if on_text is not None:
+        on_text("")
+    stream = client.chat.completions.create(**_stream_request(request_json))
+    try:
+        for chunk in stream:
+            if _consume_chunk(chunk, state, on_text, stop_when):
+                # everything the stage needs has arrived; stop paying for the rest
+                state["finish_reason"] = "stop"
+                state["cancelled"] = True
+                break
+    finally:
+        stream.close()
+    if state["ttft"] is not None:
+        get_executor().record_ttft(state["ttft"])
+    return _streamed_completion(request_json, state["meta"], state["content"], state["usage"],
+                                state["finish_reason"], state["cancelled"])
+
+
+async def _astream_once(client, request_json, on_text, stop_when):
+    state = {"meta": {}, "content": "", "usage": None, "finish_reason": None, "ttft": None, "start": time.time(),
+             "cancelled": False}
+    if on_text is not None:
+        on_text("")
+    stream = await client.chat.completions.create(**_stream_request(request_json))
+    try:
+        async for chunk in stream:
+            if _consume_chunk(chunk, state, on_text, stop_when):
+                state["finish_reason"] = "stop"
+                state["cancelled"] = True
+                break
+    finally:
+        await stream.close()
+    if state["ttft"] is not None:
+        get_executor().record_ttft(state["ttft"])
+    return _streamed_completion(request_json, state["meta"], state["content"], state["usage"],
+                                state["finish_reason"], state["cancelled"])
+
+
+def stream_chat_completion(client, request_json, cache=None, on_text=None, stop_when=None):
+    """
+    chat_completion with stream=True: `on_text(content so far)` is called as
+    tokens arrive (and with "" when a retry starts over), and the stream is
+    closed as soon as `stop_when(content so far)` is true. Returns a regular
+    ChatCompletion. Streams are never hedged. A cancelled stream's usage is
+    estimated and it is not cached (the key does not include stop_when), so
+    only streams that finished with the provider's usage are stored.
+    """
+    key, completion = _cache_lookup(cache, request_json)
+    if completion is not None:
+        if on_text is not None:
+            on_text(completion.choices[0].message.content or "")
+        return completion
+
+    completion = get_executor().call(
+        lambda: _limited(request_json, lambda: _stream_once(client, request_json, on_text, stop_when)),
+        label=request_json.get("model", ""), hedge=False)
+    _cache_store(cache, key, completion)
+    return completion
+
+
+async def astream_chat_completion(client, request_json, cache=None, on_text=None, stop_when=None):
+    """Async twin of stream_chat_completion for openai.AsyncOpenAI clients."""
+    key, completion = _cache_lookup(cache, request_json)
+    if completion is not None:
+        if on_text is not None:
+            on_text(completion.choices[0].message.content or "")
+        return completion
+
+    completion = await get_executor().acall(
+        lambda: _alimited(request_json, lambda: _astream_once(client, request_json, on_text, stop_when)),
+        label=request_json.get("model", ""), hedge=False)
+    _cache_store(cache, key, completion)
+    return completion
@@ -4,11 +4,19 @@
 # Lives in: scripts/
 # Calls Python files in: codes/
 #
-# Runs all 4 experiment configurations for a single paper, then evaluates each.
-# Assumes you have already run 1_planning.py for this paper.
+# Runs all 4 experiment configurations for a single paper, then codes and
+# evaluates each and collects the result tables. The orchestration lives in
+# codes/run_pipeline.py, which records a manifest per step under
+# <base_output_dir>/.pipeline and skips steps whose inputs are unchanged, so
+# re-running this script after a crash picks up where it stopped.
+# Existing planning outputs in <base_output_dir> are reused.
 #
 # Usage (from project root):
-#   bash scripts/run_all_experiments.sh <paper_name> <pdf_json_path> <base_output_dir> [data_dir] [gpt_version] [paper_format]
+#   bash scripts/run_all_experiments.sh <paper_name> <pdf_json_path> <base_output_dir> [data_dir] [gpt_version] [paper_format] [cache_mode]
+#
+# cache_mode (off | read | readwrite | replay-only) controls the shared LLM
+# response cache; with readwrite, re-running after a crash only pays for
+# requests that never completed.
 #
 # Example:
 #   bash scripts/run_all_experiments.sh transformer data/transformer.json outputs/transformer ../data
@@ -26,9 +34,10 @@ BASE_OUTPUT_DIR=$3
 DATA_DIR=${4:-"../data"}
 GPT_VERSION=${5:-"o3-mini"}
 PAPER_FORMAT=${6:-"JSON"}
+CACHE_MODE=${7:-"readwrite"}
 
 if [ -z "$PAPER_NAME" ] || [ -z "$PDF_JSON_PATH" ] || [ -z "$BASE_OUTPUT_DIR" ]; then
-    echo "Usage: bash scripts/run_all_experiments.sh <paper_name> <pdf_json_path> <base_output_dir> [data_dir] [gpt_version] [paper_format]"
+    echo "Usage: bash scripts/run_all_experiments.sh <paper_name> <pdf_json_path> <base_output_dir> [data_dir] [gpt_version] [paper_format] [cache_mode]"
     exit 1
 fi
 
@@ -38,91 +47,18 @@ echo "  codes dir:   $CODES_DIR"
 echo "  output dir:  $BASE_OUTPUT_DIR"
 echo "============================================"
 
-# The planning output should already exist at BASE_OUTPUT_DIR
-# We create separate sub-dirs for each experiment's analyzing artifacts
-
-run_experiment() {
-    local MODE=$1
-    local FORMAT=$2
-    local EXP_NAME="${MODE}_${FORMAT}"
-    local EXP_OUTPUT="${BASE_OUTPUT_DIR}/experiments/${EXP_NAME}"
-
-    echo ""
-    echo "--------------------------------------------"
-    echo "Experiment: $EXP_NAME"
-    echo "--------------------------------------------"
-
-    # Create experiment output dir
-    mkdir -p "$EXP_OUTPUT"
-
-    # Copy planning artifacts so the experiment can find them
-    if [ ! -f "$EXP_OUTPUT/planning_trajectories.json" ]; then
-        cp "$BASE_OUTPUT_DIR/planning_trajectories.json" "$EXP_OUTPUT/" 2>/dev/null || true
-        cp "$BASE_OUTPUT_DIR/planning_config.yaml" "$EXP_OUTPUT/" 2>/dev/null || true
-        cp "$BASE_OUTPUT_DIR/task_list.json" "$EXP_OUTPUT/" 2>/dev/null || true
-    fi
-
-    # Also copy any existing *_simple_analysis_response.json files
-    # (needed if static_only/multi_signal reuse baseline analysis outputs)
-    for f in "$BASE_OUTPUT_DIR"/*_simple_analysis_response.json; do
-        [ -f "$f" ] && cp -n "$f" "$EXP_OUTPUT/" 2>/dev/null || true
-    done
-
-    # Determine repo dir (for static analysis on existing .py files)
-    REPO_DIR="${BASE_OUTPUT_DIR}/${PAPER_NAME}_repo"
-
-    # Run the analyzing experiment from the codes/ directory
-    python3 "${CODES_DIR}/2_analyzing_experiments.py" \
-        --paper_name "$PAPER_NAME" \
-        --gpt_version "$GPT_VERSION" \
-        --paper_format "$PAPER_FORMAT" \
-        --pdf_json_path "$PDF_JSON_PATH" \
-        --output_dir "$EXP_OUTPUT" \
-        --mode "$MODE" \
-        --feedback_format "$FORMAT" \
-        --output_repo_dir "$REPO_DIR"
-
-    echo "Experiment $EXP_NAME complete."
-    echo "Token summary: $(cat "$EXP_OUTPUT/experiment_summary_${MODE}_${FORMAT}.json" | python -c 'import sys,json; d=json.load(sys.stdin); print(f"total={d[\"total_tokens\"]:,}")')"
-}
-
-
-# =====================================================
-# EXPERIMENT 1: LLM-only with structured JSON (baseline loop)
-# This is your original 2_analyzing.py behavior
-# =====================================================
-run_experiment "llm_only" "json"
-
-# =====================================================
-# EXPERIMENT 2: LLM-only with free-text (ablation)
-# Same rubric, but no JSON schema constraint
-# =====================================================
-run_experiment "llm_only" "freetext"
-
-# =====================================================
-# EXPERIMENT 3: Static-only (no LLM judge at all)
-# Only ast.parse + pylint + import probe
-# =====================================================
-run_experiment "static_only" "json"
-
-# =====================================================
-# EXPERIMENT 4: Multi-signal (all channels combined)
-# LLM judge + static analysis + execution probes
-# =====================================================
-run_experiment "multi_signal" "json"
-
+python3 "${CODES_DIR}/run_pipeline.py" \
+    --paper_name "$PAPER_NAME" \
+    --paper_format "$PAPER_FORMAT" \
+    --pdf_json_path "$PDF_JSON_PATH" \
+    --output_dir "$BASE_OUTPUT_DIR" \
+    --data_dir "$DATA_DIR" \
+    --gpt_version "$GPT_VERSION" \
+    --experiments "llm_only:json,llm_only:freetext,static_only:json,multi_signal:json" \
+    --cache_mode "$CACHE_MODE"
 
 echo ""
 echo "============================================"
 echo "ALL EXPERIMENTS COMPLETE FOR: $PAPER_NAME"
 echo "============================================"
-echo ""
-echo "Next steps:"
-echo "1. Run 3_coding.py for each experiment's output to generate repos"
-echo "2. Run eval.py on each repo to get rubric scores"
-echo "3. Run collect_results.py to gather all scores into a table"
-echo ""
-echo "Example for one experiment:"
-echo "  python ${CODES_DIR}/3_coding.py --paper_name $PAPER_NAME --output_dir $BASE_OUTPUT_DIR/experiments/llm_only_json --output_repo_dir $BASE_OUTPUT_DIR/experiments/llm_only_json/${PAPER_NAME}_repo ..."
-echo "  python ${CODES_DIR}/eval.py --paper_name $PAPER_NAME --target_repo_dir $BASE_OUTPUT_DIR/experiments/llm_only_json/${PAPER_NAME}_repo ..."
-echo "  python ${CODES_DIR}/collect_results.py --base_dir outputs/ --papers transformer,vdc,curbench,gem,fit,sea"
\ No newline at end of file
+echo "Result tables: $BASE_OUTPUT_DIR/results_tables.txt"
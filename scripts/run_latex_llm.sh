@@ -13,33 +13,12 @@ echo $PAPER_NAME
 
 echo "------- PaperCoder -------"
 
-python ../codes/1_planning_llm.py \
-    --paper_name $PAPER_NAME \
-    --model_name ${MODEL_NAME} \
-    --tp_size ${TP_SIZE} \
-    --pdf_latex_path ${PDF_LATEX_CLEANED_PATH} \
-    --paper_format LaTeX \
-    --output_dir ${OUTPUT_DIR}
-
-python ../codes/1.1_extract_config.py \
-    --paper_name $PAPER_NAME \
-    --output_dir ${OUTPUT_DIR}
-
-cp -rp ${OUTPUT_DIR}/planning_config.yaml ${OUTPUT_REPO_DIR}/config.yaml
-
-python ../codes/2_analyzing_llm.py \
-    --paper_name $PAPER_NAME \
-    --model_name ${MODEL_NAME} \
-    --tp_size ${TP_SIZE} \
-    --pdf_latex_path ${PDF_LATEX_CLEANED_PATH} \
-    --paper_format LaTeX \
-    --output_dir ${OUTPUT_DIR}
-
-python ../codes/3_coding_llm.py  \
+# planning, config extraction, analyzing and coding in one process: the model is loaded once
+python ../codes/run_local.py \
     --paper_name $PAPER_NAME \
     --model_name ${MODEL_NAME} \
     --tp_size ${TP_SIZE} \
     --pdf_latex_path ${PDF_LATEX_CLEANED_PATH} \
     --paper_format LaTeX \
     --output_dir ${OUTPUT_DIR} \
-    --output_repo_dir ${OUTPUT_REPO_DIR} \
+    --output_repo_dir ${OUTPUT_REPO_DIR}
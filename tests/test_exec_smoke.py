@@ -0,0 +1,71 @@
+"""
+Exec-smoke channel (codes/exec_smoke.py, static_analysis.exec_smoke_check) on
+a tiny generated repo: one forward/backward step of a small nn.Module built
+from config.yaml. Needs torch; skipped where it is not installed.
+
+    python -m pytest tests/test_exec_smoke.py
+"""
+
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "codes"))
+
+from exec_smoke import run, shrink_config  # noqa: E402
+from static_analysis import exec_smoke_check  # noqa: E402
+
+CONFIG = """model:
+  d_model: 512
+  vocab_size: 1000
+  num_layers: 6
+"""
+
+TINY_MODEL = """import torch.nn as nn
+
+
+class TinyLM(nn.Module):
+    def __init__(self, d_model, vocab_size):
+        super().__init__()
+        self.embed = nn.Embedding(vocab_size, d_model)
+        self.proj = nn.Linear(d_model, vocab_size)
+
+    def forward(self, x):
+        return self.proj(self.embed(x))
+"""
+
+# the projection expects twice the embedding width
+BROKEN_MODEL = TINY_MODEL.replace("nn.Linear(d_model, vocab_size)", "nn.Linear(2 * d_model, vocab_size)")
+
+
+def make_repo(tmp_path, source):
+    (tmp_path / "model.py").write_text(source, encoding="utf-8")
+    (tmp_path / "config.yaml").write_text(CONFIG, encoding="utf-8")
+    return str(tmp_path)
+
+
+def test_tiny_module_steps(tmp_path):
+    repo = make_repo(tmp_path, TINY_MODEL)
+    config = shrink_config({"model": {"d_model": 512, "vocab_size": 1000, "num_layers": 6}})
+    result = run(os.path.join(repo, "model.py"), config, repo)
+    assert "skipped" not in result
+    assert result["exec_smoke"] == []
+
+
+def test_exec_smoke_check_clean(tmp_path):
+    repo = make_repo(tmp_path, TINY_MODEL)
+    assert exec_smoke_check(os.path.join(repo, "model.py"), repo, memory_mb=0) == []
+
+
+def test_exec_smoke_check_reports_shape_error(tmp_path):
+    repo = make_repo(tmp_path, BROKEN_MODEL)
+    critiques = exec_smoke_check(os.path.join(repo, "model.py"), repo, memory_mb=0)
+    assert len(critiques) == 1
+    critique = critiques[0]
+    assert critique["source"] == "exec-smoke"
+    assert critique["severity_level"] == "high"
+    assert "Smoke forward of TinyLM" in critique["critique"]
+    assert critique["target_func_name"] == "forward"